@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Decode cost per ACPW frame type, schema table against the slicing decoders it replaced:
+#
+#   python3 acpw_benchmark.py --number 100000
+
+import argparse
+import timeit
+
+import acpw_protocol
+from definitions import AcpwCommandId
+
+PAYLOAD_OFFSET = acpw_protocol.PAYLOAD_OFFSET
+
+SAMPLE_PAYLOADS = {
+    AcpwCommandId.PILOT_STATE.value: bytes([5]),
+    AcpwCommandId.VOLTAGE.value: (230000).to_bytes(4, "big") * 3,
+    AcpwCommandId.ENERGY.value: (123456789).to_bytes(8, "big"),
+    AcpwCommandId.FAULTS.value: (0x40).to_bytes(4, "big"),
+    AcpwCommandId.OTA_STATUS.value: bytes([1, 42]),
+    AcpwCommandId.CURRENT_OFFERED_TO_EV.value: bytes([16, 2]),
+    AcpwCommandId.VERSION.value: b"2.4.17"
+}
+
+
+def _int_at(data, offset, size):
+    return int.from_bytes(data[PAYLOAD_OFFSET + offset:PAYLOAD_OFFSET + offset + size], byteorder="big")
+
+
+def slicing_decode(data):
+    command = data[PAYLOAD_OFFSET - 1]
+    if command in (AcpwCommandId.VOLTAGE.value, AcpwCommandId.CURRENT.value, AcpwCommandId.POWER.value):
+        return {"P1": _int_at(data, 0, 4), "P2": _int_at(data, 4, 4), "P3": _int_at(data, 8, 4)}
+    elif command == AcpwCommandId.ENERGY.value:
+        return {"P1": _int_at(data, 0, 8), "P2": 0, "P3": 0}
+    elif command == AcpwCommandId.FAULTS.value:
+        return {"value": _int_at(data, 0, 4)}
+    elif command == AcpwCommandId.OTA_STATUS.value:
+        return {"value": _int_at(data, 0, 1), "packetId": _int_at(data, 1, 1)}
+    elif command == AcpwCommandId.CURRENT_OFFERED_TO_EV.value:
+        return {"value": {"current": _int_at(data, 0, 1), "reason": _int_at(data, 1, 1)}}
+    elif command == AcpwCommandId.VERSION.value:
+        return {"value": data[PAYLOAD_OFFSET:len(data) - 3].decode("utf-8")}
+    return {"value": data[PAYLOAD_OFFSET]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ACPW payload decode benchmark")
+    parser.add_argument("--number", type=int, default=100000, help="decodes per frame type")
+    args = parser.parse_args()
+
+    print("{0:<24}{1:>14}{2:>14}".format("frame", "slicing us", "schema us"))
+    for command, payload in sorted(SAMPLE_PAYLOADS.items()):
+        frame = acpw_protocol.create_frame(1, command, payload)
+        if acpw_protocol.decode_payload(frame).data() != slicing_decode(frame):
+            raise SystemExit("{0} decoders disagree".format(AcpwCommandId(command).name))
+        slicing = timeit.timeit(lambda: slicing_decode(frame), number=args.number)
+        schema = timeit.timeit(lambda: acpw_protocol.decode_payload(frame), number=args.number)
+        print("{0:<24}{1:>14.2f}{2:>14.2f}".format(
+            AcpwCommandId(command).name, slicing * 1e6 / args.number, schema * 1e6 / args.number))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+import binascii
+import json
+import logging
+import random
+import struct
+import time
+
+from definitions import AcpwCommandId
+
+logger = logging.getLogger("EVC04_Agent.acpw_protocol")
+
+START_BYTE = 0xDE
+STOP_BYTE = 0xAD
+# start, message size (2), message ids (2), command, crc (2), stop
+MIN_FRAME_SIZE = 9
+MAX_FRAME_SIZE = 1024
+# ACPW only sends fixed measurements and short version or serial number strings
+MAX_INBOUND_FRAME_SIZE = 128
+PAYLOAD_OFFSET = 6
+
+CRC_POLY = 0x1021
+CRC_INIT = 0xFFFF
+CRC_CHECK_VALUE = 0x29B1  # CRC-CCITT (0xFFFF) of b"123456789"
+
+
+def create_crc_table():
+    crc_tabccitt = [0] * 256
+    for i in range(256):
+        crc = 0
+        c = i << 8
+        for j in range(8):
+            if (crc ^ c) & 0x8000:
+                crc = (crc << 1) ^ CRC_POLY
+            else:
+                crc = crc << 1
+            c = c << 1
+        crc_tabccitt[i] = crc & 0xffff
+    return crc_tabccitt
+
+
+CRC_TABLE = create_crc_table()
+
+
+def crc_ccitt_table(data):
+    crc = CRC_INIT
+    table = CRC_TABLE
+    for b in data:
+        crc = ((crc << 8) ^ table[((crc >> 8) ^ b) & 0xff]) & 0xffff
+    return crc
+
+
+def crc_ccitt_binascii(data):
+    # crc_hqx is the same non-reflected 0x1021 polynomial, implemented in C
+    return binascii.crc_hqx(data, CRC_INIT)
+
+
+CRC_BACKENDS = {
+    "binascii": crc_ccitt_binascii,
+    "table": crc_ccitt_table
+}
+
+
+def check_crc_backend(crc_function, vector_count=16):
+    if crc_function(b"123456789") != CRC_CHECK_VALUE:
+        return False
+    generator = random.Random(0xACB0)
+    for i in range(vector_count):
+        vector = bytes(generator.getrandbits(8) for _ in range(generator.randint(0, 600)))
+        if crc_function(vector) != crc_ccitt_table(vector):
+            return False
+    return True
+
+
+def select_crc_backend(name="binascii"):
+    global calculate_crc, crc_backend
+    crc_function = CRC_BACKENDS.get(name)
+    try:
+        if crc_function is None or not check_crc_backend(crc_function):
+            raise ValueError(name)
+    except:
+        logger.info("CRC backend {0} unusable, falling back to table".format(name))
+        name = "table"
+        crc_function = crc_ccitt_table
+    calculate_crc = crc_function
+    crc_backend = name
+    return name
+
+
+calculate_crc = crc_ccitt_table
+crc_backend = "table"
+select_crc_backend()
+
+
+def create_frame(message_id, command, payload=b"", receive_id=0):
+    body = bytearray([0, 0, message_id, receive_id, command])
+    body.extend(payload)
+    # message size counts itself, the ids, command, payload and crc
+    body[0:2] = (len(body) + 2).to_bytes(2, byteorder="big")
+    crc = calculate_crc(body)
+    return bytes([START_BYTE]) + bytes(body) + bytes([crc >> 8, crc & 0xff, STOP_BYTE])
+
+
+class FrameBuilder(object):
+    """Builds frames in one preallocated buffer.
+
+    Payload parts, typically memoryview slices of a larger image, are copied
+    once into the buffer and the finished frame once out of it. A builder is
+    meant to be owned by a single thread.
+    """
+
+    def __init__(self, max_payload_size):
+        self.buffer = bytearray(MIN_FRAME_SIZE + max_payload_size)
+        self.view = memoryview(self.buffer)
+
+    def build(self, message_id, command, payload_parts, receive_id=0):
+        buffer = self.buffer
+        end = PAYLOAD_OFFSET
+        for part in payload_parts:
+            size = len(part)
+            buffer[end:end + size] = part
+            end += size
+        buffer[0] = START_BYTE
+        buffer[1] = (end + 1) >> 8
+        buffer[2] = (end + 1) & 0xff
+        buffer[3] = message_id
+        buffer[4] = receive_id
+        buffer[5] = command
+        crc = calculate_crc(self.view[1:end])
+        buffer[end] = crc >> 8
+        buffer[end + 1] = crc & 0xff
+        buffer[end + 2] = STOP_BYTE
+        return bytes(self.view[:end + 3])
+
+
+def check_frame_crc(frame):
+    size = len(frame)
+    return calculate_crc(frame[1:size - 3]) == (frame[size - 3] << 8 | frame[size - 2])
+
+
+class AcpwFrameDecoder(object):
+    """Incremental ACPW frame decoder.
+
+    Bytes are fed in whatever chunks the serial port delivers them. A frame
+    split across reads is carried over until its remaining bytes arrive, and
+    garbage between frames is skipped by searching for the next start byte.
+    A candidate whose size field is out of range, whose stop byte or crc is
+    wrong, or whose remaining bytes do not arrive within partial_timeout is
+    dropped one byte at a time, so the decoder resyncs on the next start byte
+    inside the bytes it already holds instead of losing the frames behind it.
+    """
+
+    def __init__(self, max_frame_size=MAX_INBOUND_FRAME_SIZE, check_crc=True, partial_timeout=0.5):
+        self.max_frame_size = max_frame_size
+        self.check_crc = check_crc
+        self.partial_timeout = partial_timeout  # Seconds
+        self.buffer = bytearray()
+        self.partial_since = None  # When the candidate at the head of buffer was first left incomplete
+        self.resync_count = 0
+        self.discarded_bytes = 0
+        self.crc_failures = 0
+        self.partial_timeouts = 0
+
+    def feed(self, data, now=None):
+        """Returns the complete frames after data, feeding b"" only expires a stale partial candidate."""
+        if now is None:
+            now = time.monotonic()
+        buffer = self.buffer
+        buffer.extend(data)
+        frames = []
+        index = 0
+        length = len(buffer)
+        while index < length:
+            if buffer[index] != START_BYTE:
+                start = buffer.find(START_BYTE, index)
+                if start == -1:
+                    start = length
+                self._discard(start - index)
+                index = start
+                continue
+            if length - index < 3:
+                frame_size = None
+            else:
+                # message size field counts everything except start and stop bytes
+                frame_size = ((buffer[index + 1] << 8) | buffer[index + 2]) + 2
+                if frame_size < MIN_FRAME_SIZE or frame_size > self.max_frame_size:
+                    self._discard(1)
+                    index += 1
+                    continue
+            if frame_size is None or length - index < frame_size:
+                if index > 0 or self.partial_since is None:
+                    self.partial_since = now
+                elif now - self.partial_since > self.partial_timeout:
+                    self.partial_timeouts += 1
+                    self._discard(1)
+                    index += 1
+                    continue
+                break
+            frame = bytes(buffer[index:index + frame_size])
+            if frame[-1] != STOP_BYTE:
+                self._discard(1)
+                index += 1
+                continue
+            if self.check_crc and not check_frame_crc(frame):
+                self.crc_failures += 1
+                self._discard(1)
+                index += 1
+                continue
+            frames.append(frame)
+            index += frame_size
+        del buffer[:index]
+        if not buffer:
+            self.partial_since = None
+        return frames
+
+    def pending(self):
+        return len(self.buffer) > 0
+
+    def reset(self):
+        self._discard(len(self.buffer))
+        del self.buffer[:]
+        self.partial_since = None
+
+    def _discard(self, count):
+        if count > 0:
+            self.resync_count += 1
+            self.discarded_bytes += count
+            logger.debug("ACPW decoder discarded {0} bytes".format(count))
+
+
+class AcpwEvent(object):
+    """Decoded ACPW message.
+
+    The JSON form is only needed by the zmq dealers, so it is built on first
+    use and cached.
+    """
+    __slots__ = ("event_type", "_json")
+
+    def __init__(self, event_type):
+        self.event_type = event_type
+        self._json = None
+
+    def data(self):
+        raise NotImplementedError
+
+    def as_dict(self):
+        return {"type": self.event_type, "data": self.data()}
+
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self.as_dict())
+        return self._json
+
+    def __repr__(self):
+        return "{0}({1})".format(self.event_type, self.data())
+
+
+class PhaseEvent(AcpwEvent):
+    __slots__ = ("P1", "P2", "P3")
+
+    def __init__(self, event_type, p1, p2=0, p3=0):
+        super().__init__(event_type)
+        self.P1 = p1
+        self.P2 = p2
+        self.P3 = p3
+
+    def data(self):
+        return {"P1": self.P1, "P2": self.P2, "P3": self.P3}
+
+
+class ValueEvent(AcpwEvent):
+    __slots__ = ("value",)
+
+    def __init__(self, event_type, value):
+        super().__init__(event_type)
+        self.value = value
+
+    def data(self):
+        return {"value": self.value}
+
+
+class OtaStatusEvent(AcpwEvent):
+    __slots__ = ("value", "packet_id")
+
+    def __init__(self, event_type, value, packet_id):
+        super().__init__(event_type)
+        self.value = value
+        self.packet_id = packet_id
+
+    def data(self):
+        return {"value": self.value, "packetId": self.packet_id}
+
+
+class LimitsEvent(AcpwEvent):
+    __slots__ = ("minimum", "maximum")
+
+    def __init__(self, event_type, minimum, maximum):
+        super().__init__(event_type)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def data(self):
+        return {"min": self.minimum, "max": self.maximum}
+
+
+class CurrentOfferedEvent(AcpwEvent):
+    __slots__ = ("current", "reason")
+
+    def __init__(self, event_type, current, reason):
+        super().__init__(event_type)
+        self.current = current
+        self.reason = reason
+
+    def data(self):
+        return {"value": {"current": self.current, "reason": self.reason}}
+
+
+class PayloadSchema(object):
+    """Layout of a fixed ACPW payload and the event it decodes to.
+
+    Fields are unpacked in one call straight from the frame, in the order of
+    the event constructor arguments. A schema without a format takes the rest
+    of the payload as a utf-8 string.
+    """
+    __slots__ = ("event_type", "event_class", "struct", "fields")
+
+    def __init__(self, event_type, event_class, payload_format, fields):
+        self.event_type = event_type
+        self.event_class = event_class
+        self.struct = struct.Struct(payload_format) if payload_format is not None else None
+        self.fields = fields
+        field_count = len(self.struct.unpack(bytes(self.struct.size))) if self.struct is not None else 1
+        if field_count != len(fields):
+            raise ValueError("{0} payload has {1} fields, {2} names given".format(
+                event_type, field_count, len(fields)))
+
+    def decode(self, frame):
+        if self.struct is None:
+            view = memoryview(frame)
+            return self.event_class(self.event_type, str(view[PAYLOAD_OFFSET:len(frame) - 3], "utf-8"))
+        return self.event_class(self.event_type, *self.struct.unpack_from(frame, PAYLOAD_OFFSET))
+
+
+PAYLOAD_SCHEMAS = {
+    AcpwCommandId.PILOT_STATE.value: PayloadSchema("pilotState", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.VOLTAGE.value: PayloadSchema("voltageEvent", PhaseEvent, ">III", ("P1", "P2", "P3")),
+    AcpwCommandId.CURRENT.value: PayloadSchema("currentEvent", PhaseEvent, ">III", ("P1", "P2", "P3")),
+    AcpwCommandId.ENERGY.value: PayloadSchema("totalEnergyEvent", PhaseEvent, ">Q", ("P1",)),
+    AcpwCommandId.POWER.value: PayloadSchema("activePowerEvent", PhaseEvent, ">III", ("P1", "P2", "P3")),
+    AcpwCommandId.FAULTS.value: PayloadSchema("faultState", ValueEvent, ">I", ("value",)),
+    AcpwCommandId.OTA_STATUS.value: PayloadSchema("otaStatus", OtaStatusEvent, ">BB", ("value", "packetId")),
+    AcpwCommandId.PROXIMITY_STATE.value: PayloadSchema("proximityState", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.MAX_CURRENT.value: PayloadSchema("maximumCurrent", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.VERSION.value: PayloadSchema("acpwVersion", ValueEvent, None, ("value",)),
+    AcpwCommandId.SERIAL_NUMBER.value: PayloadSchema("serialNumber", ValueEvent, None, ("value",)),
+    AcpwCommandId.EXTERNAL_CHARGE.value: PayloadSchema("externalCharge", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.MIN_CURRENT.value: PayloadSchema("minCurrent", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.APP_AVAILABLE_CURRENT.value: PayloadSchema("availableCurrent", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.DEVICE_CPHOME_CURRENT.value: PayloadSchema("powerOptimizerLimits", LimitsEvent, ">BB",
+                                                             ("min", "max")),
+    AcpwCommandId.APP_CPHOME_CURRENT.value: PayloadSchema("powerOptimizer", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.LOCKABLE_CABLE.value: PayloadSchema("lockableCable", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.CURRENT_OFFERED_TO_EV.value: PayloadSchema("currentOfferedEv", CurrentOfferedEvent, ">BB",
+                                                             ("current", "reason")),
+    AcpwCommandId.NUMBER_OF_PHASE.value: PayloadSchema("phaseType", ValueEvent, ">B", ("value",)),
+    AcpwCommandId.PROXIMITY_PILOT_CURRENT.value: PayloadSchema("proximityPilotCurrent", ValueEvent, ">B",
+                                                               ("value",)),
+    AcpwCommandId.SET_MODBUSTCP_CURRENT.value: PayloadSchema("modbusTcpCurrent", ValueEvent, ">B", ("value",))
+}
+
+
+def decode_payload(frame):
+    schema = PAYLOAD_SCHEMAS.get(frame[PAYLOAD_OFFSET - 1])
+    if schema is None:
+        return None
+    return schema.decode(frame)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# Simulated ACPW board behind a pseudo terminal, for running the agent without hardware:
+#
+#   python3 acpw_simulator.py --link /tmp/ttyACPW --pilot-script A1:5,B1:5,B2:2,C2:120,B1:5,A1
+#   ACPW_SERIAL_PORT=/tmp/ttyACPW python3 agent.py
+
+import argparse
+import logging
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+import acpw_protocol
+from definitions import AcpwCommandId, ControlPilotStates, ProximityPilotStates, AcpwOtaStatus
+
+logger = logging.getLogger("EVC04_Agent.acpw_simulator")
+
+OTA_PACKET_SIZE = 512
+
+
+class AcpwSimulator(object):
+
+    def __init__(self, version="1.0.0", serial_number="SIM0000001", link_path=None,
+                 meter_interval=0.0, crc_error_rate=0.0, partial_frame_rate=0.0, ota_version=None):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.port_name = os.ttyname(self.slave_fd)
+        self.link_path = link_path
+        if link_path is not None:
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.symlink(self.port_name, link_path)
+            self.port_name = link_path
+
+        self.version = version
+        self.serial_number = serial_number
+        self.ota_version = ota_version
+        self.meter_interval = meter_interval
+        self.crc_error_rate = crc_error_rate
+        self.partial_frame_rate = partial_frame_rate
+
+        self.message_id = 0
+        self.write_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        # frames from the agent include OTA data, and a bad crc is answered with a NACK below
+        self.decoder = acpw_protocol.AcpwFrameDecoder(acpw_protocol.MAX_FRAME_SIZE, check_crc=False)
+        self.received = {}
+        self.running = threading.Event()
+
+        self.pilot_state = ControlPilotStates.A1
+        self.proximity_state = ProximityPilotStates.NoCable
+        self.faults = 0
+        self.max_current = 32
+        self.min_current = 6
+        self.available_current = 32
+        self.lockable_cable = 0
+        self.modbustcp_current = 32
+        self.power_optimizer = 0
+        self.power_optimizer_limits = (6, 32)
+        self.proximity_pilot_current = 32
+        self.number_of_phase = 1
+        self.external_charge = 0
+        self.current_limit = 32
+        self.voltage = 230
+        self.energy = 0.0
+        self.energy_time = time.monotonic()
+
+        self.ota_packets = {}
+        self.ota_active = False
+
+        self.handlers = {
+            AcpwCommandId.PILOT_STATE.value: lambda frame, payload: self.send_pilot_state(),
+            AcpwCommandId.VOLTAGE.value: lambda frame, payload: self.send_voltage(),
+            AcpwCommandId.CURRENT.value: lambda frame, payload: self.send_current(),
+            AcpwCommandId.POWER.value: lambda frame, payload: self.send_power(),
+            AcpwCommandId.ENERGY.value: lambda frame, payload: self.send_energy(),
+            AcpwCommandId.FAULTS.value: lambda frame, payload: self.send_faults(),
+            AcpwCommandId.PROXIMITY_STATE.value: lambda frame, payload: self.send_proximity_state(),
+            AcpwCommandId.VERSION.value: lambda frame, payload: self.send_string(AcpwCommandId.VERSION, self.version),
+            AcpwCommandId.SERIAL_NUMBER.value:
+                lambda frame, payload: self.send_string(AcpwCommandId.SERIAL_NUMBER, self.serial_number),
+            AcpwCommandId.DEVICE_CPHOME_CURRENT.value:
+                lambda frame, payload: self.send(AcpwCommandId.DEVICE_CPHOME_CURRENT,
+                                                 bytes(self.power_optimizer_limits)),
+            AcpwCommandId.CURRENT_OFFERED_TO_EV.value:
+                lambda frame, payload: self.send(AcpwCommandId.CURRENT_OFFERED_TO_EV,
+                                                 bytes([self.current_limit, 0])),
+            AcpwCommandId.START_CHARGING.value: self._start_charging,
+            AcpwCommandId.STOP_CHARGING.value: self._stop_charging,
+            AcpwCommandId.PAUSE_CHARGE.value: self._pause_charging,
+            AcpwCommandId.SET_CURRENT_LIMIT.value: self._set_current_limit,
+            AcpwCommandId.RESET.value: lambda frame, payload: self._reboot(self.version),
+            AcpwCommandId.REBOOT.value: lambda frame, payload: self._reboot(self.version),
+            AcpwCommandId.OTA_START.value: self._ota_start,
+            AcpwCommandId.OTA_STATUS.value: lambda frame, payload: self._send_ota_status(),
+            AcpwCommandId.OTA_DATA.value: self._ota_data
+        }
+        # Single byte settings, set when sent with payload and reported back in both cases
+        self.byte_settings = {
+            AcpwCommandId.MAX_CURRENT.value: "max_current",
+            AcpwCommandId.MIN_CURRENT.value: "min_current",
+            AcpwCommandId.APP_AVAILABLE_CURRENT.value: "available_current",
+            AcpwCommandId.LOCKABLE_CABLE.value: "lockable_cable",
+            AcpwCommandId.APP_CPHOME_CURRENT.value: "power_optimizer",
+            AcpwCommandId.NUMBER_OF_PHASE.value: "number_of_phase",
+            AcpwCommandId.PROXIMITY_PILOT_CURRENT.value: "proximity_pilot_current",
+            AcpwCommandId.SET_MODBUSTCP_CURRENT.value: "modbustcp_current",
+            AcpwCommandId.EXTERNAL_CHARGE.value: "external_charge"
+        }
+
+    def start(self):
+        self.running.set()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        if self.meter_interval > 0:
+            threading.Thread(target=self._meter_loop, daemon=True).start()
+
+    def stop(self):
+        self.running.clear()
+        if self.link_path is not None and os.path.lexists(self.link_path):
+            os.remove(self.link_path)
+
+    # Outgoing frames
+
+    def send(self, command, payload=b"", receive_id=0):
+        with self.write_lock:
+            self.message_id = self.message_id % 255 + 1
+            frame = bytearray(acpw_protocol.create_frame(self.message_id, command.value, payload, receive_id))
+            if self.crc_error_rate > 0 and random.random() < self.crc_error_rate:
+                frame[-2] ^= 0xff
+                logger.info("Injecting crc error in {0}".format(command.name))
+            if self.partial_frame_rate > 0 and random.random() < self.partial_frame_rate:
+                split = random.randint(1, len(frame) - 1)
+                logger.info("Injecting partial frame {0} at byte {1}".format(command.name, split))
+                os.write(self.master_fd, bytes(frame[:split]))
+                time.sleep(0.05)
+                os.write(self.master_fd, bytes(frame[split:]))
+            else:
+                os.write(self.master_fd, bytes(frame))
+
+    def send_garbage(self, size=8):
+        with self.write_lock:
+            os.write(self.master_fd, bytes(random.getrandbits(8) for _ in range(size)))
+
+    def send_string(self, command, value):
+        self.send(command, value.encode("utf-8"))
+
+    def send_pilot_state(self):
+        self.send(AcpwCommandId.PILOT_STATE, bytes([self.pilot_state.value]))
+
+    def send_proximity_state(self):
+        self.send(AcpwCommandId.PROXIMITY_STATE, bytes([self.proximity_state.value]))
+
+    def send_faults(self):
+        self.send(AcpwCommandId.FAULTS, struct.pack(">I", self.faults))
+
+    def send_voltage(self):
+        self.send(AcpwCommandId.VOLTAGE, struct.pack(">III", *self._phase_values(self.voltage)))
+
+    def send_current(self):
+        self.send(AcpwCommandId.CURRENT, struct.pack(">III", *self._phase_values(self._current_ma())))
+
+    def send_power(self):
+        power = int(self.voltage * self._current_ma() / 1000)
+        self.send(AcpwCommandId.POWER, struct.pack(">III", *self._phase_values(power)))
+
+    def send_energy(self):
+        self.send(AcpwCommandId.ENERGY, struct.pack(">Q", int(self._update_energy())))
+
+    # Scenario control
+
+    def set_pilot_state(self, state):
+        with self.state_lock:
+            self._update_energy()
+            self.pilot_state = state
+            if state in (ControlPilotStates.A1, ControlPilotStates.A2):
+                self.proximity_state = ProximityPilotStates.NoCable
+            else:
+                self.proximity_state = ProximityPilotStates.Plugged
+        logger.info("Pilot state {0}".format(state.name))
+        self.send_pilot_state()
+        self.send_proximity_state()
+
+    def set_faults(self, faults):
+        self.faults = faults
+        self.send_faults()
+
+    def run_pilot_script(self, script):
+        for state, duration in script:
+            if not self.running.is_set():
+                break
+            self.set_pilot_state(state)
+            if duration is not None:
+                time.sleep(duration)
+
+    # Incoming frames
+
+    def _read_loop(self):
+        while self.running.is_set():
+            readable, _, _ = select.select([self.master_fd], [], [], 0.5)
+            if not readable:
+                continue
+            data = os.read(self.master_fd, 4096)
+            for frame in self.decoder.feed(data):
+                if not acpw_protocol.check_frame_crc(frame):
+                    logger.info("Crc error in received frame")
+                    self.send(AcpwCommandId.NACK, receive_id=frame[3])
+                    continue
+                self._handle_frame(frame)
+
+    def _handle_frame(self, frame):
+        command = frame[5]
+        payload = frame[6:-3]
+        self.received[command] = self.received.get(command, 0) + 1
+        try:
+            name = AcpwCommandId(command).name
+        except ValueError:
+            name = str(command)
+        logger.debug("Received {0} payload {1}".format(name, payload.hex()))
+
+        handler = self.handlers.get(command)
+        if handler is None and command in self.byte_settings:
+            handler = self._byte_setting
+        if handler is None:
+            # peripheral requests, interlock, mode select etc. are only acknowledged
+            self.send(AcpwCommandId.ACK, receive_id=frame[3])
+            return
+        if len(payload) > 0 or command in (AcpwCommandId.START_CHARGING.value, AcpwCommandId.STOP_CHARGING.value,
+                                           AcpwCommandId.PAUSE_CHARGE.value, AcpwCommandId.RESET.value,
+                                           AcpwCommandId.REBOOT.value):
+            self.send(AcpwCommandId.ACK, receive_id=frame[3])
+        handler(frame, payload)
+
+    def _byte_setting(self, frame, payload):
+        attribute = self.byte_settings[frame[5]]
+        if len(payload) > 0:
+            setattr(self, attribute, payload[0])
+        self.send(AcpwCommandId(frame[5]), bytes([getattr(self, attribute)]))
+
+    def _start_charging(self, frame, payload):
+        if self.pilot_state in (ControlPilotStates.B1, ControlPilotStates.C1):
+            self.set_pilot_state(ControlPilotStates.B2)
+            # the simulated vehicle starts drawing current shortly after PWM is enabled
+            threading.Timer(1.0, self._vehicle_request_charge).start()
+
+    def _vehicle_request_charge(self):
+        if self.pilot_state == ControlPilotStates.B2:
+            self.set_pilot_state(ControlPilotStates.C2)
+
+    def _stop_charging(self, frame, payload):
+        if self.pilot_state in (ControlPilotStates.B2, ControlPilotStates.C1, ControlPilotStates.C2):
+            self.set_pilot_state(ControlPilotStates.B1)
+
+    def _pause_charging(self, frame, payload):
+        if self.pilot_state == ControlPilotStates.C2:
+            self.set_pilot_state(ControlPilotStates.C1)
+
+    def _set_current_limit(self, frame, payload):
+        if len(payload) > 0:
+            self.current_limit = payload[0]
+        self.send(AcpwCommandId.CURRENT_OFFERED_TO_EV, bytes([self.current_limit, 0]))
+
+    def _reboot(self, version):
+        def boot():
+            self.version = version
+            self.send_string(AcpwCommandId.VERSION, self.version)
+            self.send_pilot_state()
+        threading.Timer(1.0, boot).start()
+
+    # OTA handshake: OTA_START, then OTA_STATUS(READY, n) asks for packet n until the image is complete
+
+    def _ota_start(self, frame, payload):
+        logger.info("OTA start, payload {0}".format(payload.hex()))
+        self.ota_packets = {}
+        self.ota_active = True
+
+    def _send_ota_status(self, status=None, packet_id=None):
+        if status is None:
+            status = AcpwOtaStatus.READY if self.ota_active else AcpwOtaStatus.NOT_READY
+        if packet_id is None:
+            packet_id = len(self.ota_packets) & 0xff
+        self.send(AcpwCommandId.OTA_STATUS, bytes([status.value, packet_id]))
+
+    def _ota_data(self, frame, payload):
+        if not self.ota_active or len(payload) == 0:
+            self._send_ota_status(AcpwOtaStatus.NOT_READY, 0)
+            return
+        packet_id = payload[0]
+        self.ota_packets[packet_id] = bytes(payload[1:])
+        if len(payload) - 1 < OTA_PACKET_SIZE:
+            self.ota_active = False
+            size = sum(len(packet) for packet in self.ota_packets.values())
+            logger.info("OTA transfer complete, {0} packets {1} bytes".format(len(self.ota_packets), size))
+            self._send_ota_status(AcpwOtaStatus.TRANSFER_COMPLETE, packet_id)
+            self._reboot(self.ota_version or self.version)
+        else:
+            self._send_ota_status(AcpwOtaStatus.READY, (packet_id + 1) & 0xff)
+
+    # Meter model
+
+    def _current_ma(self):
+        if self.pilot_state == ControlPilotStates.C2:
+            return self.current_limit * 1000
+        return 0
+
+    def _phase_values(self, value):
+        if self.number_of_phase == 3:
+            return value, value, value
+        return value, 0, 0
+
+    def _update_energy(self):
+        now = time.monotonic()
+        phases = 3 if self.number_of_phase == 3 else 1
+        self.energy += self.voltage * self._current_ma() / 1000.0 * phases * (now - self.energy_time) / 3600.0
+        self.energy_time = now
+        return self.energy
+
+    def _meter_loop(self):
+        while self.running.is_set():
+            if self.pilot_state == ControlPilotStates.C2:
+                self.send_voltage()
+                self.send_current()
+                self.send_power()
+                self.send_energy()
+            time.sleep(self.meter_interval)
+
+
+def parse_pilot_script(script):
+    steps = []
+    for step in script.split(","):
+        state, _, duration = step.partition(":")
+        steps.append((ControlPilotStates[state.strip()], float(duration) if duration else None))
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated ACPW board on a pseudo terminal")
+    parser.add_argument("--link", help="create a symlink to the pty at this path")
+    parser.add_argument("--version", default="1.0.0", help="reported ACPW firmware version")
+    parser.add_argument("--serial", default="SIM0000001", help="reported ACPW serial number")
+    parser.add_argument("--ota-version", help="version reported after a completed OTA transfer")
+    parser.add_argument("--pilot-script", default="A1",
+                        help="comma separated STATE[:seconds] steps, e.g. A1:5,B1:5,C2:60,B1")
+    parser.add_argument("--meter-interval", type=float, default=0.0,
+                        help="stream meter values every N seconds while charging, 0 only answers queries")
+    parser.add_argument("--crc-error-rate", type=float, default=0.0, help="fraction of frames sent with a bad crc")
+    parser.add_argument("--partial-frame-rate", type=float, default=0.0,
+                        help="fraction of frames written in two pieces")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s - %(levelname)s-%(name)s-: %(message)s")
+
+    simulator = AcpwSimulator(args.version, args.serial, args.link, args.meter_interval,
+                              args.crc_error_rate, args.partial_frame_rate, args.ota_version)
+    simulator.start()
+    print("ACPW simulator on {0}".format(simulator.port_name), flush=True)
+    try:
+        simulator.run_pilot_script(parse_pilot_script(args.pilot_script))
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# ACPW write throughput of AcpwMessageHandler against the pty simulator, with the
+# fixed 100 ms pause after every frame the writer used to have and with batched
+# writes paced by byte time:
+#
+#   python3 acpw_throughput_benchmark.py --frames 100
+
+import argparse
+import logging
+import time
+
+from acpw_simulator import AcpwSimulator
+from agent import AcpwMessageHandler, ACPW_BAUD_RATE
+from definitions import AcpwCommandId, PeripheralRequest
+
+LEGACY_FRAME_PAUSE = 0.1  # Seconds the old writer slept after each frame
+
+
+class EventSink(object):
+    # stands in for the mediator, ACPW answers are only counted
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, message, requester, message_type):
+        self.count += 1
+
+
+def run(name, handler, simulator, frame_gap, frames, acked):
+    AcpwMessageHandler.serial_inter_frame_gap = frame_gap
+    if acked:
+        command, payload = AcpwCommandId.SET_CURRENT_LIMIT, bytearray([16])
+    else:
+        command, payload = AcpwCommandId.PERIPHERAL_REQUEST, bytearray([PeripheralRequest.STOP_BLINK_AUTH.value])
+    expected = simulator.received.get(command.value, 0) + frames
+    retransmissions = handler.get_statistics()["retransmissions"]
+
+    start = time.monotonic()
+    futures = [handler.send_to_acpw(AcpwMessageHandler.create_acpw_protocol_message(command.value, payload))
+               for _ in range(frames)]
+    for future in futures:
+        future.result(frames)  # written, or acknowledged for SET_CURRENT_LIMIT
+    while simulator.received.get(command.value, 0) < expected and time.monotonic() - start < frames:
+        time.sleep(0.001)
+    elapsed = time.monotonic() - start
+    print("{0:<8} {1:<20} {2:>8.2f} s {3:>10.1f} frames/s  retransmissions {4}".format(
+        name, command.name, elapsed, frames / elapsed,
+        handler.get_statistics()["retransmissions"] - retransmissions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ACPW write throughput benchmark")
+    parser.add_argument("--frames", type=int, default=100, help="frames sent per run")
+    parser.add_argument("--mode", choices=("legacy", "batched", "both"), default="both")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    simulator = AcpwSimulator()
+    simulator.start()
+    # AcpwMessageHandler is a singleton, both modes share it and only switch the frame gap
+    handler = AcpwMessageHandler(simulator.port_name, ACPW_BAUD_RATE)
+    handler.mediator = EventSink()
+    handler.start()
+    handler.link.wait_for_port(10)
+
+    # a non-zero gap writes one frame at a time, LEGACY_FRAME_PAUSE minus the byte time of the 10 byte
+    # frames sent here matches the old sleep
+    legacy_gap = LEGACY_FRAME_PAUSE - 10 * 10.0 / ACPW_BAUD_RATE
+    try:
+        for acked in (False, True):
+            if args.mode in ("legacy", "both"):
+                run("legacy", handler, simulator, legacy_gap, args.frames, acked)
+            if args.mode in ("batched", "both"):
+                run("batched", handler, simulator, 0.0, args.frames, acked)
+    finally:
+        simulator.stop()
+
+if __name__ == "__main__":
+    main()
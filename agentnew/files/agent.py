@@ -9,6 +9,15 @@ import queue
 import json
 import uuid
 import traceback
+import select
+import collections
+import bisect
+import mmap
+import hashlib
+import shutil
+import tempfile
+import errno
+from concurrent.futures import Future
 
 
 import gpio_controller
@@ -20,14 +29,21 @@ from logging.config import fileConfig
 from configuration_manager import ConfigurationManager, WEBCONFIG_DATABASE, \
     DEBUG, AGENT_DATABASE, VFACTORY_DATABASE
 from drive_green_manager import DriveGreenManager
+import acpw_protocol
+from acpw_protocol import AcpwFrameDecoder, AcpwEvent, PAYLOAD_SCHEMAS
 from definitions import MessageTypes, Dealer, AuthorizationStatus, \
     AuthorizationResponse, ChargePointStatus, ChargePointExtendedStatus, \
     ChargePointErrorCode, ByteIndex, AcpwCommandId, ChargePointError, \
     Requester, Mediator, ControlPilotStates, ProximityPilotStates, \
     ChargeSessionStatus, ChargePointAvailability, ChargeStationStatus, \
     Status, MeterType, OtaStatus, OtaType, AcpwOtaStatus, FirmwareUpdateStatus, \
-    PeripheralRequest, PhaseType, CurrentOfferedToEvReason
+    PeripheralRequest, PhaseType, CurrentOfferedToEvReason, AcpwCommandError, OtaCancelledError
 import sqlite3
+from database import get_database
+from configuration_cache import configuration_cache
+from session_history import ChargeSessionHistory
+from meter_history import MeterHistory
+from zmq_router import ZmqRouter
 from bluetooth_handler import BluetoothHandler
 from zipfile import ZipFile
 import sys
@@ -37,8 +53,39 @@ AUTHORIZATION_TIMEOUT = 60.0
 
 FACTORY_RESET_PIN = 117
 
+# ACPW_SERIAL_PORT can point the agent at a simulated board, see acpw_simulator.py
+ACPW_SERIAL_PORT = os.environ.get("ACPW_SERIAL_PORT", "/dev/ttyS1")
+ACPW_BAUD_RATE = 9600
+
 logger = logging.getLogger("EVC04_Agent")
 
+agent_database = get_database(AGENT_DATABASE, wal=True)
+
+
+def load_acpw_version():
+    row = agent_database.fetchone("SELECT acpwVersion FROM deviceDetails WHERE ID=1;")
+    return row[0] if row is not None else None
+
+
+def load_master_card():
+    row = agent_database.fetchone("SELECT masterCard FROM hmiDetails WHERE ID=1;")
+    return row[0] if row is not None else None
+
+
+def load_vfactory_master_card():
+    conn = sqlite3.connect(VFACTORY_DATABASE, timeout=10.0)
+    cursor = conn.cursor()
+    query = "SELECT masterRfid FROM deviceDetails WHERE id=1;"
+    cursor.execute(query)
+    master_rfid = cursor.fetchone()
+    conn.close()
+    return master_rfid[0]
+
+
+configuration_cache.register("acpwVersion", load_acpw_version)
+configuration_cache.register("masterCard", load_master_card)
+configuration_cache.register("vfactoryMasterCard", load_vfactory_master_card)
+
 
 class StreamToLogger(object):
 
@@ -173,14 +220,14 @@ class MessageMediator(Mediator):
         if value is not None:
             self.bluetooth_handler.mediator = self
 
-    def send(self, message, requester, message_type):
+    def send(self, message, requester, message_type, identity=None):
 
         if requester == self.charge_station:
             # if messageType == "zmq":
             #     self.zmqMessageHandler.sendToSocket(message)
 
             if message_type == MessageTypes.ACPW:
-                self.acpw_handler.send_to_acpw(message)
+                return self.acpw_handler.send_to_acpw(message)
             elif message_type == MessageTypes.AUTHORIZATION_RESPONSE:
                 self.zmq_message_handler.send_to_socket(message, Dealer.UI)
                 if self.drive_green_manager is not None:
@@ -235,11 +282,18 @@ class MessageMediator(Mediator):
                     self.drive_green_manager.get_message(message, message_type)
             elif message_type == MessageTypes.OCPP:
                 self.zmq_message_handler.send_to_socket(message, Dealer.OCPP)
+            elif message_type == MessageTypes.DIAGNOSTICS:
+                if identity is not None:
+                    # an answer to a request goes back to the dealer that sent it
+                    self.zmq_message_handler.send_to_identity(message, identity)
+                else:
+                    self.zmq_message_handler.send_to_socket(message, Dealer.UI)
+                    self.zmq_message_handler.send_to_socket(message, Dealer.OCPP)
             else:
                 logger.info("unhandled message type from charge station")
 
         elif requester == self.internal_meter:
-            self.acpw_handler.send_to_acpw(message)
+            return self.acpw_handler.send_to_acpw(message)
         elif requester == self.acpw_handler:
             self.charge_station.get_message(message, message_type)
             # For now just pass all the messages to the ocpp dealer.
@@ -255,12 +309,12 @@ class MessageMediator(Mediator):
             elif message_type == MessageTypes.RESERVATION_REQUEST:
                 self.zmq_message_handler.send_to_socket(message, Dealer.UI)
             elif message_type == MessageTypes.OCPP:
-                self.charge_station.get_message(message, message_type)
+                self.charge_station.get_message(message, message_type, identity)
             elif message_type == MessageTypes.EXTERNAL_METER:
                 self.zmq_message_handler.send_to_socket(message, Dealer.OCPP)
                 self.charge_station.get_message(message, message_type)
             else:
-                self.charge_station.get_message(message, message_type)
+                self.charge_station.get_message(message, message_type, identity)
                 self.zmq_message_handler.send_to_socket(message, Dealer.MODBUSTCP)
 
         elif requester == self.configuration_manager:
@@ -524,6 +578,7 @@ class DriveGreenAuthorization(Authorization):
             cursor.execute(query, (local_list, 1))
             conn.commit()
             conn.close()
+            configuration_cache.invalidate("authorizationMode")
         except:
             logger.error("local list update failure {}".format(traceback.format_exc()))
 
@@ -699,6 +754,76 @@ class AcceptAllAuthorization(Authorization):
             self.charge_point.start_charging()
 
 
+class ChargeSessionPersistence:
+    """Keeps the active charge sessions in agent.db from one shared thread.
+
+    A session row is updated only when its status or times change or its energy
+    moved by at least energy_threshold since the last write. Status changes wake
+    the thread and are committed at once, other updates go through the batched
+    commit of agent_database.
+    """
+    interval = 1.0  # Seconds between checks of the registered sessions
+    energy_threshold = 10  # Wh
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.sessions = {}  # Session uuid to [session, values last written]
+        self.statistics = {"checks": 0, "writes": 0}
+
+    def add(self, session):
+        with self.lock:
+            self.sessions[str(session.session_uuid)] = [session, self._values(session)]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._update_database, daemon=True)
+                self.thread.start()
+
+    def remove(self, session):
+        # waits for a write of the session in progress, so the final write of stop() comes last
+        with self.lock:
+            self.sessions.pop(str(session.session_uuid), None)
+
+    def notify(self):
+        self.event.set()
+
+    def get_statistics(self):
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics["sessions"] = len(self.sessions)
+            return statistics
+
+    @staticmethod
+    def _values(session):
+        return (str(session.authorization_uid), int(session.start_time), int(session.stop_time),
+                session.status.value, session.initial_energy, session.last_energy)
+
+    def _changed(self, written, values):
+        return written[:5] != values[:5] or abs(values[5] - written[5]) >= self.energy_threshold
+
+    def _update_database(self):
+        sessionQuery = "UPDATE activeChargeSession SET authorizationUid=?, " \
+                       "startTime=?, stopTime=?, status=?, initialEnergy=?, " \
+                       "lastEnergy=? WHERE sessionUuid=?;"
+        while True:
+            immediate = self.event.wait(self.interval)
+            self.event.clear()
+            with self.lock:
+                for session_uuid, item in self.sessions.items():
+                    try:
+                        values = self._values(item[0])
+                        self.statistics["checks"] += 1
+                        if self._changed(item[1], values):
+                            agent_database.execute(sessionQuery, values + (session_uuid,), commit=immediate)
+                            item[1] = values
+                            self.statistics["writes"] += 1
+                    except:
+                        logger.info("ChargeSession db update issue: {0}".format(traceback.format_exc()))
+
+
+charge_session_persistence = ChargeSessionPersistence()
+
+
 class ChargeSession:
 
     # TODO report all session changes
@@ -737,6 +862,7 @@ class ChargeSession:
     def status(self, value):
         self._status = value
         self.report_status()
+        charge_session_persistence.notify()
 
     def report_status(self):
         msg = {
@@ -753,64 +879,33 @@ class ChargeSession:
         self.charge_point.charge_station.mediator.send(msg, self.charge_point.charge_station,
                                                        MessageTypes.CHARGE_SESSION_STATUS)
 
-    def start_database_update(self):
-        databaseUpdateThread = threading.Thread(target=self._update_database, daemon=True)
-        databaseUpdateThread.start()
-
     def insert_database(self):
         try:
-            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
             sessionQuery = "INSERT INTO activeChargeSession (sessionUuid, " \
                            "authorizationUid, startTime, stopTime, status, chargePointId, initialEnergy, lastEnergy) " \
-                           "VALUES('{0}', '{1}', '{2}', '{3}', '{4}', '{5}', {6}, {7});" \
-                .format(self.session_uuid, self.authorization_uid, int(self.start_time),
-                        int(self.stop_time), self.status.value, self.charge_point.id,
-                        self.initial_energy, self.last_energy)
-
-            cursor.execute(sessionQuery)
-            conn.commit()
-            conn.close()
+                           "VALUES(?, ?, ?, ?, ?, ?, ?, ?);"
+            agent_database.execute(sessionQuery, (
+                str(self.session_uuid), str(self.authorization_uid), int(self.start_time),
+                int(self.stop_time), self.status.value, str(self.charge_point.id),
+                self.initial_energy, self.last_energy
+            ))
         except:
             logger.info("ChargeSession db update issue: {0}".format(traceback.format_exc()))
 
-    def _update_database(self):
-        while self.status != ChargeSessionStatus.STOPPED:
-            try:
-                conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                cursor = conn.cursor()
-
-                sessionQuery = "UPDATE activeChargeSession SET authorizationUid='{0}', " \
-                               "startTime='{1}', stopTime='{2}', status='{3}', initialEnergy={5}, " \
-                               "lastEnergy={6} WHERE sessionUuid='{4}';". \
-                    format(self.authorization_uid, int(self.start_time),
-                           int(self.stop_time), self.status.value, self.session_uuid,
-                           self.initial_energy, self.last_energy)
-                cursor.execute(sessionQuery)
-                conn.commit()
-                conn.close()
-            except:
-                logger.info("ChargeSession db update issue: {0}".format(traceback.format_exc()))
-            time.sleep(1)
-
     def stop_and_remove_from_database(self):
+        charge_session_persistence.remove(self)
         try:
-            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
-
-            sessionQuery = "UPDATE activeChargeSession SET authorizationUid='{0}', " \
-                           "startTime='{1}', stopTime='{2}', status='{3}' WHERE " \
-                           "sessionUuid='{4}';". \
-                format(self.authorization_uid, int(self.start_time),
-                       int(self.stop_time), self.status.value, self.session_uuid)
-            cursor.execute(sessionQuery)
-            conn.commit()
+            with agent_database.transaction() as cursor:
+                # the final values are written here, the periodic updates may have skipped small energy changes
+                sessionQuery = "UPDATE activeChargeSession SET authorizationUid=?, " \
+                               "startTime=?, stopTime=?, status=?, initialEnergy=?, lastEnergy=? WHERE sessionUuid=?;"
+                cursor.execute(sessionQuery, (
+                    str(self.authorization_uid), int(self.start_time), int(self.stop_time), self.status.value,
+                    self.initial_energy, self.last_energy, str(self.session_uuid)
+                ))
 
-            sessionQuery = "DELETE FROM activeChargeSession WHERE sessionUuid='{0}';" \
-                .format(self.session_uuid)
-            cursor.execute(sessionQuery)
-            conn.commit()
-            conn.close()
+                sessionQuery = "DELETE FROM activeChargeSession WHERE sessionUuid=?;"
+                cursor.execute(sessionQuery, (str(self.session_uuid),))
         except:
             logger.info("ChargeSession db update issue: {0}".format(traceback.format_exc()))
 
@@ -818,7 +913,7 @@ class ChargeSession:
         self.start_time = time.time()
         self.status = ChargeSessionStatus.STARTED
         self.insert_database()
-        self.start_database_update()
+        charge_session_persistence.add(self)
         self.charge_point.stop_requested = False
 
     def stop(self):
@@ -872,6 +967,7 @@ class Reservation:
         
         
 class ChargePoint:
+    database_write_window = 5.0  # Seconds changes are coalesced before they are written to agent.db
 
     def __init__(self, cp_id, charge_station=None, authorization_mode=None, voltage_p1=0, voltage_p2=0, voltage_p3=0,
                  current_p1=0, current_p2=0, current_p3=0, active_power_p1=0, active_power_p2=0, active_power_p3=0, active_energy_p1=0,
@@ -893,6 +989,7 @@ class ChargePoint:
         self._current = Current(current_p1, current_p2, current_p3)
         self._active_power = Power(active_power_p1, active_power_p2, active_power_p3)
         self._active_energy = Energy(active_energy_p1, active_energy_p2, active_energy_p3)
+        self._meter_readings = set()  # Measurements received since the last meter history sample
 
         self._control_pilot_state = control_pilot_state
         self._proximity_pilot_state = proximity_state
@@ -924,6 +1021,12 @@ class ChargePoint:
         self._current_offered_value = current_offered_value
         self._current_offered_reason = current_offered_reason
         self.eco_charge_completed = False
+
+        self.database_lock = threading.Lock()
+        self.database_flush_event = threading.Event()
+        self.database_snapshot = {}  # Column values last written to agent.db
+        self.database_update_start = time.monotonic()
+        self.database_statistics = {"checks": 0, "writes": 0, "columnsWritten": 0, "immediateCommits": 0}
         
         # self.reportInitialStatus()
         # self.__voltage = voltage or Voltage(0, 0, 0)
@@ -934,12 +1037,8 @@ class ChargePoint:
 
     def initialize(self):
         
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
         query = "SELECT * FROM chargePoints;"
-        cursor.execute(query)
-        
-        rows = cursor.fetchall()
+        rows = agent_database.fetchall(query)
         if len(rows) > 0:
             for row in rows:
                 charge_point_id, control_pilot_state, proximity_state, status, \
@@ -983,7 +1082,6 @@ class ChargePoint:
                 self._modbustcp_current = modbustcp_current
 
         else:
-            cursor = conn.cursor()
             query = "INSERT INTO chargePoints (chargePointId, controlPilotState, " \
                     "proximityPilotState, status, errorCode, vendorErrorCode, " \
                     "voltageP1, voltageP2, voltageP3, " \
@@ -993,29 +1091,21 @@ class ChargePoint:
                     "minCurrent, maxCurrent, availableCurrent, lockableCable," \
                     "reservationStatus, expiryDate, idTag, reservationId, externalCharge, currentOfferedValue, " \
                     "currentOfferedReason, proximityPilotCurrent, failsafeCurrent, failsafeTimeout, modbusTcpCurrent) " \
-                    "SELECT {cid}, {control_pilot_state}, {proximity_pilot_state}, " \
-                    "'{status}', '{error_code}', {vendor_error_code}, {voltage_p1}, " \
-                    "{voltage_p2}, {voltage_p3}, {current_p1}, {current_p2}, {current_p3}, " \
-                    "{active_power_p1}, {active_power_p2}, {active_power_p3}, {active_energy_p1}, " \
-                    "{active_energy_p2}, {active_energy_p3}, {time}, '{availability}', " \
-                    "{minimum_current}, {maximum_current}, {available_current}, {lockable_cable}, " \
-                    "'{reservation_status}', '{reservation_expiry}', '{reservation_id_tag}', " \
-                    "'{reservation_id}', {external_charge}, {current_offered_value}, {current_offered_reason}, {proximity_pilot_current}, " \
-                    "{failsafe_current}, {failsafe_timeout}, {modbustcp_current}" \
-                    " WHERE NOT EXISTS (SELECT 1 FROM chargePoints WHERE chargePointId={cid});".format(
-                        cid=self.id, control_pilot_state=self.control_pilot_state.value, proximity_pilot_state=self.proximity_pilot_state.value, status=self.status.value, error_code=self.error_code.value,
-                        vendor_error_code=self._vendor_error_code, voltage_p1=self.voltage.P1, voltage_p2=self.voltage.P2, voltage_p3=self.voltage.P3, current_p1=self.current.P1, current_p2=self.current.P2, current_p3=self.current.P3,
-                        active_power_p1=self.active_power.P1, active_power_p2=self.active_power.P2, active_power_p3=self.active_power.P3, active_energy_p1=self.active_energy.P1, active_energy_p2=self.active_energy.P2, active_energy_p3=self.active_energy.P3,
-                        time=time.time(), availability=self.availability.value, minimum_current=self.minimum_current, maximum_current=self.maximum_current, available_current=self.available_current, lockable_cable=self.lockable_cable,
-                        reservation_status=self.reservation.reservation_status.value, reservation_expiry=self.reservation.expiry_date, reservation_id_tag=self.reservation.id_tag, reservation_id=self.reservation.reservation_id,
-                        external_charge=self.external_charge, current_offered_value=self.current_offered_value, current_offered_reason=self.current_offered_reason.value, proximity_pilot_current=self.proximity_pilot_current,
-                        failsafe_current=self.failsafe_current, failsafe_timeout=self.failsafe_timeout, modbustcp_current=self.modbustcp_current
-                    )
-            cursor.execute(query)
-            conn.commit()
-            
-        conn.close()
-        
+                    "SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?" \
+                    " WHERE NOT EXISTS (SELECT 1 FROM chargePoints WHERE chargePointId=?);"
+            agent_database.execute(query, (
+                self.id, self.control_pilot_state.value, self.proximity_pilot_state.value, self.status.value,
+                self.error_code.value, self._vendor_error_code, self.voltage.P1, self.voltage.P2, self.voltage.P3,
+                self.current.P1, self.current.P2, self.current.P3,
+                self.active_power.P1, self.active_power.P2, self.active_power.P3,
+                self.active_energy.P1, self.active_energy.P2, self.active_energy.P3, time.time(),
+                self.availability.value, self.minimum_current, self.maximum_current, self.available_current,
+                self.lockable_cable, self.reservation.reservation_status.value, str(self.reservation.expiry_date),
+                str(self.reservation.id_tag), str(self.reservation.reservation_id), self.external_charge,
+                self.current_offered_value, self.current_offered_reason.value, self.proximity_pilot_current,
+                self.failsafe_current, self.failsafe_timeout, self.modbustcp_current, self.id
+            ))
+
         self.load_last_authorization_and_charge_session()
         self.query_charge_point_status_from_acpw()
         
@@ -1024,21 +1114,16 @@ class ChargePoint:
 
     def load_last_authorization_and_charge_session(self):
         try:
-            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
             query = "SELECT sessionUuid, authorizationUid, startTime, " \
-                    "stopTime, status, chargePointId, initialEnergy, lastEnergy FROM activeChargeSession WHERE chargePointId={0};". \
-                format(self.id)
-            cursor.execute(query)
-            row = cursor.fetchone()
+                    "stopTime, status, chargePointId, initialEnergy, lastEnergy FROM activeChargeSession WHERE chargePointId=?;"
+            row = agent_database.fetchone(query, (self.id,))
             if row is not None:
                 sessionUuid, authorizationUid, startTime, stopTime, status, id, initialEnergy, lastEnergy = row
                 chargeSession = ChargeSession(
                     sessionUuid, authorizationUid, self, startTime, stopTime, ChargeSessionStatus(status), initialEnergy, lastEnergy
                 )
                 self.current_charge_session = chargeSession
-
-            conn.close()
+                charge_session_persistence.add(chargeSession)
         except:
             logger.info("ChargeSession db retrieve issue: {0}".format(traceback.format_exc()))
 
@@ -1050,18 +1135,17 @@ class ChargePoint:
 
     def retrieve_last_charge_session(self):
         try:
-            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
             query = "SELECT sessionUuid, authorizationUid, startTime, " \
-                    "stopTime, status, chargePointId, initialEnergy, lastEnergy FROM activeChargeSession WHERE chargePointId={0};". \
-                format(self.id)
-            cursor.execute(query)
-            row = cursor.fetchone()
+                    "stopTime, status, chargePointId, initialEnergy, lastEnergy FROM activeChargeSession WHERE chargePointId=?;"
+            row = agent_database.fetchone(query, (self.id,))
             if row is not None:
                 sessionUuid, authorizationUid, startTime, stopTime, status, id, initialEnergy, lastEnergy = row
-                chargeSession = ChargeSession(
-                    sessionUuid, authorizationUid, self, startTime, stopTime, ChargeSessionStatus(status), initialEnergy, lastEnergy
-                )
+                # reuse the session loaded at initialize, charge_session_persistence already watches that object
+                chargeSession = self.current_charge_session
+                if chargeSession is None or str(chargeSession.session_uuid) != str(sessionUuid):
+                    chargeSession = ChargeSession(
+                        sessionUuid, authorizationUid, self, startTime, stopTime, ChargeSessionStatus(status), initialEnergy, lastEnergy
+                    )
                 sessionStillActive = False
                 if chargeSession.status == ChargeSessionStatus.STARTED:
                     if self.control_pilot_state == ControlPilotStates.C2:
@@ -1077,7 +1161,7 @@ class ChargePoint:
                     self.authorization_status = AuthorizationStatus.FINISH
                 else:
                     self.current_charge_session = chargeSession
-            conn.close()
+                    charge_session_persistence.add(chargeSession)
         except:
             logger.info("ChargeSession db retrieve issue: {0}".format(traceback.format_exc()))
 
@@ -1091,50 +1175,79 @@ class ChargePoint:
         logger.info("charge point initialized : {0}".format(msg))
         self.charge_station.mediator.send(msg, self.charge_station, MessageTypes.STATUS_NOTIFICATION)
 
+    def _database_columns(self):
+        return (
+            ("controlPilotState", self.control_pilot_state.value),
+            ("proximityPilotState", self.proximity_pilot_state.value),
+            ("status", self.status.value),
+            ("errorCode", self.error_code.value),
+            ("vendorErrorCode", str(self._vendor_error_code)),
+            ("voltageP1", self.voltage.P1), ("voltageP2", self.voltage.P2), ("voltageP3", self.voltage.P3),
+            ("currentP1", self.current.P1), ("currentP2", self.current.P2), ("currentP3", self.current.P3),
+            ("activePowerP1", self.active_power.P1), ("activePowerP2", self.active_power.P2),
+            ("activePowerP3", self.active_power.P3),
+            ("activeEnergyP1", self.active_energy.P1), ("activeEnergyP2", self.active_energy.P2),
+            ("activeEnergyP3", self.active_energy.P3),
+            ("availability", self.availability.value),
+            ("minCurrent", self.minimum_current),
+            ("maxCurrent", self.maximum_current),
+            ("availableCurrent", self.available_current),
+            ("lockableCable", self.lockable_cable),
+            ("reservationStatus", self.reservation.reservation_status.value),
+            ("expiryDate", str(self.reservation.expiry_date)),
+            ("idTag", str(self.reservation.id_tag)),
+            ("reservationId", str(self.reservation.reservation_id)),
+            ("currentOfferedValue", self.current_offered_value),
+            ("currentOfferedReason", self.current_offered_reason.value),
+            ("proximityPilotCurrent", self.proximity_pilot_current),
+            ("failsafeCurrent", self.failsafe_current),
+            ("failsafeTimeout", self.failsafe_timeout),
+            ("modbusTcpCurrent", self.modbustcp_current)
+        )
+
+    def flush_database(self):
+        """Writes pending changes now instead of at the end of the write window."""
+        self.database_flush_event.set()
+
+    def write_database_changes(self, commit=False):
+        columns = self._database_columns()
+        with self.database_lock:
+            changed = [(name, value) for name, value in columns
+                       if name not in self.database_snapshot or self.database_snapshot[name] != value]
+            self.database_statistics["checks"] += 1
+            if not changed:
+                return
+            query = "UPDATE chargePoints SET {0} WHERE chargePointId=?;".format(
+                ", ".join("{0}=?".format(name) for name, _ in changed))
+            agent_database.execute(query, [value for _, value in changed] + [self.id], commit=commit)
+            self.database_snapshot.update(changed)
+            self.database_statistics["writes"] += 1
+            self.database_statistics["columnsWritten"] += len(changed)
+            if commit:
+                self.database_statistics["immediateCommits"] += 1
+
+    def get_database_statistics(self):
+        with self.database_lock:
+            statistics = dict(self.database_statistics)
+        # column writes the former full row update every 0.5 s would have made in the same time
+        full_row_columns = int((time.monotonic() - self.database_update_start) / 0.5) * len(self._database_columns())
+        statistics["fullRowColumnsEquivalent"] = full_row_columns
+        statistics["writeAmplification"] = \
+            round(statistics["columnsWritten"] / full_row_columns, 4) if full_row_columns else 0
+        statistics["writeWindow"] = self.database_write_window
+        return statistics
+
     def update_charge_points_database(self):
+        # safety relevant transitions call flush_database() and are committed right away,
+        # everything else is coalesced and written once per window
+        self.database_update_start = time.monotonic()
         while True:
+            immediate = self.database_flush_event.wait(self.database_write_window)
+            self.database_flush_event.clear()
             try:
-                conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                cursor = conn.cursor()
-                query = "UPDATE chargePoints SET controlPilotState={control_pilot_state}, " \
-                        "proximityPilotState={proximity_pilot_state}, status='{status}', " \
-                        "errorCode='{error_code}', vendorErrorCode='{vendor_error_code}', " \
-                        "voltageP1={voltage_p1}, voltageP2={voltage_p2}, voltageP3={voltage_p3}, " \
-                        "currentP1={current_p1}, currentP2={current_p2}, currentP3={current_p3}, " \
-                        "activePowerP1={active_power_p1}, activePowerP2={active_power_p2}, activePowerP3={active_power_p3}, " \
-                        "activeEnergyP1={active_energy_p1}, activeEnergyP2={active_energy_p2}, activeEnergyP3={active_energy_p3}, " \
-                        "availability='{availability}', minCurrent={minimum_current}, maxCurrent={maximum_current}, " \
-                        "availableCurrent={available_current}, lockableCable={lockable_cable}, " \
-                        "reservationStatus='{reservation_status}', expiryDate='{expiry_date}', " \
-                        "idTag='{id_tag}', reservationId='{reservation_id}', currentOfferedValue={current_offered_value}, " \
-                        "currentOfferedReason={current_offered_reason}, proximityPilotCurrent={proximity_pilot_current}, " \
-                        "failsafeCurrent={failsafe_current}, failsafeTimeout={failsafe_timeout}, modbusTcpCurrent={modbustcp_current} " \
-                        "WHERE chargePointId={cid};".format(
-                            control_pilot_state=self.control_pilot_state.value, proximity_pilot_state=self.proximity_pilot_state.value,
-                            status=self.status.value, error_code=self.error_code.value, vendor_error_code=self._vendor_error_code, voltage_p1=self.voltage.P1,
-                            voltage_p2=self.voltage.P2, voltage_p3=self.voltage.P3, current_p1=self.current.P1, current_p2=self.current.P2, current_p3=self.current.P3,
-                            active_power_p1=self.active_power.P1, active_power_p2=self.active_power.P2, active_power_p3=self.active_power.P3, 
-                            active_energy_p1=self.active_energy.P1, active_energy_p2=self.active_energy.P2, active_energy_p3=self.active_energy.P3, availability=self.availability.value,
-                            minimum_current=self.minimum_current, maximum_current=self.maximum_current, available_current=self.available_current,lockable_cable=self.lockable_cable,
-                            reservation_status=self.reservation.reservation_status.value, expiry_date=self.reservation.expiry_date, id_tag=self.reservation.id_tag,
-                            reservation_id=self.reservation.reservation_id, current_offered_reason=self.current_offered_reason.value, current_offered_value=self.current_offered_value,
-                            proximity_pilot_current=self.proximity_pilot_current, failsafe_current=self.failsafe_current, failsafe_timeout=self.failsafe_timeout,
-                            modbustcp_current=self.modbustcp_current, cid=self.id
-                        )
-                cursor.execute(query)
-
-                # for chargeSession in self.chargeSessions:
-                if self.current_charge_session is not None:
-                    sessionQuery = "UPDATE activeChargeSession SET authorizationUid='{0}', " \
-                                   "startTime='{1}', stopTime='{2}', status='{3}' WHERE " \
-                                   "sessionUuid='{4}';"
-                    cursor.execute(sessionQuery)
-
-                conn.commit()
-                conn.close()
+                self.write_database_changes(commit=immediate)
             except:
                 logger.info("ChargePoint db update issue: {0}".format(traceback.format_exc()))
-            time.sleep(0.5)
 
     def grant_authorization(self, uid="mobileApplication"):
         self.authorization_response = AuthorizationResponse.ACCEPTED
@@ -1274,6 +1387,7 @@ class ChargePoint:
     @availability.setter
     def availability(self, value):
         self._availability = value
+        self.flush_database()
         if value == ChargePointAvailability.OPERATIVE:
             self.status = self.transient_status
             isAvailable = 1
@@ -1362,6 +1476,7 @@ class ChargePoint:
     @voltage.setter
     def voltage(self, value):
         self._voltage = value
+        self._record_meter_history("voltage")
         self.report_meter_values()
 
     @property
@@ -1371,6 +1486,7 @@ class ChargePoint:
     @current.setter
     def current(self, value):
         self._current = value
+        self._record_meter_history("current")
         self.report_meter_values()
 
     @property
@@ -1380,6 +1496,7 @@ class ChargePoint:
     @active_power.setter
     def active_power(self, value):
         self._active_power = value
+        self._record_meter_history("active_power")
         self.report_meter_values()
 
     @property
@@ -1390,8 +1507,19 @@ class ChargePoint:
     def active_energy(self, value):
         self._active_energy = value
         self.update_current_session_metric()
+        self._record_meter_history("active_energy")
         self.report_meter_values()
 
+    def _record_meter_history(self, measurement):
+        # one sample per complete reading, so all its values come from the same polling cycle or burst
+        self._meter_readings.add(measurement)
+        if len(self._meter_readings) < 4:
+            return
+        self._meter_readings.clear()
+        if self.charge_station.meter_history is not None:
+            self.charge_station.meter_history.record(self.id, self.voltage, self.current, self.active_power,
+                                                     self.active_energy)
+
     def report_meter_values(self):
         dateNow = int(time.time())  # datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         msg = {
@@ -1499,6 +1627,7 @@ class ChargePoint:
         else:
             self._error_code = ChargePointErrorCode.NO_ERROR
             self.status = self.transient_status
+        self.flush_database()
 
         logger.info("Error code {0}".format(self._error_code.value))
         msg = self._create_status_notification_message()
@@ -1535,6 +1664,7 @@ class ChargePoint:
 
         if updated_status != self.status and updated_status is not None:
             self._status = updated_status
+            self.flush_database()
             logger.info("Status notification {0}".format(self._status.value))
             msg = self._create_status_notification_message()
             logger.info(msg)
@@ -1596,8 +1726,13 @@ class ChargePoint:
 
     @control_pilot_state.setter
     def control_pilot_state(self, control_pilot_state):
+        pilot_state_changed = control_pilot_state != self._control_pilot_state
         self._control_pilot_state = control_pilot_state
         logger.info("ControlPilotState: {0}".format(control_pilot_state))
+        if pilot_state_changed:
+            self.flush_database()
+            if self.charge_station.meter is not None:
+                self.charge_station.meter.poll_now()
         if control_pilot_state == ControlPilotStates.A1:
 
             if self.current_charge_session is not None:
@@ -1817,14 +1952,15 @@ class ChargePoint:
             self.current_charge_session.stop()
             self.current_charge_session = None
         start_charging_command = StartChargingCommand(self.charge_station)
-        start_charging_command.execute()
+        self._check_acpw_command(start_charging_command.execute(), AcpwCommandId.START_CHARGING)
 
     def stop_charging(self, finish_authorization=True):
         if finish_authorization is True:
             self.authorization_status = AuthorizationStatus.FINISH
             self.stop_requested = True
         stop_charging_command = StopChargingCommand(self.charge_station)
-        stop_charging_command.execute()
+        self._check_acpw_command(stop_charging_command.execute(), AcpwCommandId.STOP_CHARGING,
+                                 retry=stop_charging_command.execute)
         if self.current_charge_session is not None:
             if self.current_charge_session.status == ChargeSessionStatus.PAUSED or \
                     self.current_charge_session.status == ChargeSessionStatus.SUSPENDED:
@@ -1888,7 +2024,30 @@ class ChargePoint:
 
     def set_ocpp_current_limit(self, payload):
         set_current_limit_command = SetOcppCurrentLimitCommand(self.charge_station, payload)
-        set_current_limit_command.execute()
+        self._check_acpw_command(set_current_limit_command.execute(), AcpwCommandId.SET_CURRENT_LIMIT,
+                                 retry=set_current_limit_command.execute)
+
+    def _check_acpw_command(self, future, command_id, retry=None):
+        if future is not None:
+            future.add_done_callback(lambda done: self._acpw_command_done(done, command_id, retry))
+
+    def _acpw_command_done(self, future, command_id, retry):
+        try:
+            future.result()
+            return
+        except AcpwCommandError as e:
+            error = e
+        logger.info("Charge point {0} {1} failed: {2}".format(self.id, command_id.name, error))
+        msg = {"type": "acpwCommandFailure",
+               "data": {"connectorId": self.id, "command": command_id.name, "reason": str(error),
+                        "retried": retry is not None}}
+        self.send_to_mediator(json.dumps(msg), MessageTypes.DIAGNOSTICS)
+        # stop and current limit are idempotent and sent once more, the result of the retry is only watched
+        if retry is not None:
+            self._check_acpw_command(retry(), command_id)
+        # ACPW may or may not have acted on the command, the state machine follows what it reports now
+        self.query_status(AcpwCommandId.PILOT_STATE)
+        self.query_status(AcpwCommandId.FAULTS)
 
     def authorization_start_indicators(self):
         authorization_start_indicator = AuthorizationStartIndicatorCommand(self.charge_station)
@@ -1969,11 +2128,20 @@ class OtaManager:
 
     ACPW_UPDATE_TIMEOUT = 60 * 60  # One hour
     ACPW_UPDATE_MAX_RETRY = 5
+    ACPW_OTA_PACKET_SIZE = 512
+    # OTA_DATA packets sent ahead of the one the bootloader asks for, 1 waits for each OTA_STATUS
+    ACPW_OTA_WINDOW = 1
+    ACPW_OTA_PROGRESS_INTERVAL = 5  # Seconds between progress reports
     ACPW_OTA_FILE_PATH = "/usr/lib/vestel/acpw_update.bin"
     OSTREE_COMMIT_FILE = "/var/lib/vestel/update/commitID.txt"
     FIRMWARE_OTA_FILE = "/var/lib/vestel/update/update.bin"
     IS_OTA_DEPLOYED = "/var/lib/vestel/isOtaDeployed.txt"
     OTA_CERT_PATH = "/usr/lib/vestel/otaCert.crt"
+    OTA_VERIFY_CHUNK_SIZE = 64 * 1024
+    OTA_EXTRACT_PATH = "/var/lib/vestel/"
+    OTA_EXTRACT_CHUNK_SIZE = 64 * 1024
+    OTA_EXTRACT_SPACE_MARGIN = 4 * 1024 * 1024  # Bytes kept free on the data partition
+    OTA_EXTRACT_PROGRESS_INTERVAL = 5  # Seconds between progress reports
 
     def __init__(self, charge_station):
         self.charge_station = charge_station
@@ -1986,10 +2154,17 @@ class OtaManager:
         self.acpw_ota_status = None
         self.ota_type = None
         self.acpw_ota_file = None
+        self.acpw_ota_mmap = None
+        self.acpw_ota_frame_builder = acpw_protocol.FrameBuilder(1 + OtaManager.ACPW_OTA_PACKET_SIZE)
         self.ota_message_queue = queue.Queue()
         self.status_message_event = threading.Event()
         self.acpw_ota_progress_event = threading.Event()
+        self.ota_cancel_event = threading.Event()
         self.acpw_retry_count = 0
+        self.acpw_ota_requested = 0
+        self.acpw_ota_next = 0
+        self.acpw_ota_start_time = None
+        self.acpw_ota_progress_time = 0
         self.target_acpw_version = ""
         self.expire_mutex = threading.Lock()
         self.expire_event = threading.Event()
@@ -2060,6 +2235,7 @@ class OtaManager:
                     start_blink_firmware.execute()
                     self.acpw_retry_count += 1
                     logger.info("ACPW Retry: %s" % self.acpw_retry_count)
+                    self._reset_acpw_ota_transfer()
 
                     ota_start = OtaCommand(self.charge_station, AcpwCommandId.OTA_START, bytearray([2]))
                     ota_start.execute()
@@ -2075,21 +2251,50 @@ class OtaManager:
                     logger.info("ACPW update failed after %s retry" % self.acpw_retry_count)
 
     def verify_ota_file(self, location):
-        from OpenSSL import crypto
+        from cryptography import x509
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec, padding, utils
         try:
-            f = open(location, "br")
-            buffer = f.read()
-            f.close()
-            sig_size = buffer[-1]
-            sig = buffer[(-1 - sig_size):-1]
-            ota_bin = buffer[:(-1 - sig_size)]
-            f = open(OtaManager.OTA_CERT_PATH)
-            ss_buf = f.read()
-            f.close()
-            ss_cert = crypto.load_certificate(crypto.FILETYPE_PEM, ss_buf.encode())
-            crypto.verify(ss_cert, sig, ota_bin, 'sha256')
+            verify_start = time.monotonic()
+            # file layout: body, signature, one byte signature size
+            with open(location, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                sig_size = f.read(1)[0]
+                body_size = f.tell() - 1 - sig_size
+                if body_size < 0:
+                    raise ValueError("signature size {0} exceeds file".format(sig_size))
+                f.seek(body_size)
+                sig = f.read(sig_size)
+
+                # hash the body in chunks so it is never held in memory as a whole
+                digest = hashlib.sha256()
+                chunk = memoryview(bytearray(OtaManager.OTA_VERIFY_CHUNK_SIZE))
+                f.seek(0)
+                remaining = body_size
+                while remaining > 0:
+                    read_size = f.readinto(chunk[:min(remaining, len(chunk))])
+                    if not read_size:
+                        raise ValueError("OTA file truncated")
+                    digest.update(chunk[:read_size])
+                    remaining -= read_size
+
+            with open(OtaManager.OTA_CERT_PATH, "rb") as f:
+                ss_cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+            public_key = ss_cert.public_key()
+            prehashed = utils.Prehashed(hashes.SHA256())
+            if isinstance(public_key, ec.EllipticCurvePublicKey):
+                public_key.verify(sig, digest.digest(), ec.ECDSA(prehashed))
+            else:
+                public_key.verify(sig, digest.digest(), padding.PKCS1v15(), prehashed)
+
+            elapsed = time.monotonic() - verify_start
+            logger.info("OTA file verified, {0} bytes in {1:.2f} s ({2:.1f} MB/s)".format(
+                body_size, elapsed, body_size / elapsed / 1e6 if elapsed > 0 else 0))
             return True
-        except crypto.Error:
+        except (InvalidSignature, ValueError):
+            logger.info("OTA file signature check failed {0}".format(traceback.format_exc()))
             return False
 
     def get_ota_message(self, message):
@@ -2097,10 +2302,11 @@ class OtaManager:
 
     def ota_status_message_handler(self):
         while not self.acpw_ota_progress_event.isSet():
-            if not self.ota_message_queue.empty():
-                messageTuple = self.ota_message_queue.get()
-                self._check_ota_status_message(messageTuple)
-            time.sleep(0.2)
+            try:
+                messageTuple = self.ota_message_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            self._check_ota_status_message(messageTuple)
 
     def _check_ota_status_message(self, message):
         self.status_message_event.set()
@@ -2114,11 +2320,9 @@ class OtaManager:
                 cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.OTA_STATUS.value, bytearray([]))
                 self.charge_station.mediator.send(cmd, self.charge_station, MessageTypes.ACPW)
             elif status == AcpwOtaStatus.READY.value:
-                dataPacket = [packetId] + self.acpw_ota_file[packetId * 512:(packetId + 1) * 512]
-                cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.OTA_DATA.value, dataPacket)
-                self.charge_station.mediator.send(cmd, self.charge_station, MessageTypes.ACPW)
-                logger.info("Send OTA_DATA to ACPW id: %s" % packetId)
+                self._send_acpw_ota_packets(packetId)
             elif status == AcpwOtaStatus.TRANSFER_COMPLETE.value:
+                self._report_acpw_ota_progress(self._acpw_ota_packet_count(), force=True)
                 logger.info("ACPW update file has sent succesfully! ACPW will be updated!")
             else:
                 logger.info("Received undefined ota status msg: %s" % status)
@@ -2126,6 +2330,61 @@ class OtaManager:
         else:
             logger.info("Received ota status msg from ACPW, but ota session is over!")
 
+    def _reset_acpw_ota_transfer(self):
+        self.acpw_ota_requested = 0
+        self.acpw_ota_next = 0
+        self.acpw_ota_start_time = time.monotonic()
+        self.acpw_ota_progress_time = 0
+
+    def _close_acpw_ota_file(self):
+        try:
+            self.acpw_ota_file.release()
+            self.acpw_ota_mmap.close()
+        except:
+            logger.info("Cannot close ACPW update file {0}".format(traceback.format_exc()))
+        self.acpw_ota_file = None
+        self.acpw_ota_mmap = None
+
+    def _acpw_ota_packet_count(self):
+        # the last packet is always shorter than a full one, it may be empty, and marks the end of the image
+        return len(self.acpw_ota_file) // OtaManager.ACPW_OTA_PACKET_SIZE + 1
+
+    def _send_acpw_ota_packets(self, packet_id):
+        # packet ids are a single byte on the wire, unwrap them around the last requested packet
+        delta = ((packet_id - self.acpw_ota_requested + 128) & 0xff) - 128
+        requested = max(self.acpw_ota_requested + delta, 0)
+        if requested <= self.acpw_ota_requested:
+            # first request, or the bootloader asks again for a packet it has not taken
+            first = requested
+        else:
+            first = max(requested, self.acpw_ota_next)
+        last = min(requested + OtaManager.ACPW_OTA_WINDOW, self._acpw_ota_packet_count())
+        self.acpw_ota_requested = requested
+
+        for index in range(first, last):
+            offset = index * OtaManager.ACPW_OTA_PACKET_SIZE
+            cmd = self.acpw_ota_frame_builder.build(
+                AcpwMessageHandler.generate_message_id(), AcpwCommandId.OTA_DATA.value,
+                (bytes((index & 0xff,)), self.acpw_ota_file[offset:offset + OtaManager.ACPW_OTA_PACKET_SIZE])
+            )
+            self.charge_station.mediator.send(cmd, self.charge_station, MessageTypes.ACPW)
+            logger.info("Send OTA_DATA to ACPW id: %s" % index)
+        self.acpw_ota_next = max(self.acpw_ota_next, last)
+        self._report_acpw_ota_progress(requested)
+
+    def _report_acpw_ota_progress(self, packets_taken, force=False):
+        now = time.monotonic()
+        if not force and now - self.acpw_ota_progress_time < OtaManager.ACPW_OTA_PROGRESS_INTERVAL:
+            return
+        self.acpw_ota_progress_time = now
+        total = len(self.acpw_ota_file)
+        transferred = min(packets_taken * OtaManager.ACPW_OTA_PACKET_SIZE, total)
+        elapsed = now - (self.acpw_ota_start_time or now)
+        self.charge_station.report_firmware_progress(
+            int(transferred * 100 / total) if total else 100,
+            int(transferred / elapsed) if elapsed > 0 else 0
+        )
+
     def start_ota(self, ota_type, ota_params=None):
 
         if self.ota_status != None:
@@ -2133,13 +2392,26 @@ class OtaManager:
             return
 
         self.ota_type = ota_type
+        self.ota_status = OtaStatus.PREPARING
+        self.ota_cancel_event.clear()
+        # verification and extraction of a large package must not hold up the caller's message loop
+        self.update_thread = threading.Thread(target=self._prepare_ota, args=(ota_params,), daemon=True)
+        self.update_thread.start()
+
+    def _prepare_ota(self, ota_params):
         file_location = ota_params['data']['location']
 
-        if self.verify_ota_file(file_location):
+        try:
+            verified = self.verify_ota_file(file_location)
+        except:
+            logger.info("OTA file cannot be read {0}".format(traceback.format_exc()))
+            self._ota_fail_actions()
+            return
+
+        if verified:
             logger.info("OTA file verification succeeded")
-            now = datetime.datetime.now()
-            retrieve_date = now
-            
+            retrieve_date = datetime.datetime.now()
+
             try:
                 retrieve_date = ota_params['data']['retrieveDate']
                 retrieve_date = retrieve_date.split("+")[0]
@@ -2149,21 +2421,27 @@ class OtaManager:
             except:
                 logger.info("Ota retrieve date parse error {0}".format(traceback.format_exc()))
 
-            delta_t = retrieve_date - now
-            secs = delta_t.total_seconds()
-            if secs < 0:
-                secs = 0
-
             try:
-                # TODO remove old extract folder if any
-                with ZipFile(file_location, 'r') as zip_ref:
-                    zip_ref.extractall('/var/lib/vestel/')
-                    zip_ref.close()
+                self._extract_ota_package(file_location)
+            except OtaCancelledError:
+                logger.info("OTA package extraction cancelled")
+                self._ota_fail_actions()
+                return
             except FileNotFoundError:
                 logger.info("File not found: " + file_location)
                 self._ota_fail_actions()
                 return
+            except:
+                logger.info("OTA package extraction failed {0}".format(traceback.format_exc()))
+                self._ota_fail_actions()
+                return
 
+            delta_t = retrieve_date - datetime.datetime.now()
+            secs = delta_t.total_seconds()
+            if secs < 0:
+                secs = 0
+
+            self.ota_status = None
             logger.info("Ready to start ota")
             logger.info('remaining secs to OTA: %.2f' % secs)
             threading.Timer(secs, self._start_ostree_ota).start()
@@ -2173,6 +2451,79 @@ class OtaManager:
             self._ota_fail_actions()
             os.remove(file_location)
 
+    def _extract_ota_package(self, file_location):
+        # extract next to the destination so the result can be renamed into place, nothing of a
+        # failed extraction is left behind and an earlier extract stays until the new one is complete
+        extract_dir = tempfile.mkdtemp(prefix=".ota_extract_", dir=OtaManager.OTA_EXTRACT_PATH)
+        try:
+            with ZipFile(file_location, 'r') as zip_ref:
+                members = zip_ref.infolist()
+                total_size = sum(member.file_size for member in members)
+                fs_stat = os.statvfs(OtaManager.OTA_EXTRACT_PATH)
+                free_space = fs_stat.f_bavail * fs_stat.f_frsize
+                if total_size + OtaManager.OTA_EXTRACT_SPACE_MARGIN > free_space:
+                    raise OSError(errno.ENOSPC, "OTA package needs {0} bytes, {1} free".format(
+                        total_size, free_space))
+
+                logger.info("Extracting {0} bytes from {1}".format(total_size, file_location))
+                chunk = memoryview(bytearray(OtaManager.OTA_EXTRACT_CHUNK_SIZE))
+                extracted_size = 0
+                start_time = time.monotonic()
+                progress_time = start_time
+                self.charge_station.report_firmware_progress(0, 0, "extracting")
+                for member in members:
+                    target = self._ota_member_path(extract_dir, member.filename)
+                    if member.filename.endswith("/"):
+                        os.makedirs(target, exist_ok=True)
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with zip_ref.open(member) as source, open(target, "wb") as destination:
+                        while True:
+                            # a cancelled extraction leaves through the finally below like a failed one
+                            if self.ota_cancel_event.is_set():
+                                raise OtaCancelledError(file_location)
+                            read_size = source.readinto(chunk)
+                            if not read_size:
+                                break
+                            destination.write(chunk[:read_size])
+                            extracted_size += read_size
+                            now = time.monotonic()
+                            if now - progress_time >= OtaManager.OTA_EXTRACT_PROGRESS_INTERVAL:
+                                progress_time = now
+                                self.charge_station.report_firmware_progress(
+                                    extracted_size * 100 // total_size,
+                                    int(extracted_size / (now - start_time)), "extracting")
+
+            for name in os.listdir(extract_dir):
+                destination = os.path.join(OtaManager.OTA_EXTRACT_PATH, name)
+                if os.path.isdir(destination) and not os.path.islink(destination):
+                    shutil.rmtree(destination)
+                elif os.path.lexists(destination):
+                    os.remove(destination)
+                os.rename(os.path.join(extract_dir, name), destination)
+            elapsed = time.monotonic() - start_time
+            self.charge_station.report_firmware_progress(
+                100, int(extracted_size / elapsed) if elapsed > 0 else 0, "extracting")
+            logger.info("OTA package extracted")
+        finally:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
+    def cancel_ota(self):
+        """Cancels an OTA package that is still being verified or extracted."""
+        if self.ota_status != OtaStatus.PREPARING:
+            logger.info("No OTA package is being prepared, nothing to cancel")
+            return False
+        logger.info("OTA cancel requested")
+        self.ota_cancel_event.set()
+        return True
+
+    @staticmethod
+    def _ota_member_path(extract_dir, name):
+        target = os.path.realpath(os.path.join(extract_dir, name))
+        if not target.startswith(os.path.realpath(extract_dir) + os.sep):
+            raise ValueError("OTA package member outside extract folder: {0}".format(name))
+        return target
+
     def _ota_fail_actions(self):
         self.charge_station.firmware_status = FirmwareUpdateStatus.INSTALLATION_FAILED
         stop_blink_firmware = PeripheralCommand(
@@ -2233,16 +2584,14 @@ class OtaManager:
         self.acpw_ota_progress_event.clear()
         acpw_version = ''
 
+        # the image is paged in from flash as packets are sent instead of being read into memory
         with open(OtaManager.ACPW_OTA_FILE_PATH, "rb") as acpw_ota_bin:
-            acpw_ota_hex = list(acpw_ota_bin.read())
+            self.acpw_ota_mmap = mmap.mmap(acpw_ota_bin.fileno(), 0, access=mmap.ACCESS_READ)
         logger.info("ACPW update file is read!")
 
-        version_size = 0
-        while acpw_ota_hex[version_size] != 0:
-            self.target_acpw_version += chr(acpw_ota_hex[version_size])
-            version_size += 1
-
-        self.acpw_ota_file = acpw_ota_hex[version_size + 1:]
+        version_size = self.acpw_ota_mmap.find(b"\0")
+        self.target_acpw_version = self.acpw_ota_mmap[:version_size].decode("latin-1")
+        self.acpw_ota_file = memoryview(self.acpw_ota_mmap)[version_size + 1:]
         current_acpw_version = ChargeStation.read_acpw_version()
         if current_acpw_version == self.target_acpw_version:
             logger.info("No need to ACPW update version: {}".format(current_acpw_version))
@@ -2257,6 +2606,7 @@ class OtaManager:
             logger.info("ACPW updating from v%s to v%s" % (current_acpw_version, self.target_acpw_version))
             # acpwUpdateOngoing = 1
             self.ota_status = OtaStatus.ACPW  # ACPW update in progress
+            self._reset_acpw_ota_transfer()
             ota_start = OtaCommand(self.charge_station, AcpwCommandId.OTA_START, bytearray([2]))
             ota_start.execute()
 
@@ -2301,6 +2651,7 @@ class OtaManager:
         self.expire_event.set()
 
         self.ota_status = None
+        self._close_acpw_ota_file()
         
         if self.acpw_ota_status == AcpwOtaStatus.FINISHED_SUCCESS.value:
             logger.info("ACPW updated succesfully!")
@@ -2355,6 +2706,8 @@ class ChargeStation(Requester):
         self.configuration_manager = None
         self.meter = None
         self.drive_green_manager = None
+        self.session_history = None
+        self.meter_history = None
         self.zmq_message_handler = None
         self.acpw_handler = None
         self.rfid_reader = None
@@ -2433,6 +2786,19 @@ class ChargeStation(Requester):
             else:
                 self.status = ChargeStationStatus.NORMAL
 
+    def report_firmware_progress(self, progress, throughput, stage=None):
+        msg = {
+            "type": "FirmwareUpdateStatus",
+            "status": FirmwareUpdateStatus.INSTALLING.value,
+            "progress": progress,
+            "throughput": throughput
+        }
+        if stage is not None:
+            msg["stage"] = stage
+        msg = json.dumps(msg)
+        logger.info(msg)
+        self.mediator.send(msg, self, MessageTypes.FIRMWARE_UPDATE_STATUS)
+
     @property
     def power_optimizer(self):
         return self._power_optimizer
@@ -2511,15 +2877,10 @@ class ChargeStation(Requester):
                 if self.charge_points[1].authorization_status == AuthorizationStatus.FINISH:
                     self.charge_points[1].interlock_control(False)
 
-            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
-            query = "UPDATE chargeStation SET delayChargeStatus='{}', " \
-                    "delayChargeStart={}, delayChargeTime={} WHERE ID=1;" \
-                .format(self.delay_charge_status.value, self.delay_charge_start_time,
-                        self.delay_charge_time)
-            cursor.execute(query)
-            conn.commit()
-            conn.close()
+            query = "UPDATE chargeStation SET delayChargeStatus=?, " \
+                    "delayChargeStart=?, delayChargeTime=? WHERE ID=1;"
+            agent_database.execute(query, (self.delay_charge_status.value, self.delay_charge_start_time,
+                                           self.delay_charge_time))
 
             msg = self._create_delay_charge_status_message()
             logger.info(msg)
@@ -2581,15 +2942,10 @@ class ChargeStation(Requester):
                     self, AcpwCommandId.PERIPHERAL_REQUEST, PeripheralRequest.STOP_BLINK_ECO)
                 stop_blink_eco.execute()
 
-            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
-            query = "UPDATE chargeStation SET ecoChargeStatus='{}', " \
-                    "ecoChargeStart='{}', ecoChargeStop='{}' WHERE ID=1;" \
-                .format(self.eco_charge_status.value,
-                        self.eco_charge_start_time, self.eco_charge_stop_time)
-            cursor.execute(query)
-            conn.commit()
-            conn.close()
+            query = "UPDATE chargeStation SET ecoChargeStatus=?, " \
+                    "ecoChargeStart=?, ecoChargeStop=? WHERE ID=1;"
+            agent_database.execute(query, (self.eco_charge_status.value,
+                                           str(self.eco_charge_start_time), str(self.eco_charge_stop_time)))
 
             msg = {
                 "type": "EcoChargeNotification",
@@ -2636,6 +2992,10 @@ class ChargeStation(Requester):
         self.message_parser_thread.start()
         self.configuration_manager = ConfigurationManager()
         self.configuration_manager.initialize_configurations()
+        self.session_history = ChargeSessionHistory(agent_database)
+        self.session_history.start()
+        self.meter_history = MeterHistory(agent_database)
+        self.meter_history.start()
         self.acpw_handler = AcpwMessageHandler()
 
         get_peripheral_data()
@@ -2836,12 +3196,8 @@ class ChargeStation(Requester):
         self.query_charge_station_status_from_acpw()
         
     def load_eco_delay_charge(self):
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
         query = "SELECT * FROM chargeStation;"
-        cursor.execute(query)
-        row = cursor.fetchone()
-        conn.close()
+        row = agent_database.fetchone(query)
         if row is not None:
             ID, eco_charge_status, eco_charge_start, eco_charge_stop, delay_charge_status, delay_charge_start, \
                 delay_charge_time, power_optimizer_min, power_optimizer_max, power_optimizer, phase_type = row
@@ -2903,13 +3259,8 @@ class ChargeStation(Requester):
                 self.meter = InternalMeter()
 
     def is_configured(self):
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
         query = "SELECT configured FROM hmiDetails;"
-        cursor.execute(query)
-        configured = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        configured = agent_database.fetchone(query)
         if configured is not None:
             return configured[0] == 1
         return False
@@ -2922,13 +3273,7 @@ class ChargeStation(Requester):
         authorization = None
         if row is None:
             try:
-                conn = sqlite3.connect(WEBCONFIG_DATABASE, timeout=10.0)
-                cursor = conn.cursor()
-                query = "SELECT id, mode, localList FROM authorizationMode;"
-                cursor.execute(query)
-                row = cursor.fetchone()
-                cursor.close()
-                conn.close()
+                row = configuration_cache.get("authorizationMode")
             except:
                 pass
          
@@ -3000,8 +3345,8 @@ class ChargeStation(Requester):
         mid_error_command = HmiErrorCommand(self, self._mid_error | self._rfid_error)
         mid_error_command.execute()
 
-    def get_message(self, message, messageType):
-        self.message_queue.put({"message": message, "messageType": messageType})
+    def get_message(self, message, messageType, identity=None):
+        self.message_queue.put({"message": message, "messageType": messageType, "identity": identity})
 
     def add_or_remove_user_card(self, uid):
         if self.charge_points[1].authorization_mode.contains_uid_inset(uid):
@@ -3027,13 +3372,7 @@ class ChargeStation(Requester):
 
     def is_master_rfid(self, uid):
         if isinstance(cs.charge_points[1].authorization_mode, DriveGreenAuthorization):
-            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
-            query = "SELECT masterCard FROM hmiDetails WHERE ID=1;"
-            cursor.execute(query)
-            master_rfid = cursor.fetchone()
-            conn.close()
-            master_rfid = master_rfid[0]
+            master_rfid = configuration_cache.get("masterCard")
             if master_rfid is not None and master_rfid != "":
                 if uid == master_rfid:
                     return True
@@ -3048,22 +3387,10 @@ class ChargeStation(Requester):
 
     def load_master_card(self):
         if os.path.exists(VFACTORY_DATABASE):
-            conn = sqlite3.connect(VFACTORY_DATABASE, timeout=10.0)
-            cursor = conn.cursor()
-            query = "SELECT masterRfid FROM deviceDetails WHERE id=1;"
-            cursor.execute(query)
-            master_rfid = cursor.fetchone()
-            conn.close()
-            self.master_rfid_vfactory = master_rfid[0]
+            self.master_rfid_vfactory = configuration_cache.get("vfactoryMasterCard")
 
     def has_master_rfid(self):
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
-        query = "SELECT masterCard FROM hmiDetails WHERE ID=1;"
-        cursor.execute(query)
-        master_rfid_agent = cursor.fetchone()
-        conn.close()
-        master_rfid_agent = master_rfid_agent[0]
+        master_rfid_agent = configuration_cache.get("masterCard")
         if master_rfid_agent is not None and master_rfid_agent != "":
             logger.info("master rfid is defined")
             return True
@@ -3110,12 +3437,8 @@ class ChargeStation(Requester):
             self.mediator.bluetooth_handler.stop()
 
     def finish_master_configuration(self):
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
         query = "UPDATE hmiDetails SET configured=1 WHERE ID=1;"
-        cursor.execute(query)
-        conn.commit()
-        conn.close()
+        agent_database.execute(query)
         # self.status = ChargeStationStatus.NORMAL
 
     def delete_old_master_configuration(self):
@@ -3126,13 +3449,11 @@ class ChargeStation(Requester):
         cursor.execute(query)
         conn.commit()
         conn.close()
+        configuration_cache.invalidate("authorizationMode")
 
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
         query = "UPDATE hmiDetails SET configured=0, masterCard=NULL WHERE ID=1;"
-        cursor.execute(query)
-        conn.commit()
-        conn.close()
+        agent_database.execute(query)
+        configuration_cache.set("masterCard", None)
 
         self.load_authorization()
 
@@ -3219,12 +3540,9 @@ class ChargeStation(Requester):
                 # authorization_start_indicator = AuthorizationStartIndicatorCommand(self)
                 # authorization_start_indicator.execute()
                 self.wait_for_master_addition_event.set()
-                conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                cursor = conn.cursor()
-                query = "UPDATE hmiDetails SET masterCard='{}' WHERE ID=1;".format(card_uid)
-                cursor.execute(query)
-                conn.commit()
-                conn.close()
+                query = "UPDATE hmiDetails SET masterCard=? WHERE ID=1;"
+                agent_database.execute(query, (str(card_uid),))
+                configuration_cache.set("masterCard", str(card_uid))
                 master_set_beep = GenericCommand(
                     self, AcpwCommandId.PERIPHERAL_REQUEST, PeripheralRequest.MASTER_SET_BEEP)
                 master_set_beep.execute()
@@ -3267,436 +3585,459 @@ class ChargeStation(Requester):
         else:
             logger.info("Unidentified rfid message")
 
+    def _dispatch_acpw_event(self, event):
+        # Frequent ACPW events go straight to the charge point setters, the rest take the generic path
+        charge_point = self.charge_points[1]
+        event_type = event.event_type
+        if event_type == "voltageEvent":
+            charge_point.voltage = Voltage(event.P1, event.P2, event.P3)
+        elif event_type == "currentEvent":
+            charge_point.current = Current(event.P1, event.P2, event.P3)
+        elif event_type == "activePowerEvent":
+            charge_point.active_power = Power(event.P1, event.P2, event.P3)
+        elif event_type == "totalEnergyEvent":
+            charge_point.active_energy = Energy(event.P1, event.P2, event.P3)
+        elif event_type == "pilotState":
+            charge_point.control_pilot_state = ControlPilotStates(event.value)
+        elif event_type == "faultState":
+            charge_point.error_code = event.value
+        elif event_type == "proximityState":
+            charge_point.proximity_pilot_state = ProximityPilotStates(event.value)
+        else:
+            return False
+        return True
+
     def _parse_message(self):
 
         while True:
-            if not self.message_queue.empty():
-                try:
-                    messageDict = self.message_queue.get()
-                    message = messageDict["message"]
-                    message_type = messageDict["messageType"]
+            try:
+                messageDict = self.message_queue.get()
+                message = messageDict["message"]
+                message_type = messageDict["messageType"]
+                identity = messageDict.get("identity")
+                if isinstance(message, AcpwEvent):
+                    if self._dispatch_acpw_event(message):
+                        continue
+                    json_object = message.as_dict()
+                else:
                     json_object = json.loads(message)
-                    charge_point_id = 1  # TODO right now we only have one charge point, should check chargePoint id in the future.
-                    if message_type == MessageTypes.ACPW \
-                            or message_type == MessageTypes.EXTERNAL_METER:
-                        json_type = json_object['type']
-                        if json_type == "voltageEvent":
-                            self.charge_points[charge_point_id].voltage = \
-                                Voltage(json_object['data']['P1'],
-                                        json_object['data']['P2'],
-                                        json_object['data']['P3'])
-
-                        elif json_type == "currentEvent":
-                            self.charge_points[charge_point_id].current = \
-                                Current(json_object['data']['P1'],
-                                        json_object['data']['P2'],
-                                        json_object['data']['P3'])
-
-                        elif json_type == "activePowerEvent":
-                            self.charge_points[charge_point_id].active_power = \
-                                Power(json_object['data']['P1'],
-                                      json_object['data']['P2'],
-                                      json_object['data']['P3'])
-
-                        elif json_type == "totalEnergyEvent":
-                            self.charge_points[charge_point_id].active_energy = \
-                                Energy(json_object['data']['P1'],
-                                       json_object['data']['P2'],
-                                       json_object['data']['P3'])
-
-                        elif json_type == "midConnection":
-                            logger.info("MID connection status changed: %s" % json_object['data'])
-                            if json_object['data'] == "ConnectionLost":
-                                # New error value for mid_error is 2 (00000010)
-                                self.mid_error = {"value": 2, "message": message}
-                            else:
-                                self.mid_error = {"value": 0, "message": message}
-
-                        elif json_type == "pilotState":
-                            self.charge_points[charge_point_id].control_pilot_state = ControlPilotStates(
-                                json_object['data']['value'])
-
-                        elif json_type == "faultState":
-                            self.charge_points[charge_point_id].error_code = json_object['data']['value']
-
-                        elif json_type == "proximityState":
-                            self.charge_points[charge_point_id].proximity_pilot_state = ProximityPilotStates(
-                                json_object['data']['value'])
-
-                        elif json_type == "maximumCurrent":
-                            self.charge_points[charge_point_id].maximum_current = json_object['data']['value']
-
-                        elif json_type == "otaStatus":
-                            if self.ota_manager is not None:
-                                self.ota_manager.get_ota_message(
-                                    (json_object['data']['value'], json_object['data']['packetId'])
-                                )
-
-                        elif json_type == "acpwVersion":
-                            if self.ota_manager is not None:
-                                self.acpw_version = json_object['data']['value']
-
-                                if os.path.exists(AGENT_DATABASE):
-                                    connection = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                                    if connection:
-                                        cursor = connection.cursor()
-                                        query = "INSERT OR IGNORE INTO deviceDetails(ID, acpwVersion) " \
-                                                "VALUES(1, '{0}');".format(self.acpw_version)
-                                        cursor.execute(query)
-                                        query = "UPDATE deviceDetails SET acpwVersion='{}' WHERE ID=1;".format(
-                                            self.acpw_version)
-                                        cursor.execute(query)
-                                        logger.info("ACPW version is updated in db")
-                                        connection.commit()
-                                        connection.close()
-                                    else:
-                                        logger.info("Database connection is failed! for acpw version update")
-
-                                self.ota_manager.get_acpw_version_message(self.acpw_version)
-                                
-                        elif json_type == "minCurrent":
-                            self.charge_points[charge_point_id].minimum_current = json_object['data']['value']
+                charge_point_id = 1  # TODO right now we only have one charge point, should check chargePoint id in the future.
+                if message_type == MessageTypes.ACPW \
+                        or message_type == MessageTypes.EXTERNAL_METER:
+                    json_type = json_object['type']
+                    if json_type == "voltageEvent":
+                        self.charge_points[charge_point_id].voltage = \
+                            Voltage(json_object['data']['P1'],
+                                    json_object['data']['P2'],
+                                    json_object['data']['P3'])
+
+                    elif json_type == "currentEvent":
+                        self.charge_points[charge_point_id].current = \
+                            Current(json_object['data']['P1'],
+                                    json_object['data']['P2'],
+                                    json_object['data']['P3'])
+
+                    elif json_type == "activePowerEvent":
+                        self.charge_points[charge_point_id].active_power = \
+                            Power(json_object['data']['P1'],
+                                  json_object['data']['P2'],
+                                  json_object['data']['P3'])
+
+                    elif json_type == "totalEnergyEvent":
+                        self.charge_points[charge_point_id].active_energy = \
+                            Energy(json_object['data']['P1'],
+                                   json_object['data']['P2'],
+                                   json_object['data']['P3'])
+
+                    elif json_type == "midConnection":
+                        logger.info("MID connection status changed: %s" % json_object['data'])
+                        if json_object['data'] == "ConnectionLost":
+                            # New error value for mid_error is 2 (00000010)
+                            self.mid_error = {"value": 2, "message": message}
+                        else:
+                            self.mid_error = {"value": 0, "message": message}
 
-                        elif json_type == "proximityPilotCurrent":
-                            self.charge_points[charge_point_id].proximity_pilot_current = json_object['data']['value']
+                    elif json_type == "pilotState":
+                        self.charge_points[charge_point_id].control_pilot_state = ControlPilotStates(
+                            json_object['data']['value'])
 
-                        elif json_type == "modbusTcpCurrent":
-                            self.charge_points[charge_point_id].modbustcp_current = json_object['data']['value']
+                    elif json_type == "faultState":
+                        self.charge_points[charge_point_id].error_code = json_object['data']['value']
 
-                        elif json_type == "availableCurrent":
-                            self.charge_points[charge_point_id].available_current = json_object['data']['value']
-                                
-                        elif json_type == "serialNumber":
-                            self.serial_number = json_object['data']['value']
+                    elif json_type == "proximityState":
+                        self.charge_points[charge_point_id].proximity_pilot_state = ProximityPilotStates(
+                            json_object['data']['value'])
+
+                    elif json_type == "maximumCurrent":
+                        self.charge_points[charge_point_id].maximum_current = json_object['data']['value']
+
+                    elif json_type == "otaStatus":
+                        if self.ota_manager is not None:
+                            self.ota_manager.get_ota_message(
+                                (json_object['data']['value'], json_object['data']['packetId'])
+                            )
+
+                    elif json_type == "acpwVersion":
+                        if self.ota_manager is not None:
+                            self.acpw_version = json_object['data']['value']
 
                             if os.path.exists(AGENT_DATABASE):
-                                connection = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                                if connection:
-                                    cursor = connection.cursor()
-                                    query = "INSERT OR IGNORE INTO deviceDetails(ID, acpwSerialNumber) " \
-                                            "VALUES(1, '{0}');".format(self.serial_number)
-                                    cursor.execute(query)
-                                    query = "UPDATE deviceDetails SET acpwSerialNumber='{0}' WHERE ID=1;".format(
-                                        self.serial_number)
-                                    cursor.execute(query)
-                                    logger.info("Serial number is updated in db")
-                                    connection.commit()
-                                    connection.close()
-                                else:
-                                    logger.info("Database connection is failed for serial number update!")
-                        
-                        elif json_type == "lockableCable":
-                            self.charge_points[charge_point_id].lockable_cable = json_object['data']['value']
+                                with agent_database.transaction() as cursor:
+                                    query = "INSERT OR IGNORE INTO deviceDetails(ID, acpwVersion) VALUES(1, ?);"
+                                    cursor.execute(query, (str(self.acpw_version),))
+                                    query = "UPDATE deviceDetails SET acpwVersion=? WHERE ID=1;"
+                                    cursor.execute(query, (str(self.acpw_version),))
+                                configuration_cache.set("acpwVersion", str(self.acpw_version))
+                                logger.info("ACPW version is updated in db")
+
+                            self.ota_manager.get_acpw_version_message(self.acpw_version)
                             
-                        elif json_type == "powerOptimizerLimits":
-                            self.power_optimizer_min = json_object['data']['min']
-                            self.power_optimizer_max = json_object['data']['max']
-
-                            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                            cursor = conn.cursor()
-                            query = "UPDATE chargeStation SET powerOptimizerMin={0}, powerOptimizerMax={1} WHERE ID=1;".format(
-                                self.power_optimizer_min, self.power_optimizer_max)
-                            cursor.execute(query)
-                            conn.commit()
-                            conn.close()
-
-                        elif json_type == "phaseType":
-                            self.phase_type = PhaseType(json_object['data']['value'])
-
-                            self.number_of_phases = True
-                            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                            cursor = conn.cursor()
-                            query = "UPDATE chargeStation SET phaseType={0} WHERE ID=1;".format(self.phase_type.value)
-                            cursor.execute(query)
-                            conn.commit()
-                            conn.close()
-
-                            # if self.dlm_message_handler is not None:
-                            #     if self.number_of_phases == True and self.dlm_info == True:
-                            #         msg = {
-                            #             "type": "dlmSlaveParametersRequest"
-                            #         }
-                            #         msg = json.dumps(msg)
-                            #         self.mediator.send(msg, self, MessageTypes.DLM_SLAVE_PARAMETERS_REQUEST)
-
-                        elif json_type == "powerOptimizer":
-                            self.power_optimizer = json_object['data']['value']
+                    elif json_type == "minCurrent":
+                        self.charge_points[charge_point_id].minimum_current = json_object['data']['value']
+
+                    elif json_type == "proximityPilotCurrent":
+                        self.charge_points[charge_point_id].proximity_pilot_current = json_object['data']['value']
+
+                    elif json_type == "modbusTcpCurrent":
+                        self.charge_points[charge_point_id].modbustcp_current = json_object['data']['value']
+
+                    elif json_type == "availableCurrent":
+                        self.charge_points[charge_point_id].available_current = json_object['data']['value']
                             
-                            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                            cursor = conn.cursor()
-                            query = "UPDATE chargeStation SET powerOptimizer={0} WHERE ID=1;".format(
-                                self.power_optimizer)
-                            cursor.execute(query)
-                            conn.commit()
-                            conn.close()
-
-                        elif json_type == "currentOfferedEv":
-                            self.charge_points[charge_point_id].current_offered_value = json_object['data']['value'][
-                                'current']
-                            self.charge_points[charge_point_id].current_offered_reason = CurrentOfferedToEvReason(
-                                json_object['data']['value'][
-                                    'reason'])
+                    elif json_type == "serialNumber":
+                        self.serial_number = json_object['data']['value']
+
+                        if os.path.exists(AGENT_DATABASE):
+                            with agent_database.transaction() as cursor:
+                                query = "INSERT OR IGNORE INTO deviceDetails(ID, acpwSerialNumber) VALUES(1, ?);"
+                                cursor.execute(query, (str(self.serial_number),))
+                                query = "UPDATE deviceDetails SET acpwSerialNumber=? WHERE ID=1;"
+                                cursor.execute(query, (str(self.serial_number),))
+                            logger.info("Serial number is updated in db")
+                    
+                    elif json_type == "lockableCable":
+                        self.charge_points[charge_point_id].lockable_cable = json_object['data']['value']
                         
-                        elif json_type == "externalCharge":
-                            self.charge_points[charge_point_id].external_charge = json_object['data']['value']
+                    elif json_type == "powerOptimizerLimits":
+                        self.power_optimizer_min = json_object['data']['min']
+                        self.power_optimizer_max = json_object['data']['max']
+
+                        query = "UPDATE chargeStation SET powerOptimizerMin=?, powerOptimizerMax=? WHERE ID=1;"
+                        agent_database.execute(query, (self.power_optimizer_min, self.power_optimizer_max))
+
+                    elif json_type == "phaseType":
+                        self.phase_type = PhaseType(json_object['data']['value'])
+
+                        self.number_of_phases = True
+                        query = "UPDATE chargeStation SET phaseType=? WHERE ID=1;"
+                        agent_database.execute(query, (self.phase_type.value,))
+
+                        # if self.dlm_message_handler is not None:
+                        #     if self.number_of_phases == True and self.dlm_info == True:
+                        #         msg = {
+                        #             "type": "dlmSlaveParametersRequest"
+                        #         }
+                        #         msg = json.dumps(msg)
+                        #         self.mediator.send(msg, self, MessageTypes.DLM_SLAVE_PARAMETERS_REQUEST)
+
+                    elif json_type == "powerOptimizer":
+                        self.power_optimizer = json_object['data']['value']
+                        
+                        query = "UPDATE chargeStation SET powerOptimizer=? WHERE ID=1;"
+                        agent_database.execute(query, (self.power_optimizer,))
+
+                    elif json_type == "currentOfferedEv":
+                        self.charge_points[charge_point_id].current_offered_value = json_object['data']['value'][
+                            'current']
+                        self.charge_points[charge_point_id].current_offered_reason = CurrentOfferedToEvReason(
+                            json_object['data']['value'][
+                                'reason'])
+                    
+                    elif json_type == "externalCharge":
+                        self.charge_points[charge_point_id].external_charge = json_object['data']['value']
+
+                elif message_type == MessageTypes.AVAILABLE_CURRENT:
+                    value = json_object['data']['value']
+                    app_current_limit_command = SetAppCurrentLimitCommand(self, value)
+                    app_current_limit_command.execute()
+
+                elif message_type == MessageTypes.LOCKABLE_CABLE:
+                    value = json_object['data']['value']
+                    lockable_cable_command = SetLockableCableCommand(self, value)
+                    lockable_cable_command.execute()
+                    
+                elif message_type == MessageTypes.POWER_OPTIMIZER:
+                    value = json_object['data']['value']
+                    power_optimizer_command = SetPowerOptimizerCommand(self, value)
+                    power_optimizer_command.execute()
+
+                elif message_type == MessageTypes.BLUETOOTH_STATUS:
+                    if json_object['status'] == "Connected":
+                        self.bt_connected = True
+                    elif json_object['status'] == "Disconnected":
+                        self.bt_connected = False
+
+                elif message_type == MessageTypes.REGISTRATION_FAIL:
+                    if json_object['status'] != "NoInternetConnection":
+                        self.stop_master_configuration()
+                        if self.is_configured():
+                            self.status = ChargeStationStatus.NORMAL
+                        else:
+                            self.status = ChargeStationStatus.ONBOARDING
 
-                    elif message_type == MessageTypes.AVAILABLE_CURRENT:
-                        value = json_object['data']['value']
-                        app_current_limit_command = SetAppCurrentLimitCommand(self, value)
-                        app_current_limit_command.execute()
+                else:
+                    json_type = json_object['type']
+                    if json_type == "command":
+                        cmd_id = json_object["data"]["commandId"]
+                        cmd_id = AcpwCommandId(cmd_id)
+                        payload = json_object["data"]["payload"]
+
+                        if cmd_id == AcpwCommandId.PILOT_STATE:
+                            self.charge_points[charge_point_id].query_status(cmd_id)
+
+                        elif cmd_id == AcpwCommandId.VOLTAGE:
+                            pass
+                        elif cmd_id == AcpwCommandId.CURRENT:
+                            pass
+                        elif cmd_id == AcpwCommandId.ENERGY:
+                            pass
+                        elif cmd_id == AcpwCommandId.POWER:
+                            pass
+                        elif cmd_id == AcpwCommandId.START_CHARGING:
+                            logger.info("Authorize received")
+                            self.charge_points[charge_point_id].authorize()
+
+                        elif cmd_id == AcpwCommandId.STOP_CHARGING:
+                            logger.info("STOP_CHARGING ")
+                            self.charge_points[charge_point_id].authorize()
+
+                        elif cmd_id == AcpwCommandId.SET_CURRENT_LIMIT:
+                            self.charge_points[charge_point_id].set_ocpp_current_limit(payload)
+
+                        elif cmd_id == AcpwCommandId.UNLOCK:
+                            pass
+                        elif cmd_id == AcpwCommandId.PAUSE_CHARGE:
+                            self.charge_points[charge_point_id].pause_charging()
+
+                        elif cmd_id == AcpwCommandId.FAULTS:
+                            self.charge_points[charge_point_id].query_status(cmd_id)
+
+                        elif cmd_id == AcpwCommandId.LOG_DUMP:
+                            pass
+                        elif cmd_id == AcpwCommandId.TEMPERATURE:
+                            pass
+                        elif cmd_id == AcpwCommandId.OTA_START:
+                            pass
+                        elif cmd_id == AcpwCommandId.OTA_DATA:
+                            pass
+                        elif cmd_id == AcpwCommandId.PERIPHERAL_REQUEST:
+                            pass
+                        elif cmd_id == AcpwCommandId.PROXIMITY_STATE:
+                            self.charge_points[charge_point_id].query_status(cmd_id)
+
+                        elif cmd_id == AcpwCommandId.MODE_SELECT:
+                            pass
+                        elif cmd_id == AcpwCommandId.HMI_BOARD_ERR:
+                            pass
+                        elif cmd_id == AcpwCommandId.REBOOT:
+                            pass
+                        elif cmd_id == AcpwCommandId.MAX_CURRENT:
+                            self.charge_points[charge_point_id].query_status(cmd_id)
+                        elif cmd_id == AcpwCommandId.NUMBER_OF_PHASE:
+                            self.charge_points[charge_point_id].query_status(cmd_id)
 
-                    elif message_type == MessageTypes.LOCKABLE_CABLE:
-                        value = json_object['data']['value']
-                        lockable_cable_command = SetLockableCableCommand(self, value)
-                        lockable_cable_command.execute()
-                        
-                    elif message_type == MessageTypes.POWER_OPTIMIZER:
-                        value = json_object['data']['value']
-                        power_optimizer_command = SetPowerOptimizerCommand(self, value)
-                        power_optimizer_command.execute()
-
-                    elif message_type == MessageTypes.BLUETOOTH_STATUS:
-                        if json_object['status'] == "Connected":
-                            self.bt_connected = True
-                        elif json_object['status'] == "Disconnected":
-                            self.bt_connected = False
-
-                    elif message_type == MessageTypes.REGISTRATION_FAIL:
-                        if json_object['status'] != "NoInternetConnection":
-                            self.stop_master_configuration()
-                            if self.is_configured():
-                                self.status = ChargeStationStatus.NORMAL
-                            else:
-                                self.status = ChargeStationStatus.ONBOARDING
+                        else:
+                            # TODO send unknown command back as response.
+                            pass
+                    elif json_type == "AuthorizationResponse":
+                        self.charge_points[charge_point_id].authorization_mode.receive_authorization_response(
+                            AuthorizationResponse(json_object["idTagInfo"]["status"]), json_object["idTagInfo"]["idTag"])
+
+                    elif json_type == "ReserveNow":
+                        connector_id = int(json_object["connectorId"])
+                        if connector_id in self.charge_points.keys():
+                            self.mediator.send(message, self.zmq_message_handler, MessageTypes.RESERVATION_REQUEST)
+                            self.charge_points[connector_id].make_reservation(json_object["expiryDate"],
+                                                                              json_object["idTag"],
+                                                                              json_object["reservationId"])
+                        else:
+                            logger.info("no such a chargepoint for reservation {}".format(connector_id))
+
+                    elif json_type == "CancelReservation":
+                        reservation_id = json_object["reservationId"]
+                        for charge_point in self.charge_points.values():
+                            if charge_point.reservation.reservation_status == Status.ENABLED:
+                                self.mediator.send(message, self.zmq_message_handler,
+                                                   MessageTypes.RESERVATION_REQUEST)
+                                charge_point.cancel_reservation(reservation_id)
+
+                    elif json_type == "ocppOffline":
+                        self.is_ocpp_offline_enabled = json_object["status"]
+                        if self.is_ocpp_offline_enabled and self.status == ChargeStationStatus.WAITING_FOR_CONNECTION:
+                            self.status = ChargeStationStatus.NORMAL
+                        elif not self.is_ocpp_offline_enabled and not self.ocpp_connected and self.initialized:
+                            self.status = ChargeStationStatus.WAITING_FOR_CONNECTION
 
-                    else:
-                        json_type = json_object['type']
-                        if json_type == "command":
-                            cmd_id = json_object["data"]["commandId"]
-                            cmd_id = AcpwCommandId(cmd_id)
-                            payload = json_object["data"]["payload"]
-
-                            if cmd_id == AcpwCommandId.PILOT_STATE:
-                                self.charge_points[charge_point_id].query_status(cmd_id)
-
-                            elif cmd_id == AcpwCommandId.VOLTAGE:
-                                pass
-                            elif cmd_id == AcpwCommandId.CURRENT:
-                                pass
-                            elif cmd_id == AcpwCommandId.ENERGY:
-                                pass
-                            elif cmd_id == AcpwCommandId.POWER:
-                                pass
-                            elif cmd_id == AcpwCommandId.START_CHARGING:
-                                logger.info("Authorize received")
-                                self.charge_points[charge_point_id].authorize()
-
-                            elif cmd_id == AcpwCommandId.STOP_CHARGING:
-                                logger.info("STOP_CHARGING ")
-                                self.charge_points[charge_point_id].authorize()
-
-                            elif cmd_id == AcpwCommandId.SET_CURRENT_LIMIT:
-                                self.charge_points[charge_point_id].set_ocpp_current_limit(payload)
-
-                            elif cmd_id == AcpwCommandId.UNLOCK:
-                                pass
-                            elif cmd_id == AcpwCommandId.PAUSE_CHARGE:
-                                self.charge_points[charge_point_id].pause_charging()
-
-                            elif cmd_id == AcpwCommandId.FAULTS:
-                                self.charge_points[charge_point_id].query_status(cmd_id)
-
-                            elif cmd_id == AcpwCommandId.LOG_DUMP:
-                                pass
-                            elif cmd_id == AcpwCommandId.TEMPERATURE:
-                                pass
-                            elif cmd_id == AcpwCommandId.OTA_START:
-                                pass
-                            elif cmd_id == AcpwCommandId.OTA_DATA:
-                                pass
-                            elif cmd_id == AcpwCommandId.PERIPHERAL_REQUEST:
-                                pass
-                            elif cmd_id == AcpwCommandId.PROXIMITY_STATE:
-                                self.charge_points[charge_point_id].query_status(cmd_id)
-
-                            elif cmd_id == AcpwCommandId.MODE_SELECT:
-                                pass
-                            elif cmd_id == AcpwCommandId.HMI_BOARD_ERR:
-                                pass
-                            elif cmd_id == AcpwCommandId.REBOOT:
-                                pass
-                            elif cmd_id == AcpwCommandId.MAX_CURRENT:
-                                self.charge_points[charge_point_id].query_status(cmd_id)
-                            elif cmd_id == AcpwCommandId.NUMBER_OF_PHASE:
-                                self.charge_points[charge_point_id].query_status(cmd_id)
+                    elif json_type == "UnlockConnector":
+                        connector_id = json_object["connectorId"]
+                        if connector_id in self.charge_points:
+                            self.charge_points[connector_id].stop_charging()
 
-                            else:
-                                # TODO send unknown command back as response.
-                                pass
-                        elif json_type == "AuthorizationResponse":
-                            self.charge_points[charge_point_id].authorization_mode.receive_authorization_response(
-                                AuthorizationResponse(json_object["idTagInfo"]["status"]), json_object["idTagInfo"]["idTag"])
-
-                        elif json_type == "ReserveNow":
-                            connector_id = int(json_object["connectorId"])
-                            if connector_id in self.charge_points.keys():
-                                self.mediator.send(message, self.zmq_message_handler, MessageTypes.RESERVATION_REQUEST)
-                                self.charge_points[connector_id].make_reservation(json_object["expiryDate"],
-                                                                                  json_object["idTag"],
-                                                                                  json_object["reservationId"])
-                            else:
-                                logger.info("no such a chargepoint for reservation {}".format(connector_id))
+                    elif json_type == "ChangeAvailability":
+                        connector_id = int(json_object["connectorId"])
+                        self.charge_points[connector_id].availability = ChargePointAvailability(
+                            json_object["status"])
 
-                        elif json_type == "CancelReservation":
-                            reservation_id = json_object["reservationId"]
+                    elif json_type == "GeneralStatus":
+                        if self.charge_points is not None:
                             for charge_point in self.charge_points.values():
-                                if charge_point.reservation.reservation_status == Status.ENABLED:
-                                    self.mediator.send(message, self.zmq_message_handler,
-                                                       MessageTypes.RESERVATION_REQUEST)
-                                    charge_point.cancel_reservation(reservation_id)
-
-                        elif json_type == "ocppOffline":
-                            self.is_ocpp_offline_enabled = json_object["status"]
-                            if self.is_ocpp_offline_enabled and self.status == ChargeStationStatus.WAITING_FOR_CONNECTION:
-                                self.status = ChargeStationStatus.NORMAL
-                            elif not self.is_ocpp_offline_enabled and not self.ocpp_connected and self.initialized:
-                                self.status = ChargeStationStatus.WAITING_FOR_CONNECTION
-
-                        elif json_type == "UnlockConnector":
-                            connector_id = json_object["connectorId"]
-                            if connector_id in self.charge_points:
-                                self.charge_points[connector_id].stop_charging()
-
-                        elif json_type == "ChangeAvailability":
-                            connector_id = int(json_object["connectorId"])
-                            self.charge_points[connector_id].availability = ChargePointAvailability(
-                                json_object["status"])
-
-                        elif json_type == "GeneralStatus":
-                            if self.charge_points is not None:
-                                for charge_point in self.charge_points.values():
-                                    self.report_status()
-                                    charge_point.report_status()
-                                    
-                        elif json_type == "agentCommand":
-                            cmd = json_object["data"]["command"]
-                            if cmd == "factoryReset":
-                                self.reset_factory_settings()
-                            elif cmd == "hardReset":
-                                self.reset_hard()
-                            elif cmd == "softReset":
-                                self.reset_soft()
-                            elif cmd == "firmwareUpdate":
-                                self.update_firmware(json_object)
-                            else:
-                                logger.info("undefined agent command")
+                                self.report_status()
+                                charge_point.report_status()
                                 
-                        elif json_type == "configurationComplete":
-                            self.stop_master_configuration()
-                            self.finish_master_configuration()
-                            self.status = ChargeStationStatus.NORMAL
-                            
-                        elif json_type == "ecoCharge":
-                            logger.info(json_object)
-                            status = json_object["status"]
-                            start_time = 0
-                            stop_time = 0
-                            if status == "Enabled":
-                                start_time = json_object["startTime"]
-                                stop_time = json_object["stopTime"]
-                            self.update_eco_charge(status, start_time, stop_time)
-
-                        elif json_type == "delayCharge":
-                            status = json_object["status"]
-                            delay_time = 0
-                            if status == "Enabled":
-                                delay_time = json_object["delayTime"]
-                            self.update_delay_charge(status, delay_time)
-
-                        elif json_type == "firmwareUpdate":
-                            self.ota_manager.start_ota(OtaType.OCPP, json_object)
+                    elif json_type == "agentCommand":
+                        cmd = json_object["data"]["command"]
+                        if cmd == "factoryReset":
+                            self.reset_factory_settings()
+                        elif cmd == "hardReset":
+                            self.reset_hard()
+                        elif cmd == "softReset":
+                            self.reset_soft()
+                        elif cmd == "firmwareUpdate":
+                            self.update_firmware(json_object)
+                        elif cmd == "cancelFirmwareUpdate":
+                            self.ota_manager.cancel_ota()
+                        elif cmd == "acpwLinkStatistics":
+                            msg = {"type": "acpwLinkStatistics", "data": self.acpw_handler.get_statistics()}
+                            self.mediator.send(json.dumps(msg), self, MessageTypes.DIAGNOSTICS)
+                        elif cmd == "zmqRouterStatistics":
+                            msg = {"type": "zmqRouterStatistics", "data": self.zmq_message_handler.get_statistics()}
+                            self.mediator.send(json.dumps(msg), self, MessageTypes.DIAGNOSTICS)
+                        elif cmd == "databaseStatistics":
+                            msg = {"type": "databaseStatistics", "data": {
+                                "agentDatabase": agent_database.get_statistics(),
+                                "chargeSessions": charge_session_persistence.get_statistics(),
+                                "meterHistory": self.meter_history.get_statistics(),
+                                "configurationCache": configuration_cache.get_statistics(),
+                                "chargePoints": {str(cp_id): charge_point.get_database_statistics()
+                                                 for cp_id, charge_point in self.charge_points.items()}
+                            }}
+                            self.mediator.send(json.dumps(msg), self, MessageTypes.DIAGNOSTICS)
+                        else:
+                            logger.info("undefined agent command")
                             
-                        elif json_type == "acpwVersionRequest":
-                            msg = {'type': "acpwVersionResponse", 'value': ""}
-                            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                            cursor = conn.cursor()
-                            query = "SELECT acpwVersion FROM deviceDetails WHERE ID=1 "
-                            cursor.execute(query)
-                            records = cursor.fetchone()
-                            conn.close()
-                            if records is not None and records[0] is not None:
-                                msg['value'] = records[0]
-                                msg = json.dumps(msg)
-                                logger.info(msg)
-                                self.mediator.send(msg, self, MessageTypes.OCPP)
-                                
-                        elif json_type == "serialRequest":
-                            msg = {'type': "serialResponse", 'value': ""}
-                            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                            cursor = conn.cursor()
-                            query = "SELECT acpwSerialNumber FROM deviceDetails WHERE ID=1 "
-                            cursor.execute(query)
-                            records = cursor.fetchone()
-                            conn.close()
-                            if records is not None and records[0] is not None:
-                                msg['value'] = records[0]
-                                msg = json.dumps(msg)
-                                logger.info(msg)
-                                self.mediator.send(msg, self, MessageTypes.OCPP)
-                                
-                        elif json_type == "cellularRequest":
-                            msg = {'type': "cellularResponse", 'value': {}}
-                            msg['value']['IMEI'] = ""
-                            msg['value']['IMSI'] = ""
-                            msg['value']['ICCID'] = ""
-                            conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                            cursor = conn.cursor()
-                            query = "SELECT imei ,imsi ,iccid FROM hmiDetails WHERE ID=1 "
-                            cursor.execute(query)
-                            records = cursor.fetchone()
-                            conn.close()
-                            if records is not None and records[0] is not None and records[1] is not None and records[2] is not None:
-                                msg['value']['IMEI'] = records[0]
-                                msg['value']['IMSI'] = records[1]
-                                msg['value']['ICCID'] = records[2]
-                                msg = json.dumps(msg)
-                                logger.info(msg)
-                                self.mediator.send(msg, self, MessageTypes.OCPP)
-                                
-                        elif json_type == "ocppConnected":
-                            self.ocpp_connected = True
-                            if self.initialized and self.status == ChargeStationStatus.WAITING_FOR_CONNECTION:
-                                self.status = ChargeStationStatus.NORMAL
-                        elif json_type == "ocppDisconnected":
-                            self.ocpp_connected = False
-                            if self.initialized and not self.is_ocpp_offline_enabled and self.status == ChargeStationStatus.NORMAL:
-                                self.status = ChargeStationStatus.WAITING_FOR_CONNECTION
-
-                            if self.configuration_manager.is_cellular_enabled():
-                                self.configuration_manager.reset_quectel_modem()
-
-                        elif json_type == "failsafeCurrent":
-                            self.charge_points[charge_point_id].failsafe_current = json_object['data']['value']
-
-                        elif json_type == "failsafeTimeout":
-                            self.charge_points[charge_point_id].failsafe_timeout = json_object['data']['value']
-
-                        elif json_type == "modbusTcpCurrent":
-                            value = json_object['data']['value']
-                            modbustcp_current_command = SetModbusTcpCurrentCommand(self, value)
-                            modbustcp_current_command.execute()
+                    elif json_type == "configurationComplete":
+                        self.stop_master_configuration()
+                        self.finish_master_configuration()
+                        self.status = ChargeStationStatus.NORMAL
                         
-                        else:
-                            logger.info("Unknown request")
+                    elif json_type == "ecoCharge":
+                        logger.info(json_object)
+                        status = json_object["status"]
+                        start_time = 0
+                        stop_time = 0
+                        if status == "Enabled":
+                            start_time = json_object["startTime"]
+                            stop_time = json_object["stopTime"]
+                        self.update_eco_charge(status, start_time, stop_time)
+
+                    elif json_type == "delayCharge":
+                        status = json_object["status"]
+                        delay_time = 0
+                        if status == "Enabled":
+                            delay_time = json_object["delayTime"]
+                        self.update_delay_charge(status, delay_time)
+
+                    elif json_type == "firmwareUpdate":
+                        self.ota_manager.start_ota(OtaType.OCPP, json_object)
+                        
+                    elif json_type == "acpwVersionRequest":
+                        msg = {'type': "acpwVersionResponse", 'value': ""}
+                        acpw_version = configuration_cache.get("acpwVersion")
+                        if acpw_version is not None:
+                            msg['value'] = acpw_version
+                            msg = json.dumps(msg)
+                            logger.info(msg)
+                            self.mediator.send(msg, self, MessageTypes.OCPP)
+                            
+                    elif json_type == "serialRequest":
+                        msg = {'type': "serialResponse", 'value': ""}
+                        query = "SELECT acpwSerialNumber FROM deviceDetails WHERE ID=1 "
+                        records = agent_database.fetchone(query)
+                        if records is not None and records[0] is not None:
+                            msg['value'] = records[0]
+                            msg = json.dumps(msg)
+                            logger.info(msg)
+                            self.mediator.send(msg, self, MessageTypes.OCPP)
+                            
+                    elif json_type == "cellularRequest":
+                        msg = {'type': "cellularResponse", 'value': {}}
+                        msg['value']['IMEI'] = ""
+                        msg['value']['IMSI'] = ""
+                        msg['value']['ICCID'] = ""
+                        query = "SELECT imei ,imsi ,iccid FROM hmiDetails WHERE ID=1 "
+                        records = agent_database.fetchone(query)
+                        if records is not None and records[0] is not None and records[1] is not None and records[2] is not None:
+                            msg['value']['IMEI'] = records[0]
+                            msg['value']['IMSI'] = records[1]
+                            msg['value']['ICCID'] = records[2]
+                            msg = json.dumps(msg)
+                            logger.info(msg)
+                            self.mediator.send(msg, self, MessageTypes.OCPP)
+
+                    elif json_type == "chargeSessionHistoryRequest":
+                        data = json_object.get("data", {})
+                        msg = {"type": "chargeSessionHistoryResponse", "requestId": data.get("requestId")}
+                        try:
+                            msg["data"] = self.session_history.query(
+                                data.get("startTime"), data.get("stopTime"), data.get("idTag"),
+                                data.get("cursor"), data.get("limit"))
+                        except (sqlite3.Error, ValueError, TypeError, IndexError) as e:
+                            msg["error"] = str(e)
+                        self.mediator.send(json.dumps(msg), self, MessageTypes.DIAGNOSTICS, identity)
+
+                    elif json_type == "meterHistoryRequest":
+                        data = json_object.get("data", {})
+                        msg = {"type": "meterHistoryResponse", "requestId": data.get("requestId")}
+                        try:
+                            msg["data"] = self.meter_history.query(
+                                data.get("chargePointId", 1), data["startTime"], data.get("stopTime", time.time()),
+                                data.get("resolution", 0), data.get("limit"))
+                        except (sqlite3.Error, KeyError, ValueError, TypeError) as e:
+                            msg["error"] = str(e)
+                        self.mediator.send(json.dumps(msg), self, MessageTypes.DIAGNOSTICS, identity)
+                            
+                    elif json_type == "ocppConnected":
+                        self.ocpp_connected = True
+                        if self.initialized and self.status == ChargeStationStatus.WAITING_FOR_CONNECTION:
+                            self.status = ChargeStationStatus.NORMAL
+                    elif json_type == "ocppDisconnected":
+                        self.ocpp_connected = False
+                        if self.initialized and not self.is_ocpp_offline_enabled and self.status == ChargeStationStatus.NORMAL:
+                            self.status = ChargeStationStatus.WAITING_FOR_CONNECTION
 
-                        # if cmd is not None:
-                        #     self.mediator.send(cmd, self, "acpw")
-                    # elif (jsonObject["type"] == "rfidAuthentication"):
-                    #     sendToDealers(msg)
-                except:
-                    logger.info("Malformed message: {0}".format(traceback.format_exc()))
+                        if self.configuration_manager.is_cellular_enabled():
+                            self.configuration_manager.reset_quectel_modem()
 
-            time.sleep(0.1)
+                    elif json_type == "failsafeCurrent":
+                        self.charge_points[charge_point_id].failsafe_current = json_object['data']['value']
+
+                    elif json_type == "failsafeTimeout":
+                        self.charge_points[charge_point_id].failsafe_timeout = json_object['data']['value']
+
+                    elif json_type == "modbusTcpCurrent":
+                        value = json_object['data']['value']
+                        modbustcp_current_command = SetModbusTcpCurrentCommand(self, value)
+                        modbustcp_current_command.execute()
+                    
+                    else:
+                        logger.info("Unknown request")
+
+                    # if cmd is not None:
+                    #     self.mediator.send(cmd, self, "acpw")
+                # elif (jsonObject["type"] == "rfidAuthentication"):
+                #     sendToDealers(msg)
+            except:
+                logger.info("Malformed message: {0}".format(traceback.format_exc()))
 
     def update_eco_charge(self, status, start_time, stop_time):
 
@@ -3881,17 +4222,7 @@ class ChargeStation(Requester):
     def read_acpw_version():
         acpw_version = ''
         if os.path.exists(AGENT_DATABASE):
-            connection = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            if connection:
-                cursor = connection.cursor()
-                query = "SELECT acpwVersion FROM deviceDetails WHERE ID=1;"
-                cursor.execute(query)
-                acpw_version = cursor.fetchone()
-                if acpw_version is not None:
-                    acpw_version = acpw_version[0]
-            else:
-                logger.info("Database connection is failed!")
-            connection.close()
+            acpw_version = configuration_cache.get("acpwVersion")
         else:
             logger.info("Database file is not exists!")
         return acpw_version
@@ -3912,6 +4243,7 @@ class Command(ABC):
 
     @abstractmethod
     def execute(self):
+        """Returns the Future of the frame sent, failed with AcpwCommandError if ACPW never acknowledges it."""
         pass
 
 
@@ -3922,7 +4254,7 @@ class StartChargingCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.START_CHARGING.value, bytearray([]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class StopChargingCommand(Command):
@@ -3932,7 +4264,7 @@ class StopChargingCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.STOP_CHARGING.value, bytearray([]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class PauseChargingCommand(Command):
@@ -3942,7 +4274,7 @@ class PauseChargingCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.PAUSE_CHARGE.value, bytearray([]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class OtaCommand(Command):
@@ -3954,7 +4286,7 @@ class OtaCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(self.ota_command.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class AuthorizationStartIndicatorCommand(Command):
@@ -3971,7 +4303,7 @@ class AuthorizationStartIndicatorCommand(Command):
         # Beep
         cmd = AcpwMessageHandler.create_acpw_protocol_message(
             AcpwCommandId.PERIPHERAL_REQUEST.value, bytearray([PeripheralRequest.THREE_BEEP.value]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class AuthorizationStopIndicatorCommand(Command):
@@ -3983,7 +4315,7 @@ class AuthorizationStopIndicatorCommand(Command):
         # Stop blinking for authorization
         cmd = AcpwMessageHandler.create_acpw_protocol_message(
             AcpwCommandId.PERIPHERAL_REQUEST.value, bytearray([PeripheralRequest.STOP_BLINK_AUTH.value]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class AuthorizationFailIndicatorCommand(Command):
@@ -3995,7 +4327,7 @@ class AuthorizationFailIndicatorCommand(Command):
         # Start blinking for invalid rfid card
         cmd = AcpwMessageHandler.create_acpw_protocol_message(
             AcpwCommandId.PERIPHERAL_REQUEST.value, bytearray([PeripheralRequest.INVALID_CARD_BLINK.value]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class CardRemovedIndicatorCommand(Command):
@@ -4007,7 +4339,7 @@ class CardRemovedIndicatorCommand(Command):
         # Start blinking for card removal
         cmd = AcpwMessageHandler.create_acpw_protocol_message(
             AcpwCommandId.PERIPHERAL_REQUEST.value, bytearray([PeripheralRequest.TWO_RED_BLINK.value]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class CardAddedIndicatorCommand(Command):
@@ -4019,7 +4351,7 @@ class CardAddedIndicatorCommand(Command):
         # Start blinking for card addition
         cmd = AcpwMessageHandler.create_acpw_protocol_message(
             AcpwCommandId.PERIPHERAL_REQUEST.value, bytearray([PeripheralRequest.TWO_GREEN_BLINK.value]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class AuthorizationFinishIndicatorCommand(Command):
@@ -4043,7 +4375,7 @@ class AuthorizationFinishIndicatorCommand(Command):
         # long beep
         long_beep = GenericCommand(
             self.owner, AcpwCommandId.PERIPHERAL_REQUEST, PeripheralRequest.LONG_BEEP)
-        long_beep.execute()
+        return long_beep.execute()
 
 
 class QueryStatusCommand(Command):
@@ -4054,7 +4386,7 @@ class QueryStatusCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(self.command_id.value, bytearray([]))
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class GenericCommand(Command):
@@ -4069,7 +4401,7 @@ class GenericCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(self.command_id.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class SetOcppCurrentLimitCommand(Command):
@@ -4083,7 +4415,7 @@ class SetOcppCurrentLimitCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.SET_CURRENT_LIMIT.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class SetAppCurrentLimitCommand(Command):
@@ -4097,11 +4429,12 @@ class SetAppCurrentLimitCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.APP_AVAILABLE_CURRENT.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        future = self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
         time.sleep(0.2)
         # query app available current for db update
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.APP_AVAILABLE_CURRENT.value, bytearray([]))
         self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return future
 
 
 class SetLockableCableCommand(Command):
@@ -4115,11 +4448,12 @@ class SetLockableCableCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.LOCKABLE_CABLE.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        future = self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
         time.sleep(0.2)
         # query lockable cable status for db update
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.LOCKABLE_CABLE.value, bytearray([]))
         self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return future
 
 
 class SetPowerOptimizerCommand(Command):
@@ -4133,11 +4467,12 @@ class SetPowerOptimizerCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.APP_CPHOME_CURRENT.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        future = self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
         time.sleep(0.2)
         # query lockable cable status for db update
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.APP_CPHOME_CURRENT.value, bytearray([]))
         self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return future
 
 
 class SetModbusTcpCurrentCommand(Command):
@@ -4151,11 +4486,12 @@ class SetModbusTcpCurrentCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.SET_MODBUSTCP_CURRENT.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        future = self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
         time.sleep(0.2)
         # query lockable cable status for db update
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.SET_MODBUSTCP_CURRENT.value, bytearray([]))
         self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return future
 
 
 class PeripheralCommand(Command):
@@ -4169,7 +4505,7 @@ class PeripheralCommand(Command):
 
     def execute(self):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.PERIPHERAL_REQUEST.value, self.payload)
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class SwitchOperationModeCommand(Command):
@@ -4184,7 +4520,7 @@ class SwitchOperationModeCommand(Command):
         else:
             cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.MODE_SELECT.value, bytearray([1]))
 
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class HmiErrorCommand(Command):
@@ -4197,7 +4533,7 @@ class HmiErrorCommand(Command):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.HMI_BOARD_ERR.value,
                                                               bytearray([self.value]))
         if cmd is not None:
-            self.charge_station.mediator.send(cmd, self.charge_station, MessageTypes.ACPW)
+            return self.charge_station.mediator.send(cmd, self.charge_station, MessageTypes.ACPW)
 
 
 class InterlockCommand(Command):
@@ -4212,7 +4548,7 @@ class InterlockCommand(Command):
         else:
             cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.INTERLOCK.value, bytearray([0]))
 
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class ChangeAvailabilityCommand(Command):
@@ -4226,30 +4562,24 @@ class ChangeAvailabilityCommand(Command):
         else:
             cmd = AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.CHANGE_AVAILABILITY.value, bytearray([0]))
 
-        self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
+        return self.owner.mediator.send(cmd, self.owner, MessageTypes.ACPW)
 
 
 class ZmqMessageHandler(Requester):
 
     def __init__(self):
         super().__init__()
-        self.broker = None
-        self.dealer_queue = queue.Queue()
+        self.router = ZmqRouter("ipc:///var/lib/routing.ipc", self._route_message)
         self.zmq_router_thread = None
-        self.zmq_send_thread = None
         self.web_config_listen_thread = None
 
     def join(self):
         self.zmq_router_thread.join()
-        self.zmq_send_thread.join()
         self.web_config_listen_thread.join()
 
     def start(self):
-        self.zmq_router_thread = threading.Thread(target=self._zmqReceiver, daemon=True)
+        self.zmq_router_thread = threading.Thread(target=self.router.run, daemon=True)
         self.zmq_router_thread.start()
-        time.sleep(1)
-        self.zmq_send_thread = threading.Thread(target=self._zmq_sender, daemon=True)
-        self.zmq_send_thread.start()
         self.web_config_listen_thread = threading.Thread(target=self._web_config_listen, daemon=True)
         self.web_config_listen_thread.start()
 
@@ -4280,53 +4610,31 @@ class ZmqMessageHandler(Requester):
 
             time.sleep(0.5)
 
-    def _zmqReceiver(self, context=None):
-        context = context or zmq.Context.instance()
-        self.broker = context.socket(zmq.ROUTER)
-        self.broker.bind("ipc:///var/lib/routing.ipc")
-
-        while True:
-            try:
-                identity = self.broker.recv_string(flags=zmq.NOBLOCK)
-                msg = self.broker.recv_string(flags=zmq.NOBLOCK)
-                logger.info("Zmq message from {0}: {1}".format(identity, msg))
-            except:
-                time.sleep(0.05)
-                continue
-            
-            try:
-                if identity == "midMeter":
-                    self.mediator.send(msg, self, MessageTypes.EXTERNAL_METER)
-                elif identity == "OCPP1.6":
-                    self.mediator.send(msg, self, MessageTypes.OCPP)
-                elif identity == "rest":
-                    self.mediator.send(msg, self, MessageTypes.REST)
-                else:
-                    self.mediator.send(msg, self, MessageTypes.DEALER)
-            except:
-                logger.info("Router receive parse error: {0}".format(traceback.format_exc()))
+    def _route_message(self, identity, msg):
+        logger.info("Zmq message from {0}: {1}".format(identity, msg))
+        if identity == "midMeter":
+            self.mediator.send(msg, self, MessageTypes.EXTERNAL_METER)
+        elif identity == "OCPP1.6":
+            self.mediator.send(msg, self, MessageTypes.OCPP, identity)
+        elif identity == "rest":
+            self.mediator.send(msg, self, MessageTypes.REST, identity)
+        else:
+            self.mediator.send(msg, self, MessageTypes.DEALER, identity)
 
     def send_to_socket(self, data, destination=None):
-        self.dealer_queue.put({"data": data, "destination": destination})
+        if isinstance(data, AcpwEvent):
+            data = data.to_json()
+        if destination is not None:
+            self.router.send(destination.value, data)
+        else:
+            for dealer in Dealer:
+                self.router.send(dealer.value, data)
 
-    def _zmq_sender(self):
-        while True:
-            if not self.dealer_queue.empty():
-                value_dict = self.dealer_queue.get()
-                destination = value_dict["destination"]
-                if destination is not None:
-                    self.broker.send_string(destination.value, flags=zmq.SNDMORE)
-                    self.broker.send_string(value_dict['data'])
-                else:
-                    for dealer in Dealer:
-                        self.broker.send_string(dealer.value, flags=zmq.SNDMORE)
-                        self.broker.send_string(value_dict['data'])
-                # send to dealers
-                # for x in dealerList:
-                #     broker.send_string(x, flags=zmq.SNDMORE)
-                #     broker.send_string(data)
-                # broker.send_multipart([b'UI', b'ACK'])
-            time.sleep(0.01)
+    def send_to_identity(self, data, identity):
+        self.router.send(identity, data)
+
+    def get_statistics(self):
+        return dict(self.router.statistics)
 
 
 class Configurator(Requester):
@@ -4341,9 +4649,19 @@ class Meter(Requester):
     def start_query(self):
         pass
 
+    def poll_now(self):
+        pass
+
 
 class InternalMeter(Meter):
-    def __init__(self, command_list=None):
+    # Seconds to go through the whole command list, picked by charge point status
+    fast_interval = 5
+    slow_interval = 60
+    default_interval = 20
+    fast_statuses = (ChargePointStatus.CHARGING, ChargePointStatus.SUSPENDED_EV, ChargePointStatus.SUSPENDED_EVSE)
+    slow_statuses = (ChargePointStatus.AVAILABLE,)
+
+    def __init__(self, command_list=None, fast_interval=None, slow_interval=None, default_interval=None):
         command_list = command_list or \
                        [
                            AcpwCommandId.ENERGY.value,
@@ -4352,12 +4670,38 @@ class InternalMeter(Meter):
                            AcpwCommandId.VOLTAGE.value
                        ]
         super().__init__(command_list)
+        self.fast_interval = fast_interval or InternalMeter.fast_interval
+        self.slow_interval = slow_interval or InternalMeter.slow_interval
+        self.default_interval = default_interval or InternalMeter.default_interval
+        self.burst_event = threading.Event()
+
+    def poll_now(self):
+        self.burst_event.set()
+
+    def polling_interval(self):
+        try:
+            status = self.mediator.charge_station.charge_points[1].status
+        except:
+            return self.default_interval
+        if status in self.fast_statuses:
+            return self.fast_interval
+        elif status in self.slow_statuses:
+            return self.slow_interval
+        return self.default_interval
 
     def _query_metrics(self):
+        index = 0
         while True:
-            for command in self.command_list:
-                self._get_metric(command, bytearray([]))
-            time.sleep(20)
+            if self.burst_event.is_set():
+                self.burst_event.clear()
+                for command in self.command_list:
+                    self._get_metric(command, bytearray([]))
+                index = 0
+            else:
+                self._get_metric(self.command_list[index], bytearray([]))
+                index = (index + 1) % len(self.command_list)
+            # one command per step so a reading is spread over the interval instead of sent as a burst
+            self.burst_event.wait(self.polling_interval() / len(self.command_list))
 
     def _get_metric(self, command, payload):
         cmd = AcpwMessageHandler.create_acpw_protocol_message(command, payload)
@@ -4377,78 +4721,69 @@ class MidMeter(Meter):
 
 class AcpwMessageHandler(Requester):
     message_id = c_ubyte(1)
-    crc_table = []
     start_byte = 0xDE
     stop_byte = 0xAD
-    serial_reset_time = 120.0  # Seconds
-
-    def __init__(self, serial_port=None):
-
-        self.serial_port = serial_port or serial.Serial()
-        self.serial_outgoing_queue = queue.Queue()
+    serial_read_timeout = 1.0  # Seconds
+    serial_inter_byte_chars = 3.5  # Silence in character times that ends a received burst
+    serial_inter_frame_gap = 0.0  # Seconds of idle line between frames, 0 batches ready frames into one write
+    serial_write_batch_size = 256  # Bytes
+    ack_window = 4  # Unacknowledged commands allowed on the link at once
+    ack_retries = 2  # Retransmissions before a command is failed
+    # Commands that are held until ACPW answers with ACK/NACK, with their timeout in seconds
+    ack_timeouts = {
+        AcpwCommandId.START_CHARGING.value: 2.0,
+        AcpwCommandId.STOP_CHARGING.value: 2.0,
+        AcpwCommandId.PAUSE_CHARGE.value: 2.0,
+        AcpwCommandId.SET_CURRENT_LIMIT.value: 1.0,
+        AcpwCommandId.UNLOCK.value: 2.0,
+        AcpwCommandId.MODE_SELECT.value: 1.0,
+        AcpwCommandId.HMI_BOARD_ERR.value: 1.0,
+        AcpwCommandId.INTERLOCK.value: 1.0,
+        AcpwCommandId.CHANGE_AVAILABILITY.value: 1.0
+    }
+
+    def __init__(self, port_name=ACPW_SERIAL_PORT, baud_rate=ACPW_BAUD_RATE):
+
+        self.link = AcpwLinkSupervisor(port_name, baud_rate, self._probe_link, self._link_opened)
+        self.serial_outgoing_queue = AcpwOutgoingQueue()
         self.serial_incoming_queue = queue.Queue()
-        self.serial_event = threading.Event()
-        self.serial_sent_event = threading.Event()
-        self.serial_timer_thread = threading.Thread(target=self._reset_serial, daemon=True)
-        self.serial_sent_time = time.time()
+        # a partial frame may wait for twice the time the longest ACPW frame takes on the wire
+        self.frame_decoder = AcpwFrameDecoder(
+            partial_timeout=2 * acpw_protocol.MAX_INBOUND_FRAME_SIZE * 10.0 / baud_rate)
+        self.statistics = AcpwLinkStatistics()
+        self.in_flight = {}
+        self.in_flight_condition = threading.Condition()
         self._protocol_message_checker = {
             AcpwCommandId.ACK.value: self._ack_received,
             AcpwCommandId.NACK.value: self._nack_received,
-            AcpwCommandId.PILOT_STATE.value: self._control_pilot_state_received,
-            AcpwCommandId.VOLTAGE.value: self._voltage_received,
-            AcpwCommandId.CURRENT.value: self._current_received,
-            AcpwCommandId.ENERGY.value: self._total_energy_received,
-            AcpwCommandId.POWER.value: self._active_power_received,
             # Command.START_CHARGING.value:   8,
             # Command.STOP_CHARGING.value:    9,
             # Command.SET_CURRENT_LIMIT.value:10,
             # Command.UNLOCK.value:           11,
             # Command.REBOOT.value:           12,
-            AcpwCommandId.FAULTS.value: self._faults_received,
             AcpwCommandId.LOG_DUMP.value: self._log_dump_received,
             # Command.TEMPERATURE.value:      15,
             AcpwCommandId.OTA_START.value: self._ota_start_received,
-            AcpwCommandId.OTA_STATUS.value: self._ota_status_received,
             AcpwCommandId.OTA_DATA.value: self._fw_update_result_received,
             # Command.PERIPHERAL_REQUEST.value: 19,
-            AcpwCommandId.PROXIMITY_STATE.value: self._proximity_pilot_state_received,
-            AcpwCommandId.MAX_CURRENT.value: self._max_current_received,
-            AcpwCommandId.VERSION.value: self._version_received,
             AcpwCommandId.SERIAL_NUMBER.value: self._serialnumber_received,
-            AcpwCommandId.EXTERNAL_CHARGE.value: self._external_charge_received,
-            AcpwCommandId.MIN_CURRENT.value: self._min_current_received,
-            AcpwCommandId.APP_AVAILABLE_CURRENT.value: self._app_available_current_received,
-            AcpwCommandId.DEVICE_CPHOME_CURRENT.value: self._device_cphome_current_received,
-            AcpwCommandId.APP_CPHOME_CURRENT.value: self._app_cphome_received,
-            AcpwCommandId.LOCKABLE_CABLE.value: self._lockable_cable_received,
-            AcpwCommandId.PEAK_OFFPEAK_INFO.value: self._peak_offpeak_received,
-            AcpwCommandId.CURRENT_OFFERED_TO_EV.value: self._current_offered_to_ev_received,
-            AcpwCommandId.NUMBER_OF_PHASE.value: self._number_of_phase_received,
-            AcpwCommandId.PROXIMITY_PILOT_CURRENT.value: self._proximity_pilot_current_received,
-            AcpwCommandId.SET_MODBUSTCP_CURRENT.value: self._modbustcp_current_received
+            AcpwCommandId.PEAK_OFFPEAK_INFO.value: self._peak_offpeak_received
         }
+        # Fixed layout payloads are decoded from acpw_protocol.PAYLOAD_SCHEMAS
+        for command in PAYLOAD_SCHEMAS:
+            self._protocol_message_checker.setdefault(command, self._payload_received)
 
-        AcpwMessageHandler.crc_table = self.create_crc_table()
+        logger.info("ACPW crc backend: {0}".format(acpw_protocol.crc_backend))
         super().__init__(self)
-        self.serial_timer_thread.start()
+
+    @property
+    def serial_port(self):
+        return self.link.port
 
     @staticmethod
     def create_acpw_protocol_message(command, data):
         try:
-            message_id = AcpwMessageHandler.generate_message_id()
-            message = bytearray([message_id, 0, command])
-            if len(data) > 0:
-                message.extend(data)
-            message_size = (len(message) + 4).to_bytes(2, byteorder="big")  # plus 4 - crc and message size itself
-            message.insert(0, message_size[0])
-            message.insert(1, message_size[1])
-            crc = AcpwMessageHandler.calculate_crc(message)
-            crc_bytes = crc.to_bytes(2, byteorder="big")
-            message.insert(len(message), int(hex(crc_bytes[0]), 16))
-            message.insert(len(message), crc_bytes[1])
-            message.insert(ByteIndex.START.value, AcpwMessageHandler.start_byte)
-            message.insert(len(message), AcpwMessageHandler.stop_byte)
-            return message
+            return acpw_protocol.create_frame(AcpwMessageHandler.generate_message_id(), command, data)
         except:
             logger.info("Malformed ACPW message create data {0}".format(traceback.format_exc()))
             return None
@@ -4456,374 +4791,59 @@ class AcpwMessageHandler(Requester):
     @staticmethod
     def generate_message_id():
         AcpwMessageHandler.message_id.value += 1
+        if AcpwMessageHandler.message_id.value == 0:  # 0 means "no message" in the receive id field
+            AcpwMessageHandler.message_id.value = 1
         return AcpwMessageHandler.message_id.value
 
     def _ack_received(self, data):
-        pass
-        # sendToDealers("ACK")
+        with self.in_flight_condition:
+            command = self.in_flight.pop(data[ByteIndex.MESSAGE_ID_RECEIVE.value], None)
+            self.in_flight_condition.notify_all()
+        if command is not None:
+            logger.debug("ACK for {0} after {1} attempt(s)".format(command.name, command.attempts))
+            command.future.set_result(data)
 
     def _nack_received(self, data):
-        pass
-
-    def _control_pilot_state_received(self, data):
-
-        pilot_state = data[ByteIndex.PAYLOAD.value]
-        # self.__checkPilotStateChange(pilotState)
-
-        ps = {
-            "type": "pilotState",
-            "data": {
-                "value": pilot_state
-            }
-        }
-
-        msg = json.dumps(ps)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _voltage_received(self, data):
-
-        voltage_p1 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 4],
-            byteorder='big')
-        voltage_p2 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 4:ByteIndex.PAYLOAD.value + 8],
-            byteorder='big')
-        voltage_p3 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 8:ByteIndex.PAYLOAD.value + 12],
-            byteorder='big')
-
-        voltage = {
-            "type": "voltageEvent",
-            "data": {
-                "P1": voltage_p1, "P2": voltage_p2, "P3": voltage_p3
-            }
-        }
-
-        msg = json.dumps(voltage)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _current_received(self, data):
-
-        current_p1 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 4],
-            byteorder='big')
-        current_p2 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 4:ByteIndex.PAYLOAD.value + 8],
-            byteorder='big')
-        current_p3 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 8:ByteIndex.PAYLOAD.value + 12],
-            byteorder='big')
-
-        current = {
-            "type": "currentEvent",
-            "data": {
-                "P1": current_p1, "P2": current_p2, "P3": current_p3
-            }
-        }
-
-        msg = json.dumps(current)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _total_energy_received(self, data):
-
-        total_energy = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 8],
-            byteorder='big')
-        energy = {
-            "type": "totalEnergyEvent",
-            "data": {
-                "P1": total_energy,
-                "P2": 0,
-                "P3": 0
-            }
-        }
-
-        msg = json.dumps(energy)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _active_power_received(self, data):
-
-        active_power_p1 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 4],
-            byteorder='big')
-        active_power_p2 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 4:ByteIndex.PAYLOAD.value + 8],
-            byteorder='big')
-        active_power_p3 = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 8:ByteIndex.PAYLOAD.value + 12],
-            byteorder='big')
-
-        active_power = {
-            "type": "activePowerEvent",
-            "data": {
-                "P1": active_power_p1, "P2": active_power_p2, "P3": active_power_p3
-            }
-        }
-
-        msg = json.dumps(active_power)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _faults_received(self, data):
-
-        fault = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 4], byteorder='big')
-        fault_json = {
-            "type": "faultState",
-            "data": {
-                "value": fault
-            }
-        }
-
-        msg = json.dumps(fault_json)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
+        with self.in_flight_condition:
+            command = self.in_flight.get(data[ByteIndex.MESSAGE_ID_RECEIVE.value], None)
+            if command is not None:
+                self.statistics.count("nacks")
+                logger.info("NACK for {0}".format(command.name))
+                # Retransmitted by the writer thread on its next pass
+                command.deadline = 0
+                self.in_flight_condition.notify_all()
+        if command is not None:
+            # the writer may be waiting for outgoing frames rather than for the ack window
+            self.serial_outgoing_queue.wake()
+
+    def _payload_received(self, data):
+        self._dispatch_event(PAYLOAD_SCHEMAS[data[ByteIndex.COMMAND_ID.value]].decode(data))
 
     def _fw_update_result_received(self, data):
         logger.info("fwUpdate result received")
 
-    def _proximity_pilot_state_received(self, data):
-
-        val = data[ByteIndex.PAYLOAD.value]
-        proximity_state = {
-            "type": "proximityState",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(proximity_state)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
     def _log_dump_received(self, data):
         pass
 
     def _ota_start_received(self, data):
         pass
 
-    def _ota_status_received(self, data):
-        received_ota_status = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 1],
-            byteorder='big')
-        received_packet_id = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 1:ByteIndex.PAYLOAD.value + 2],
-            byteorder='big')
-
-        ota_status = {
-            "type": "otaStatus",
-            "data": {
-                "value": received_ota_status,
-                "packetId": received_packet_id
-            }
-        }
-        msg = json.dumps(ota_status)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _max_current_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-        maxCurrent = {
-            "type": "maximumCurrent",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(maxCurrent)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _version_received(self, data):
-        size = len(data)
-        acpw_version = data[ByteIndex.PAYLOAD.value:size - 3]
-        acpw_version = acpw_version.decode("utf-8")
-
-        version = {
-            "type": "acpwVersion",
-            "data": {
-                "value": acpw_version
-            }
-        }
-        msg = json.dumps(version)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
     def _serialnumber_received(self, data):
+        event = PAYLOAD_SCHEMAS[AcpwCommandId.SERIAL_NUMBER.value].decode(data)
+        logger.info("Serial Number Received: %s" % event.value)
+        self._dispatch_event(event)
 
-        size = len(data)
-        serial_number = data[ByteIndex.PAYLOAD.value:size - 3]
-        serial_number = serial_number.decode("utf-8")
-        logger.info("Serial Number Received: %s" % serial_number)
-
-        serial = {
-            "type": "serialNumber",
-            "data": {
-                "value": serial_number
-            }
-        }
-        msg = json.dumps(serial)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _external_charge_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-        external_charge = {
-            "type": "externalCharge",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(external_charge)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _min_current_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-
-        min_current = {
-            "type": "minCurrent",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(min_current)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _proximity_pilot_current_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-
-        proximity_pilot_current = {
-            "type": "proximityPilotCurrent",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(proximity_pilot_current)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _modbustcp_current_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-
-        modbustcp_current = {
-            "type": "modbusTcpCurrent",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(modbustcp_current)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _app_available_current_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-        available_current = {
-            "type": "availableCurrent",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(available_current)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _device_cphome_current_received(self, data):
-        minimum = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 1],
-            byteorder='big')
-        maximum = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 1:ByteIndex.PAYLOAD.value + 2],
-            byteorder='big')
-
-        power_optimizer_limits = {
-            "type": "powerOptimizerLimits",
-            "data": {
-                "min": minimum,
-                "max": maximum
-            }
-        }
-        msg = json.dumps(power_optimizer_limits)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _app_cphome_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-
-        power_optimizer = {
-            "type": "powerOptimizer",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(power_optimizer)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-
-    def _number_of_phase_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-
-        phase_type = {
-            "type": "phaseType",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(phase_type)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-        
-    def _lockable_cable_received(self, data):
-        val = data[ByteIndex.PAYLOAD.value]
-        lockable_cable = {
-            "type": "lockableCable",
-            "data": {
-                "value": val
-            }
-        }
-
-        msg = json.dumps(lockable_cable)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-        
     def _peak_offpeak_received(self, data):
         pass
-    
-    def _current_offered_to_ev_received(self, data):
-        current_offered = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value:ByteIndex.PAYLOAD.value + 1],
-            byteorder='big')
-        reason = int.from_bytes(
-            data[ByteIndex.PAYLOAD.value + 1:ByteIndex.PAYLOAD.value + 2],
-            byteorder='big')
-
-        current_offered_msg = {
-            "type": "currentOfferedEv",
-            "data": {
-                "value": {
-                    "current": current_offered,
-                    "reason": reason
-                }
-            }
-        }
-        msg = json.dumps(current_offered_msg)
-        logger.info(msg)
-        self.mediator.send(msg, self, MessageTypes.ACPW)
-        
+
+    def _dispatch_event(self, event):
+        logger.debug(event)
+        self.mediator.send(event, self, MessageTypes.ACPW)
+
     def start(self):
-        acpw_read_thread = threading.Thread(target=self._serial_read, args=("/dev/ttyS1", 9600), daemon=True)
+        self.link.start()
+
+        acpw_read_thread = threading.Thread(target=self._serial_read, daemon=True)
         acpw_read_thread.start()
 
         acpw_send_thread = threading.Thread(target=self._serial_write, daemon=True)
@@ -4832,198 +4852,570 @@ class AcpwMessageHandler(Requester):
         acpw_parse_thread = threading.Thread(target=self._parse_acpw_message, daemon=True)
         acpw_parse_thread.start()
 
-    def _serial_read(self, portName, baudRate):
-        try:
-            self.serial_port = serial.Serial(portName, baudRate)
-            self.serial_event.clear()
-        except:
-            logger.info("Cannot open acpw serial")
-            return
-        while not self.serial_event.isSet():
+    def _serial_read(self):
+        # 10 bits per character on the wire (start + 8 data + stop)
+        inter_byte_timeout = AcpwMessageHandler.serial_inter_byte_chars * 10.0 / self.link.baud_rate
+        while True:
+            port, generation = self.link.wait_for_port()
             try:
-                if self.serial_port.inWaiting() > 0:
-                    self.serial_sent_event.clear()
-                    logger.debug("Got raw serial")
-                    in_waiting = self.serial_port.inWaiting()
-                    received_data = self.serial_port.read(in_waiting)
-                    time.sleep(0.1)
-                    # check for remaining byte
-                    remaining = self.serial_port.read(self.serial_port.inWaiting())
-                    if len(remaining) > 0:
-                        received_data += remaining
-                    self.serial_incoming_queue.put(received_data)
+                # Block until the first byte arrives (or the read timeout expires)
+                received_data = port.read(1)
+                if len(received_data) == 0:
+                    continue
+                received_time = time.monotonic()
+                # Collect the rest of the burst until the line goes quiet
+                while True:
+                    in_waiting = port.inWaiting()
+                    if in_waiting > 0:
+                        received_data += port.read(in_waiting)
+                    readable, _, _ = select.select([port.fileno()], [], [], inter_byte_timeout)
+                    if not readable:
+                        break
+                self.link.report_received()
+                logger.debug("Got raw serial")
+                self.serial_incoming_queue.put((received_time, received_data))
             except:
-                logger.info("ACPW serial port read error {0}".format(traceback.format_exc()))
-            time.sleep(0.1)
+                if self.link.report_error(generation, "read error"):
+                    logger.info("ACPW serial port read error {0}".format(traceback.format_exc()))
 
     def _serial_write(self):
         while True:
+            ready = []
             try:
-                if not self.serial_outgoing_queue.empty() and self.serial_port.isOpen():
-                    data = self.serial_outgoing_queue.get()
-                    # TODO check for ACK
-                    self.serial_port.write(data)
-                    if not self.serial_sent_event.isSet():
-                        self.serial_sent_time = time.time()
-                    self.serial_sent_event.set()
-                    logger.info("Sent {0} to ACPW, payload {1}".format(
-                        AcpwCommandId(data[ByteIndex.COMMAND_ID.value]).name, data[ByteIndex.PAYLOAD.value])
-                    )
-                    if DEBUG:
-                        logger.debug("Raw data:")
-                        for b in data:
-                            logger.debug(hex(b))
-                        print()
+                port, generation = self.link.wait_for_port(0.1)
+                if port is None:
+                    continue
+                self._retransmit_expired()
+                try:
+                    ready = [self.serial_outgoing_queue.get(timeout=self._next_ack_timeout())]
+                except queue.Empty:
+                    continue
+                if AcpwMessageHandler.serial_inter_frame_gap == 0:
+                    # Drain whatever else is ready so it goes out in a single write
+                    batch_size = len(ready[0][0])
+                    while batch_size < AcpwMessageHandler.serial_write_batch_size:
+                        try:
+                            ready.append(self.serial_outgoing_queue.get(timeout=0))
+                        except queue.Empty:
+                            break
+                        batch_size += len(ready[-1][0])
+                batch = []
+                written = []
+                for data, future in ready:
+                    timeout = AcpwMessageHandler.ack_timeouts.get(data[ByteIndex.COMMAND_ID.value])
+                    if timeout is not None:
+                        if len(batch) > 0 and self._ack_window_full():
+                            self._write_frames(batch)
+                            batch = []
+                        self._wait_for_ack_window()
+                        command = InFlightCommand(data, future, timeout)
+                        with self.in_flight_condition:
+                            self.in_flight[command.message_id] = command
+                    else:
+                        written.append(future)
+                    batch.append(data)
+                    if AcpwMessageHandler.serial_inter_frame_gap > 0:
+                        self._write_frames(batch)
+                        batch = []
+                if len(batch) > 0:
+                    self._write_frames(batch)
+                for future in written:
+                    future.set_result(None)
             except:
                 logger.info("ACPW serial port send error {0}".format(traceback.format_exc()))
+                self._fail_unsent(ready, "ACPW serial write failed")
+                self.link.report_error(generation, "write error")
+                time.sleep(0.1)
 
-            time.sleep(0.1)
+    def _fail_unsent(self, entries, reason):
+        # commands already in flight are retransmitted on the reopened port, everything else is lost
+        with self.in_flight_condition:
+            in_flight = set(id(command.future) for command in self.in_flight.values())
+        for data, future in entries:
+            if not future.done() and id(future) not in in_flight:
+                future.set_exception(AcpwCommandError(reason))
+
+    def _write_frames(self, frames):
+        data = frames[0] if len(frames) == 1 else b"".join(frames)
+        self.serial_port.write(data)
+        self.link.report_sent()
+        for frame in frames:
+            name = AcpwCommandId(frame[ByteIndex.COMMAND_ID.value]).name
+            self.statistics.frame_sent(name)
+            logger.info("Sent {0} to ACPW, payload {1}".format(name, frame[ByteIndex.PAYLOAD.value]))
+        if DEBUG:
+            for frame in frames:
+                logger.debug("Raw data: " + " ".join(hex(b) for b in frame))
+        # Hold the next write until these bytes are on the wire, so queued frames keep their priority order.
+        # Never called with in_flight_condition held, so ACKs are taken by the parser thread meanwhile.
+        time.sleep(len(data) * 10.0 / self.link.baud_rate + AcpwMessageHandler.serial_inter_frame_gap)
+
+    def _ack_window_full(self):
+        with self.in_flight_condition:
+            return len(self.in_flight) >= AcpwMessageHandler.ack_window
 
-    def _reset_serial(self):
+    def _wait_for_ack_window(self):
         while True:
-            if time.time() - self.serial_sent_time > AcpwMessageHandler.serial_reset_time and self.serial_sent_event.isSet():
-                logger.info("resetting serial port")
-                self.serial_event.set()
-                self.serial_sent_event.clear()
-                self.serial_port.close()
-                logger.info("closed serial port")
-                time.sleep(0.1)
-                acpw_read_thread = threading.Thread(target=self._serial_read, args=("/dev/ttyS1", 9600), daemon=True)
-                acpw_read_thread.start()
-                logger.info("opened new serial port")
-            time.sleep(1)
+            with self.in_flight_condition:
+                if len(self.in_flight) < AcpwMessageHandler.ack_window:
+                    return
+                self.in_flight_condition.wait(self._next_ack_timeout())
+            self._retransmit_expired()
+
+    def _next_ack_timeout(self):
+        with self.in_flight_condition:
+            if len(self.in_flight) == 0:
+                return None
+            deadline = min(command.deadline for command in self.in_flight.values())
+        return max(deadline - time.monotonic(), 0.0)
+
+    def _retransmit_expired(self):
+        now = time.monotonic()
+        failed = []
+        retransmit = []
+        with self.in_flight_condition:
+            for command in [command for command in self.in_flight.values() if command.deadline <= now]:
+                if command.attempts > AcpwMessageHandler.ack_retries:
+                    del self.in_flight[command.message_id]
+                    failed.append(command)
+                    continue
+                command.attempts += 1
+                command.deadline = now + command.timeout
+                retransmit.append(command)
+            if len(failed) > 0:
+                self.in_flight_condition.notify_all()
+        for command in failed:
+            self.statistics.count("ackFailures")
+            logger.info("No ACK for {0} after {1} attempt(s), giving up".format(command.name, command.attempts))
+            command.future.set_exception(AcpwCommandError("{0} not acknowledged by ACPW".format(command.name)))
+        for command in retransmit:
+            logger.info("Retransmitting {0}, attempt {1}".format(command.name, command.attempts))
+            self.statistics.count("retransmissions")
+        if len(retransmit) > 0:
+            self._write_frames([command.frame for command in retransmit])
+
+    def _link_opened(self):
+        # bytes left from the old port are dropped by the parser thread before any from the new one
+        self.serial_incoming_queue.put((time.monotonic(), None))
+
+    def _probe_link(self):
+        # MAX_CURRENT is answered without side effects on the charge point state machine
+        self.send_to_acpw(AcpwMessageHandler.create_acpw_protocol_message(AcpwCommandId.MAX_CURRENT.value, bytearray([])))
 
     def _parse_acpw_message(self):
         while True:
             try:
-                if not self.serial_incoming_queue.empty():
-                    data = self.serial_incoming_queue.get()
-                    fragments = self._split_acpw_message(data)
-                    if DEBUG:
-                        logger.debug("Received messages: ")
-                        logger.debug("----------------")
-                        for val in fragments:
-                            for b in val:
-                                logger.debug(hex(b), end=" ")
-                            print()
-                            logger.debug("----------------")
-
+                try:
+                    # a partial frame is expired by the decoder even if nothing else arrives
+                    received_time, data = self.serial_incoming_queue.get(
+                        timeout=self.frame_decoder.partial_timeout if self.frame_decoder.pending() else None)
+                except queue.Empty:
+                    received_time, data = time.monotonic(), b""
+                if data is None:
+                    self.frame_decoder.reset()
+                    continue
+                fragments = self.frame_decoder.feed(data)
+                if DEBUG:
                     for val in fragments:
-                        if self._check_acpw_message_integrity(data):
-                            logger.debug("Serial incoming msg is valid")
-                            command = val[ByteIndex.COMMAND_ID.value]
-                            logger.debug("Serial incoming command id %d" % command)
-                            acpw_command = None
-                            try:
-                                acpw_command = AcpwCommandId(command)
-                            except:
-                                logger.info("Undefined command received from acpw")
-                                continue
-                            
-                            logger.info("Received: {0}".format(acpw_command.name))
-                            func = self._get_command_func(command)
-                            if func is not None:
-                                try:
-                                    func(val)
-                                except:
-                                    logger.info("Command data error from acpw {0}".format(traceback.format_exc()))
-                            else:
-                                logger.info("Undefined command received from acpw")
-            except:
-                logger.info("Unexpected content acpw")
-                
-            time.sleep(0.01)
-
-    def _split_acpw_message(self, data):
-        # TODO implement remaining bytes case
-        fragment_list = []
-        size = len(data)
-        start_index = 0
-        try:
-            while True:
-                if data[start_index] == 0xde:
+                        logger.debug("Received message: " + " ".join(hex(b) for b in val))
 
+                for val in fragments:
+                    command = val[ByteIndex.COMMAND_ID.value]
+                    logger.debug("Serial incoming command id %d" % command)
+                    acpw_command = None
                     try:
-                        logger.debug("start index %d" % start_index)
-                        logger.debug("size %d" % size)
-                        message_size = int.from_bytes(
-                            data[start_index + ByteIndex.MESSAGE_SIZE.value:start_index + 3],
-                            byteorder='big')
-                        logger.debug("message size %d" % message_size)
-                        # logger.info(data[startIndex + messageSize])
-                        if (size > start_index + message_size and
-                                data[start_index + message_size + 1] == 0xad):
-                            logger.debug("found")
-                            # found valid message
-                            fragment_list.append(
-                                data[start_index:start_index + message_size + 2])
-
-                            # for b in data[startIndex:startIndex + messageSize+2]:
-                            #     logger.info(hex(b))
-                            if size > start_index + message_size + 3:  # check if another message remaining
-                                logger.debug("another message")
-                                start_index = start_index + message_size + 2
-                            else:
-                                logger.debug("no more msg, break")
-                                break
-                        else: # Discard incomplete message and move the index
-                            startIndex += 1
-
+                        acpw_command = AcpwCommandId(command)
                     except:
-                        logger.info("!!! incomplete message")
-                        if DEBUG:
-                            for b in data:
-                                logger.debug(hex(b), end=" ")
-                            print()
-                            logger.debug("~~~~~~~~~~~~~~~~")
-                        break  # TODO remaining
-                else:
-                    start_index += 1
-                    logger.debug("splitAcpwMessage search  startIndex {0}".format(start_index))
-                time.sleep(0.01)
-        except:
-            logger.info("splitAcpwMessage discard")
-
-        return fragment_list
-
-    def _check_acpw_message_integrity(self, data):
-        logger.debug("checking message integrity")
-        size = len(data)
-        if self.calculate_crc(data[ByteIndex.MESSAGE_SIZE.value:size - 3]):
-            return True
-        return False
+                        self.statistics.frame_received(str(command))
+                        logger.info("Undefined command received from acpw")
+                        continue
+
+                    self.statistics.frame_received(acpw_command.name)
+                    logger.info("Received: {0}".format(acpw_command.name))
+                    func = self._get_command_func(command)
+                    if func is not None:
+                        try:
+                            func(val)
+                        except:
+                            logger.info("Command data error from acpw {0}".format(traceback.format_exc()))
+                    else:
+                        logger.info("Undefined command received from acpw")
+                    self.statistics.frame_dispatched(time.monotonic() - received_time)
+            except:
+                logger.info("Unexpected content acpw")
 
     def _get_command_func(self, commandId):
         func = self._protocol_message_checker.get(commandId, None)
         return func
 
-    @staticmethod
-    def create_crc_table():
-        crc_poly = 0x1021
-        crc_tabccitt = [0] * 256
-        for i in range(256):
-            crc = 0
-            c = i << 8
-            for j in range(8):
-                if (crc ^ c) & 0x8000:
-                    crc = (crc << 1) ^ crc_poly
-                else:
-                    crc = crc << 1
-                c = c << 1
-            crc_tabccitt[i] = crc
-        return crc_tabccitt
-
     @staticmethod
     def calculate_crc(data):
-        crc = 0xFFFF
-        for b in data:
-            short_c = 0x00ff & b
-            tmp = ((crc >> 8) ^ short_c & 0x00ff)
-            crc = ((crc << 8) ^ AcpwMessageHandler.crc_table[tmp & 0xff]) & 0xffff
-        return crc
+        return acpw_protocol.calculate_crc(data)
+
+    def get_statistics(self):
+        statistics = self.statistics.as_dict()
+        statistics["resyncs"] = self.frame_decoder.resync_count
+        statistics["bytesDiscarded"] = self.frame_decoder.discarded_bytes
+        statistics["crcFailures"] = self.frame_decoder.crc_failures
+        statistics["partialTimeouts"] = self.frame_decoder.partial_timeouts
+        statistics["inFlight"] = len(self.in_flight)
+        statistics["outgoingQueue"] = self.serial_outgoing_queue.get_metrics()
+        statistics["link"] = self.link.get_metrics()
+        statistics["crcBackend"] = acpw_protocol.crc_backend
+        return statistics
 
     def send_to_acpw(self, data):
-        self.serial_outgoing_queue.put(data)
+        if data is None:
+            future = Future()
+            future.set_exception(AcpwCommandError("Malformed ACPW message"))
+            return future
+        return self.serial_outgoing_queue.put(data)
+
+
+class LatencyHistogram(object):
+    bounds_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyHistogram.bounds_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(LatencyHistogram.bounds_ms, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.maximum = max(self.maximum, milliseconds)
+
+    def as_dict(self):
+        buckets = collections.OrderedDict()
+        for bound, count in zip(LatencyHistogram.bounds_ms, self.counts):
+            buckets["<={0}ms".format(bound)] = count
+        buckets[">{0}ms".format(LatencyHistogram.bounds_ms[-1])] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avgMs": round(self.total / self.count, 2) if self.count else 0,
+            "maxMs": round(self.maximum, 2),
+            "buckets": buckets
+        }
+
+
+class AcpwLinkStatistics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames_in = {}
+        self.frames_out = {}
+        self.counters = {"nacks": 0, "retransmissions": 0, "ackFailures": 0}
+        self.dispatch_latency = LatencyHistogram()
+
+    def frame_received(self, name):
+        with self.lock:
+            self.frames_in[name] = self.frames_in.get(name, 0) + 1
+
+    def frame_sent(self, name):
+        with self.lock:
+            self.frames_out[name] = self.frames_out.get(name, 0) + 1
+
+    def frame_dispatched(self, latency):
+        with self.lock:
+            self.dispatch_latency.add(latency)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def as_dict(self):
+        with self.lock:
+            statistics = dict(self.counters)
+            statistics["framesIn"] = dict(self.frames_in)
+            statistics["framesOut"] = dict(self.frames_out)
+            statistics["dispatchLatency"] = self.dispatch_latency.as_dict()
+        return statistics
+
+
+class AcpwOutgoingQueue(object):
+    """Outgoing ACPW frames ordered by priority.
+
+    Charging and safety commands go out before OTA traffic, which goes out
+    before LED, buzzer and HMI error indications, which go out before
+    telemetry queries. A query that is already waiting is not queued again;
+    the caller gets the future of the pending one.
+    """
+    CONTROL = 0
+    OTA = 1
+    INDICATOR = 2
+    TELEMETRY = 3
+    names = ("control", "ota", "indicator", "telemetry")
+
+    ota_commands = {
+        AcpwCommandId.OTA_START.value,
+        AcpwCommandId.OTA_STATUS.value,
+        AcpwCommandId.OTA_DATA.value
+    }
+    indicator_commands = {
+        AcpwCommandId.PERIPHERAL_REQUEST.value,
+        AcpwCommandId.HMI_BOARD_ERR.value
+    }
+    # Sent without payload these only ask ACPW to report a value
+    query_commands = {
+        AcpwCommandId.PILOT_STATE.value,
+        AcpwCommandId.VOLTAGE.value,
+        AcpwCommandId.CURRENT.value,
+        AcpwCommandId.ENERGY.value,
+        AcpwCommandId.POWER.value,
+        AcpwCommandId.FAULTS.value,
+        AcpwCommandId.TEMPERATURE.value,
+        AcpwCommandId.PROXIMITY_STATE.value,
+        AcpwCommandId.MAX_CURRENT.value,
+        AcpwCommandId.VERSION.value,
+        AcpwCommandId.SERIAL_NUMBER.value,
+        AcpwCommandId.EXTERNAL_CHARGE.value,
+        AcpwCommandId.MIN_CURRENT.value,
+        AcpwCommandId.APP_AVAILABLE_CURRENT.value,
+        AcpwCommandId.DEVICE_CPHOME_CURRENT.value,
+        AcpwCommandId.APP_CPHOME_CURRENT.value,
+        AcpwCommandId.LOCKABLE_CABLE.value,
+        AcpwCommandId.NUMBER_OF_PHASE.value,
+        AcpwCommandId.PROXIMITY_PILOT_CURRENT.value,
+        AcpwCommandId.SET_MODBUSTCP_CURRENT.value
+    }
+
+    def __init__(self):
+        self.queues = [collections.deque() for _ in AcpwOutgoingQueue.names]
+        self.pending_queries = {}
+        self.condition = threading.Condition()
+        self.woken = False
+        self.coalesced_count = 0
+        self.dequeued_count = [0] * len(AcpwOutgoingQueue.names)
+        self.wait_time_total = [0.0] * len(AcpwOutgoingQueue.names)
+        self.wait_time_max = [0.0] * len(AcpwOutgoingQueue.names)
+        self.wait_histogram = LatencyHistogram()
+
+    @staticmethod
+    def is_query(data):
+        return len(data) == acpw_protocol.MIN_FRAME_SIZE and \
+            data[ByteIndex.COMMAND_ID.value] in AcpwOutgoingQueue.query_commands
+
+    def priority(self, data):
+        command = data[ByteIndex.COMMAND_ID.value]
+        if command in AcpwOutgoingQueue.ota_commands:
+            return AcpwOutgoingQueue.OTA
+        if command in AcpwOutgoingQueue.indicator_commands:
+            return AcpwOutgoingQueue.INDICATOR
+        if self.is_query(data):
+            return AcpwOutgoingQueue.TELEMETRY
+        return AcpwOutgoingQueue.CONTROL
+
+    def wake(self):
+        """Makes a waiting get() return early, with queue.Empty if nothing was queued meanwhile."""
+        with self.condition:
+            self.woken = True
+            self.condition.notify()
+
+    def put(self, data):
+        priority = self.priority(data)
+        with self.condition:
+            if priority == AcpwOutgoingQueue.TELEMETRY:
+                pending = self.pending_queries.get(data[ByteIndex.COMMAND_ID.value])
+                if pending is not None:
+                    self.coalesced_count += 1
+                    return pending[1]
+            entry = (data, Future(), time.monotonic())
+            if priority == AcpwOutgoingQueue.TELEMETRY:
+                self.pending_queries[data[ByteIndex.COMMAND_ID.value]] = entry
+            self.queues[priority].append(entry)
+            self.condition.notify()
+        return entry[1]
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.woken or self.qsize() > 0, timeout) or self.qsize() == 0:
+                self.woken = False
+                raise queue.Empty
+            self.woken = False
+            for priority, entries in enumerate(self.queues):
+                if len(entries) > 0:
+                    break
+            data, future, enqueue_time = entries.popleft()
+            if priority == AcpwOutgoingQueue.TELEMETRY:
+                del self.pending_queries[data[ByteIndex.COMMAND_ID.value]]
+            wait_time = time.monotonic() - enqueue_time
+            self.dequeued_count[priority] += 1
+            self.wait_time_total[priority] += wait_time
+            self.wait_time_max[priority] = max(self.wait_time_max[priority], wait_time)
+            self.wait_histogram.add(wait_time)
+        return data, future
+
+    def qsize(self):
+        return sum(len(entries) for entries in self.queues)
+
+    def get_metrics(self):
+        with self.condition:
+            metrics = {"coalesced": self.coalesced_count, "waitHistogram": self.wait_histogram.as_dict()}
+            for priority, name in enumerate(AcpwOutgoingQueue.names):
+                count = self.dequeued_count[priority]
+                metrics[name] = {
+                    "depth": len(self.queues[priority]),
+                    "sent": count,
+                    "waitAvgMs": round(self.wait_time_total[priority] * 1000 / count, 1) if count else 0,
+                    "waitMaxMs": round(self.wait_time_max[priority] * 1000, 1)
+                }
+        return metrics
+
+
+class AcpwLinkSupervisor(object):
+    """Owns the ACPW serial port.
+
+    The port is opened with exponential backoff, an idle link is probed, and
+    the port is reopened when ACPW stops answering. Reader and writer threads
+    live as long as the process and wait here while the link is down.
+    """
+    reopen_delay_min = 1.0  # Seconds
+    reopen_delay_max = 60.0  # Seconds
+    probe_interval = 30.0  # Seconds without traffic from ACPW before a probe is sent
+    response_timeout = 120.0  # Seconds without an answer to sent frames before the port is reopened
+    check_interval = 1.0  # Seconds
+
+    def __init__(self, port_name, baud_rate, probe=None, opened=None):
+        self.port_name = port_name
+        self.baud_rate = baud_rate
+        self.probe = probe
+        self.opened = opened
+        self.port = serial.Serial()
+        self.generation = 0
+        self.link_up = threading.Event()
+        self.lock = threading.Lock()
+        self.reopen_delay = 0.0
+        self.last_received_time = time.monotonic()
+        self.last_probe_time = 0.0
+        self.unanswered_since = None
+        self.down_since = time.monotonic()
+        self.down_reason = "not opened"
+        self.reconnect_count = 0
+        self.downtime_total = 0.0
+        self.last_recovery_time = None
+
+    def start(self):
+        supervisor_thread = threading.Thread(target=self._supervise, daemon=True)
+        supervisor_thread.start()
+
+    def wait_for_port(self, timeout=None):
+        if not self.link_up.wait(timeout):
+            return None, None
+        with self.lock:
+            return self.port, self.generation
+
+    def report_received(self):
+        self.last_received_time = time.monotonic()
+        self.unanswered_since = None
+        self.reopen_delay = 0.0
+
+    def report_sent(self):
+        if self.unanswered_since is None:
+            self.unanswered_since = time.monotonic()
+
+    def report_error(self, generation, reason):
+        with self.lock:
+            if generation != self.generation or not self.link_up.is_set():
+                return False
+            self._close(reason)
+        return True
+
+    def get_metrics(self):
+        now = time.monotonic()
+        with self.lock:
+            up = self.link_up.is_set()
+            return {
+                "port": self.port_name,
+                "up": up,
+                "downReason": None if up else self.down_reason,
+                "reconnects": self.reconnect_count,
+                "downtimeS": round(self.downtime_total + (0 if up else now - self.down_since), 1),
+                "lastTimeToRecoverS": None if self.last_recovery_time is None else round(self.last_recovery_time, 1),
+                "sinceLastReceiveS": round(now - self.last_received_time, 1)
+            }
+
+    def _close(self, reason):
+        logger.info("ACPW link down: {0}".format(reason))
+        self.link_up.clear()
+        self.down_since = time.monotonic()
+        self.down_reason = reason
+        try:
+            # Wake a reader blocked in select() on the old port
+            self.port.cancel_read()
+        except:
+            pass
+        try:
+            self.port.close()
+        except:
+            pass
+
+    def _open(self):
+        port = serial.Serial(self.port_name, self.baud_rate, timeout=AcpwMessageHandler.serial_read_timeout)
+        with self.lock:
+            now = time.monotonic()
+            downtime = now - self.down_since
+            if self.generation > 0:
+                self.reconnect_count += 1
+                self.downtime_total += downtime
+                self.last_recovery_time = downtime
+            self.port = port
+            self.generation += 1
+            self.last_received_time = now
+            self.unanswered_since = None
+            if self.opened is not None:
+                self.opened()
+            self.link_up.set()
+        logger.info("ACPW link up on {0} after {1:.1f} s".format(self.port_name, downtime))
+
+    def _back_off(self):
+        self.reopen_delay = min(max(self.reopen_delay * 2, AcpwLinkSupervisor.reopen_delay_min),
+                                AcpwLinkSupervisor.reopen_delay_max)
+
+    def _supervise(self):
+        while True:
+            try:
+                if not self.link_up.is_set():
+                    time.sleep(self.reopen_delay)
+                    try:
+                        self._open()
+                    except:
+                        self._back_off()
+                        logger.info("Cannot open acpw serial {0}, retrying in {1:.0f} s".format(
+                            self.port_name, self.reopen_delay))
+                    continue
+
+                now = time.monotonic()
+                unanswered_since = self.unanswered_since
+                if unanswered_since is not None and now - unanswered_since > AcpwLinkSupervisor.response_timeout:
+                    with self.lock:
+                        self._close("no response for {0:.0f} s".format(now - unanswered_since))
+                    self._back_off()
+                    continue
+
+                if self.probe is not None and \
+                        now - self.last_received_time > AcpwLinkSupervisor.probe_interval and \
+                        now - self.last_probe_time > AcpwLinkSupervisor.probe_interval:
+                    self.last_probe_time = now
+                    self.probe()
+            except:
+                logger.info("ACPW link supervisor error {0}".format(traceback.format_exc()))
+            time.sleep(AcpwLinkSupervisor.check_interval)
+
+
+class InFlightCommand(object):
+    __slots__ = ("frame", "future", "timeout", "message_id", "name", "attempts", "deadline")
+
+    def __init__(self, frame, future, timeout):
+        self.frame = frame
+        self.future = future
+        self.timeout = timeout
+        self.message_id = frame[ByteIndex.MESSAGE_ID_SEND.value]
+        self.name = AcpwCommandId(frame[ByteIndex.COMMAND_ID.value]).name
+        self.attempts = 1
+        self.deadline = time.monotonic() + timeout
 
 
 def get_peripheral_data():
@@ -5067,17 +5459,13 @@ def get_peripheral_data():
         except:
             logger.info("iccid read error: {0}".format(traceback.format_exc()))
 
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
-        query = "INSERT INTO hmiDetails (ID, imei, imsi, iccid )" \
-                "SELECT {0}, '{1}', '{2}', '{3}'" \
-                "WHERE NOT EXISTS (SELECT 1 FROM hmiDetails WHERE ID={0});". \
-            format(1, imei, imsi, iccid)
-        cursor.execute(query)
-        query = "UPDATE hmiDetails SET imei='{0}', imsi='{1}', iccid='{2}' WHERE ID=1;".format(imei, imsi, iccid)
-        cursor.execute(query)
-        conn.commit()
-        conn.close()
+        with agent_database.transaction() as cursor:
+            query = "INSERT INTO hmiDetails (ID, imei, imsi, iccid )" \
+                    "SELECT 1, ?, ?, ? " \
+                    "WHERE NOT EXISTS (SELECT 1 FROM hmiDetails WHERE ID=1);"
+            cursor.execute(query, (str(imei), str(imsi), str(iccid)))
+            query = "UPDATE hmiDetails SET imei=?, imsi=?, iccid=? WHERE ID=1;"
+            cursor.execute(query, (str(imei), str(imsi), str(iccid)))
 
 
 def wifiExists():
@@ -0,0 +1,64 @@
+import logging
+import threading
+
+logger = logging.getLogger("EVC04_Agent.configuration_cache")
+
+
+class ConfigurationCache(object):
+    """Read-through cache of configuration values the agent reads on hot paths.
+
+    Each key is registered with a loader that reads the value from its
+    database. The first get() calls the loader and later ones return the
+    stored value until the key is invalidated. Whoever writes a cached value
+    updates it with set() or drops it with invalidate(), and a
+    CONFIGURATION_UPDATE from webconfig invalidates everything.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaders = {}
+        self.values = {}
+        self.hits = {}
+        self.misses = {}
+        self.invalidations = 0
+
+    def register(self, key, loader):
+        with self.lock:
+            self.loaders[key] = loader
+            self.values.pop(key, None)
+            self.hits.setdefault(key, 0)
+            self.misses.setdefault(key, 0)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.values:
+                self.hits[key] += 1
+                return self.values[key]
+            self.misses[key] += 1
+            # a failing loader raises to the caller and leaves the key unloaded
+            value = self.loaders[key]()
+            self.values[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+            self.invalidations += 1
+
+    def get_statistics(self):
+        with self.lock:
+            return {
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "invalidations": self.invalidations
+            }
+
+
+configuration_cache = ConfigurationCache()
@@ -5,6 +5,8 @@ import subprocess
 import signal
 import ipaddress
 from definitions import MessageTypes, Requester
+from database import get_database, copy_database, copy_shared_columns, migrate_database, remove_database_files
+from configuration_cache import configuration_cache
 import sqlite3
 import threading
 import time
@@ -31,6 +33,22 @@ VFACTORY_DATABASE = "/run/media/mmcblk1p3/vfactory.db"
 
 logger = logging.getLogger("EVC04_Agent.configuration_manager")
 
+agent_database = get_database(AGENT_DATABASE, wal=True)
+
+
+def load_authorization_mode():
+    conn = sqlite3.connect(WEBCONFIG_DATABASE, timeout=10.0)
+    cursor = conn.cursor()
+    query = "SELECT id, mode, localList FROM authorizationMode;"
+    cursor.execute(query)
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return row
+
+
+configuration_cache.register("authorizationMode", load_authorization_mode)
+
 
 class ConfigurationManager(Requester):
     DIP_SW_OFF = 1
@@ -131,14 +149,7 @@ class ConfigurationManager(Requester):
             pass
 
     def apply_authentication_settings(self):
-        conn = sqlite3.connect(WEBCONFIG_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
-        query = "SELECT id, mode, localList FROM authorizationMode;"
-        cursor.execute(query)
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
-
+        row = configuration_cache.get("authorizationMode")
         if row is not None:
             self.mediator.send(row, self, MessageTypes.AUTHORIZATION_TYPE)
 
@@ -321,12 +332,10 @@ class ConfigurationManager(Requester):
                         traceback.format_exc()))
         connection_webconfig.commit()
         connection_webconfig.close()
+        configuration_cache.invalidate("authorizationMode")
 
     def create_new_database(self, newFileName, oldFileName):
-        new_db = sqlite3.connect(newFileName, timeout=10.0)
-        old_db = sqlite3.connect(oldFileName, timeout=10.0)
-        query = "".join(line for line in old_db.iterdump())
-        new_db.executescript(query)
+        copy_database(oldFileName, newFileName)
 
     def check_db_versions(self):
         conn = sqlite3.connect(WEBCONFIG_DATABASE_DEFAULT, timeout=10.0)
@@ -368,80 +377,28 @@ class ConfigurationManager(Requester):
             connection.close()
         return version
 
-    def create_database_ddl(self, dbName):
-        con = sqlite3.connect(dbName, timeout=10.0)
-        db = con.cursor()
-        with open('/var/lib/vestel/dump.ddl', 'w') as f:
-            for line in con.iterdump():
-                if "CREATE TABLE" not in line:
-                    if "dbInfo" not in line:
-                        if "sqlite_sequence" not in line:
-                            if line.startswith("INSERT INTO"):
-                                line = str(line).replace(
-                                    "INSERT INTO", "INSERT OR REPLACE INTO")
-                                stat = line.split('"')
-                                if len(stat) > 1:
-                                    table = stat[1]
-                                    selectStmt = "SELECT * FROM %s" % table
-                                    db.execute(selectStmt)
-                                    columnNames = [description[0]
-                                                   for description in db.description]
-                                    if columnNames is not None:
-                                        columnList = ', '.join(columnNames)
-                                        columnList = "( " + columnList + " )"
-                                    table = '"' + table + '"'
-                                    columnList = table + columnList
-                                    line = line.replace(table, columnList)
-                                    f.write('%s\n' % line)
-        f.close()
-        db.close()
-        con.close()
-
     def initiate_agent_database(self):
         recreate_db = False
         try:
-            connection_agent = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-            db = connection_agent.cursor()
-            db.execute("SELECT * from deviceDetails")
-            db.close()
-            connection_agent.close()
+            agent_database.fetchone("SELECT * from deviceDetails")
         except:
             recreate_db = True
             logger.info("recreating agent db")
 
         if not os.path.exists(AGENT_DATABASE) or recreate_db:
+            # a WAL file left next to a missing or broken database must not be replayed into the new one
+            remove_database_files(AGENT_DATABASE)
             self.create_new_database(AGENT_DATABASE, AGENT_DATABASE_DEFAULT)
         else:
             try:
-                connection_agent = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                db = connection_agent.cursor()
-                db.execute("SELECT * from dbInfo")
-                db.close()
-                connection_agent.close()
-                old_version = self.get_database_version(AGENT_DATABASE)
+                old_version = agent_database.fetchone("SELECT dbVersion FROM dbInfo WHERE id=1")
             except:
                 old_version = ""
 
             new_version = self.get_database_version(AGENT_DATABASE_DEFAULT)
             if old_version == "" or new_version > old_version:
                 try:
-                    self.create_database_ddl(AGENT_DATABASE)
-                    cmd = "rm " + str(AGENT_DATABASE)
-                    os.system(cmd)
-                    self.create_new_database(
-                        AGENT_DATABASE, AGENT_DATABASE_DEFAULT)
-                    conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-                    c = conn.cursor()
-                    f = open("/var/lib/vestel/dump.ddl", "r")
-                    sql = f.readlines()
-                    for statement in sql:
-                        try:
-                            c.executescript(statement)
-                        except sqlite3.Error as err:
-                            logger.info(err)
-                    c.close()
-                    conn.close()
-                    os.system("rm /var/lib/vestel/dump.ddl")
+                    migrate_database(AGENT_DATABASE, AGENT_DATABASE_DEFAULT)
                 except sqlite3.Error as err:
                     logger.info(err)
 
@@ -467,20 +424,7 @@ class ConfigurationManager(Requester):
                     if os.path.exists(WEBCONFIG_VFACTORY_DATABASE):
                         if self.check_db_versions():
                             try:
-                                self.create_database_ddl(
-                                    WEBCONFIG_VFACTORY_DATABASE)
-                                conn = sqlite3.connect(WEBCONFIG_DATABASE, timeout=10.0)
-                                c = conn.cursor()
-                                f = open('/var/lib/vestel/dump.ddl', 'r')
-                                sql = f.readlines()
-                                for statement in sql:
-                                    try:
-                                        c.executescript(statement)
-                                    except sqlite3.Error as err:
-                                        logger.info(err)
-                                c.close()
-                                conn.close()
-                                os.system("rm /var/lib/vestel/dump.ddl")
+                                copy_shared_columns(WEBCONFIG_DATABASE, WEBCONFIG_VFACTORY_DATABASE)
                             except sqlite3.Error as err:
                                 logger.info(err)
                         else:
@@ -502,23 +446,7 @@ class ConfigurationManager(Requester):
             else:
                 if new_version > old_version:
                     try:
-                        self.create_database_ddl(WEBCONFIG_DATABASE)
-                        cmd = "rm " + str(WEBCONFIG_DATABASE)
-                        os.system(cmd)
-                        self.create_new_database(
-                            WEBCONFIG_DATABASE, WEBCONFIG_DATABASE_DEFAULT)
-                        conn = sqlite3.connect(WEBCONFIG_DATABASE, timeout=10.0)
-                        c = conn.cursor()
-                        f = open("/var/lib/vestel/dump.ddl", "r")
-                        sql = f.readlines()
-                        for statement in sql:
-                            try:
-                                c.executescript(statement)
-                            except sqlite3.Error as err:
-                                logger.info(err)
-                        c.close()
-                        conn.close()
-                        os.system("rm /var/lib/vestel/dump.ddl")
+                        migrate_database(WEBCONFIG_DATABASE, WEBCONFIG_DATABASE_DEFAULT)
                     except sqlite3.Error as err:
                         logger.info(err)
 
@@ -538,34 +466,26 @@ class ConfigurationManager(Requester):
         gpio_controller.export_gpio_pin(56)
         gpio_controller.export_gpio_pin(55)
 
-        conn = sqlite3.connect(AGENT_DATABASE, timeout=10.0)
-        cursor = conn.cursor()
         query = "SELECT * FROM dipSwitch;"
-        cursor.execute(query)
-        row = cursor.fetchone()
+        row = agent_database.fetchone(query)
         if row is not None:
             id, dip1, dip2, dip3, dip4, dip5, dip6 = row
             self.dip_master_configuration = dip1
             self.dip_static_ip = dip2
             if self.dip_master_configuration != gpio_controller.read_gpio_pin(57):
                 self.dip_master_configuration = gpio_controller.read_gpio_pin(57)
-                query = "UPDATE dipSwitch SET dip1={} WHERE ID=1".format(
-                    self.dip_master_configuration)
-                cursor.execute(query)
+                query = "UPDATE dipSwitch SET dip1=? WHERE ID=1"
+                agent_database.execute(query, (self.dip_master_configuration,))
                 logger.info("master card dip switch toggled")
                 self.waiting_for_master_addition = True
 
             if self.dip_static_ip != gpio_controller.read_gpio_pin(56):
                 self.dip_static_ip = gpio_controller.read_gpio_pin(56)
-                query = "UPDATE dipSwitch SET dip2={} WHERE ID=1".format(
-                    self.dip_static_ip)
-                cursor.execute(query)
+                query = "UPDATE dipSwitch SET dip2=? WHERE ID=1"
+                agent_database.execute(query, (self.dip_static_ip,))
                 logger.info("static ip dip switch toggled")
                 self.force_for_static_ip = True
 
-        conn.commit()
-        conn.close()
-
         self.dip_webconfig_disable = gpio_controller.read_gpio_pin(55)
 
     def apply_settings(self):
@@ -575,6 +495,8 @@ class ConfigurationManager(Requester):
     def get_message(self, message, message_type):
         message = json.loads(message)
         if message_type == MessageTypes.CONFIGURATION_UPDATE:
+            # webconfig changed the databases behind the agent's back
+            configuration_cache.invalidate()
             if message["type"] == "authenticationUpdate":
                 self.apply_authentication_settings()
             elif message["type"] == "generalUpdate":
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# ACPW crc backends, binascii.crc_hqx against the lookup table it replaced. Every
+# length from 0 to 1024 and whole OTA data frames are compared on random data
+# before anything is timed:
+#
+#   python3 crc_benchmark.py --number 10000 --seed 1
+
+import argparse
+import random
+import timeit
+
+import acpw_protocol
+from definitions import AcpwCommandId
+
+OTA_PACKET_SIZE = 512  # OtaManager.ACPW_OTA_PACKET_SIZE
+SIZES = (9, 64, 522, 1024)
+
+
+def random_bytes(generator, size):
+    return bytes(generator.getrandbits(8) for _ in range(size))
+
+
+def check_backends(generator, rounds):
+    """Compares every backend with the table one, returns the number of inputs checked."""
+    backends = sorted(acpw_protocol.CRC_BACKENDS.items())
+    checked = 0
+    for _ in range(rounds):
+        inputs = [random_bytes(generator, size) for size in range(acpw_protocol.MAX_FRAME_SIZE + 1)]
+        # an OTA data frame is checked the way the receiver does it, over the frame without start, crc and stop
+        builder = acpw_protocol.FrameBuilder(1 + OTA_PACKET_SIZE)
+        frame = builder.build(generator.randint(1, 255), AcpwCommandId.OTA_DATA.value,
+                              (bytes((generator.randint(0, 255),)), random_bytes(generator, OTA_PACKET_SIZE)))
+        inputs.append(frame[1:-3])
+        for data in inputs:
+            expected = acpw_protocol.crc_ccitt_table(data)
+            for name, crc_function in backends:
+                if crc_function(data) != expected:
+                    raise SystemExit("{0} crc of {1} bytes differs: {2:#06x} != {3:#06x}".format(
+                        name, len(data), crc_function(data), expected))
+                if crc_function(memoryview(data)) != expected:
+                    raise SystemExit("{0} crc of a {1} byte memoryview differs".format(name, len(data)))
+            checked += 1
+        if not acpw_protocol.check_frame_crc(frame):
+            raise SystemExit("OTA frame crc check failed")
+    return checked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ACPW crc backend benchmark")
+    parser.add_argument("--number", type=int, default=10000, help="crc calculations per size and backend")
+    parser.add_argument("--rounds", type=int, default=3, help="random rounds of the property check")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the property check")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    checked = check_backends(random.Random(seed), args.rounds)
+    print("{0} inputs identical across backends (seed {1})".format(checked, seed))
+
+    backends = sorted(acpw_protocol.CRC_BACKENDS.items())
+    print("{0:<8}".format("bytes") + "".join("{0:>14}".format(name + " us") for name, _ in backends))
+    generator = random.Random(seed)
+    for size in SIZES:
+        data = random_bytes(generator, size)
+        timings = [timeit.timeit(lambda: crc_function(data), number=args.number) for _, crc_function in backends]
+        print("{0:<8}".format(size) + "".join("{0:>14.2f}".format(t * 1e6 / args.number) for t in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import contextlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+
+logger = logging.getLogger("EVC04_Agent.database")
+
+
+class Database(object):
+    """One long-lived connection to a SQLite file, shared by all agent threads.
+
+    Statements are serialized with a lock and always take their values as
+    parameters, so sqlite3 can reuse the prepared statement from its cache.
+    Writes made with commit=False join the open transaction and are committed
+    together by a flusher thread within commit_interval, which turns frequent
+    periodic updates into one commit instead of one per statement.
+    """
+    timeout = 10.0  # Seconds to wait for a lock held by another process
+    commit_interval = 1.0  # Seconds a batched write may wait for its commit
+
+    def __init__(self, path, wal=False):
+        self.path = path
+        self.wal = wal
+        self.connection = None
+        self.lock = threading.RLock()
+        self.flush_event = threading.Event()
+        self.flush_thread = None
+        self.statement_count = 0
+        self.commit_count = 0
+        self.pending_writes = 0
+
+    def fetchone(self, query, parameters=()):
+        with self.lock:
+            return self._execute(query, parameters).fetchone()
+
+    def fetchall(self, query, parameters=()):
+        with self.lock:
+            return self._execute(query, parameters).fetchall()
+
+    def execute(self, query, parameters=(), commit=True):
+        with self.lock:
+            rowcount = self._execute(query, parameters).rowcount
+            self._written(commit)
+            return rowcount
+
+    def executemany(self, query, parameters_list, commit=True):
+        with self.lock:
+            connection = self._connect()
+            self.statement_count += 1
+            try:
+                rowcount = connection.executemany(query, parameters_list).rowcount
+            except sqlite3.DatabaseError:
+                self._reset_on_error()
+                raise
+            self._written(commit)
+            return rowcount
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the statements of the block as one transaction on a cursor."""
+        with self.lock:
+            # keep batched writes of other threads out of a rollback of this block
+            self.commit()
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            except:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+            self.statement_count += 1
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.connection is not None and self.connection.in_transaction:
+                self.connection.commit()
+                self.commit_count += 1
+            self.pending_writes = 0
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                try:
+                    self.commit()
+                finally:
+                    self.connection.close()
+                    self.connection = None
+
+    def get_statistics(self):
+        with self.lock:
+            return {
+                "statements": self.statement_count,
+                "commits": self.commit_count,
+                "pendingWrites": self.pending_writes
+            }
+
+    def _connect(self):
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            if self.wal:
+                connection.execute("PRAGMA journal_mode=WAL")
+                # every commit syncs the WAL, so a committed session stop survives a power cut
+                connection.execute("PRAGMA synchronous=FULL")
+            self.connection = connection
+        return self.connection
+
+    def _execute(self, query, parameters):
+        connection = self._connect()
+        self.statement_count += 1
+        try:
+            return connection.execute(query, parameters)
+        except sqlite3.DatabaseError:
+            self._reset_on_error()
+            raise
+
+    def _reset_on_error(self):
+        # a broken or replaced database file is reopened by the next statement
+        if not isinstance(self.connection, sqlite3.Connection):
+            return
+        try:
+            self.connection.close()
+        except sqlite3.Error:
+            pass
+        self.connection = None
+        self.pending_writes = 0
+
+    def _written(self, commit):
+        if commit:
+            self.commit()
+            return
+        self.pending_writes += 1
+        if self.flush_thread is None:
+            self.flush_thread = threading.Thread(target=self._flush_pending_writes, daemon=True)
+            self.flush_thread.start()
+        self.flush_event.set()
+
+    def _flush_pending_writes(self):
+        while True:
+            self.flush_event.wait()
+            time.sleep(self.commit_interval)
+            self.flush_event.clear()
+            try:
+                self.commit()
+            except:
+                logger.info("Database commit error {0}: {1}".format(self.path, traceback.format_exc()))
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path, wal=False):
+    with _databases_lock:
+        database = _databases.get(path)
+        if database is None:
+            database = Database(path, wal)
+            _databases[path] = database
+        return database
+
+
+def remove_database_files(path):
+    """Deletes a database file together with its journal, WAL and shared memory files."""
+    with _databases_lock:
+        database = _databases.get(path)
+    if database is not None:
+        database.close()
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def copy_database(source, destination):
+    """Copies a database page by page, with the backup API where sqlite3 provides it."""
+    source_connection = sqlite3.connect(source, timeout=Database.timeout)
+    if not hasattr(source_connection, "backup"):
+        # the default databases are never written, so a copy of the file is consistent
+        source_connection.close()
+        shutil.copyfile(source, destination)
+        return
+    destination_connection = sqlite3.connect(destination, timeout=Database.timeout)
+    try:
+        source_connection.backup(destination_connection)
+    finally:
+        destination_connection.close()
+        source_connection.close()
+
+
+def _table_columns(cursor, schema, table):
+    cursor.execute("PRAGMA {0}.table_info(\"{1}\")".format(schema, table))
+    return [row[1] for row in cursor.fetchall()]
+
+
+def copy_shared_columns(destination, source, skip_tables=("dbInfo",)):
+    """Copies the rows of every table of source that destination also has.
+
+    Only the columns both tables share are copied, one INSERT ... SELECT per
+    table, and all tables in one transaction. Rows with the same key replace
+    the ones already in destination.
+    """
+    connection = sqlite3.connect(destination, timeout=Database.timeout)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("ATTACH DATABASE ? AS source", (source,))
+        cursor.execute("SELECT name FROM main.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")
+        tables = [row[0] for row in cursor.fetchall() if row[0] not in skip_tables]
+        copied_rows = 0
+        for table in tables:
+            source_columns = set(_table_columns(cursor, "source", table))
+            columns = [column for column in _table_columns(cursor, "main", table) if column in source_columns]
+            if not columns:
+                continue
+            column_list = ", ".join("\"{0}\"".format(column) for column in columns)
+            query = "INSERT OR REPLACE INTO main.\"{0}\" ({1}) SELECT {1} FROM source.\"{0}\"".format(
+                table, column_list)
+            try:
+                cursor.execute(query)
+                copied_rows += cursor.rowcount
+            except sqlite3.Error as e:
+                logger.info("Table {0} could not be copied: {1}".format(table, e))
+        connection.commit()
+        cursor.execute("DETACH DATABASE source")
+        cursor.close()
+        logger.info("{0} rows of {1} tables copied from {2} to {3}".format(
+            copied_rows, len(tables), source, destination))
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def migrate_database(path, default_path):
+    """Replaces a database with a copy of its default, keeping the data of the columns both share."""
+    new_path = path + ".new"
+    remove_database_files(new_path)
+    try:
+        copy_database(default_path, new_path)
+        with _databases_lock:
+            database = _databases.get(path)
+        if database is not None:
+            database.close()
+        copy_shared_columns(new_path, path)
+        # the old WAL must not be replayed into the migrated file
+        for suffix in ("-journal", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+        os.replace(new_path, path)
+    finally:
+        remove_database_files(new_path)
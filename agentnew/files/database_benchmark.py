@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Write latency and commit rate of the periodic agent.db updates, connection per
+# statement against the shared WAL connection of database.py:
+#
+#   python3 database_benchmark.py --database agent.db --minutes 1 --speedup 10
+#
+# Run it under strace to count the syncs each mode costs on the target flash:
+#
+#   strace -f -c -e trace=fsync,fdatasync python3 database_benchmark.py --mode legacy
+#   strace -f -c -e trace=fsync,fdatasync python3 database_benchmark.py --mode shared
+
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import database
+
+CHARGE_POINT_INTERVAL = 0.5  # Seconds, ChargePoint.update_charge_points_database
+CHARGE_SESSION_INTERVAL = 1.0  # Seconds, ChargeSession._update_database
+
+CHARGE_POINT_QUERY = "UPDATE chargePoints SET voltageP1=?, currentP1=?, activePowerP1=?, " \
+                     "activeEnergyP1=?, lastUpdate=? WHERE chargePointId=1;"
+CHARGE_SESSION_QUERY = "UPDATE activeChargeSession SET lastEnergy=?, stopTime=? WHERE sessionUuid=?;"
+SESSION_UUID = "benchmark-session"
+
+
+class LegacyWriter(object):
+    # connect, execute, commit and close for every statement, as agent.py did
+    def __init__(self, path):
+        self.path = path
+        self.commits = 0
+
+    def write(self, query, parameters):
+        conn = sqlite3.connect(self.path, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute(query, parameters)
+        conn.commit()
+        conn.close()
+        self.commits += 1
+
+    def close(self):
+        pass
+
+
+class SharedWriter(object):
+    def __init__(self, path, commit_interval):
+        self.database = database.Database(path, wal=True)
+        self.database.commit_interval = commit_interval
+
+    @property
+    def commits(self):
+        return self.database.get_statistics()["commits"]
+
+    def write(self, query, parameters):
+        self.database.execute(query, parameters, commit=False)
+
+    def close(self):
+        self.database.close()
+
+
+def _periodic(writer, query, make_parameters, interval, stop, latencies, lock):
+    step = 0
+    while not stop.is_set():
+        start = time.monotonic()
+        writer.write(query, make_parameters(step))
+        elapsed = time.monotonic() - start
+        with lock:
+            latencies.append(elapsed)
+        step += 1
+        stop.wait(max(0, interval - elapsed))
+
+
+def run(mode, path, minutes, speedup):
+    if mode == "legacy":
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        writer = LegacyWriter(path)
+    else:
+        writer = SharedWriter(path, database.Database.commit_interval / speedup)
+    conn = sqlite3.connect(path)
+    conn.execute("DELETE FROM activeChargeSession")
+    conn.execute("INSERT INTO activeChargeSession (sessionUuid, authorizationUid, startTime, status, chargePointId, "
+                 "initialEnergy, lastEnergy) VALUES (?, 'benchmark', 0, 'Charging', 1, 0, 0)", (SESSION_UUID,))
+    conn.commit()
+    conn.close()
+
+    stop = threading.Event()
+    latencies = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=_periodic, daemon=True, args=(
+            writer, CHARGE_POINT_QUERY, lambda step: (230000 + step % 7, 16000, 3680, step * 10, int(time.time())),
+            CHARGE_POINT_INTERVAL / speedup, stop, latencies, lock)),
+        threading.Thread(target=_periodic, daemon=True, args=(
+            writer, CHARGE_SESSION_QUERY, lambda step: (step * 10, int(time.time()), SESSION_UUID),
+            CHARGE_SESSION_INTERVAL / speedup, stop, latencies, lock))
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(minutes * 60 / speedup)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    writer.close()
+
+    latencies.sort()
+    count = len(latencies)
+    print("{0:<8} writes {1:>6}  mean {2:>8.3f} ms  p99 {3:>8.3f} ms  max {4:>8.3f} ms  commits/min {5:>8.1f}".format(
+        mode, count, sum(latencies) * 1000 / count, latencies[min(count - 1, int(count * 0.99))] * 1000,
+        latencies[-1] * 1000, writer.commits / minutes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="agent.db write benchmark")
+    parser.add_argument("--database", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.db"),
+                        help="agent.db to copy the schema from")
+    parser.add_argument("--mode", choices=("legacy", "shared", "both"), default="both")
+    parser.add_argument("--minutes", type=float, default=1, help="simulated minutes of updates")
+    parser.add_argument("--speedup", type=float, default=1, help="divides every interval by this factor")
+    args = parser.parse_args()
+
+    modes = ("legacy", "shared") if args.mode == "both" else (args.mode,)
+    for mode in modes:
+        directory = tempfile.mkdtemp(prefix="agent_db_benchmark_")
+        try:
+            path = os.path.join(directory, "agent.db")
+            shutil.copyfile(args.database, path)
+            run(mode, path, args.minutes, args.speedup)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
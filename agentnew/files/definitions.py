@@ -41,7 +41,7 @@ class Requester(metaclass=Singleton):
 class Mediator(ABC):
 
     @abstractmethod
-    def send(self, message, requester, target):
+    def send(self, message, requester, target, identity=None):
         pass
 
 
@@ -92,6 +92,7 @@ class MessageTypes(Enum):
     DLM_METERING_DATA = 43
     CONTINUE_AFTER_ECO_CHARGE = 44
     CONTINUE_AFTER_POWER_OFF = 45
+    DIAGNOSTICS = 46
 
 
 class Dealer(Enum):
@@ -342,6 +343,18 @@ class BluetoothInterfaceError(Exception):
     pass
 
 
+class AcpwCommandError(Exception):
+    pass
+
+
+class OtaCancelledError(Exception):
+    pass
+
+
+class DownloadError(Exception):
+    pass
+
+
 class Status(Enum):
     ENABLED = "Enabled"
     DISABLED = "Disabled"
@@ -354,6 +367,7 @@ class MeterType(Enum):
 
 
 class OtaStatus(Enum):
+    PREPARING = "Preparing"
     OSTREE = "Ostree"
     ACPW = "Acpw"
 
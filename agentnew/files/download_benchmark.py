@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# RangeDownloader of http_downloader.py against a local http.server stand-in for
+# the OTA file server. The resume, parallel range and no range fallback paths are
+# checked on random data before the connection counts are timed:
+#
+#   python3 download_benchmark.py --size 3 --connections 4
+
+import argparse
+import hashlib
+import http.server
+import os
+import random
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+
+import http_downloader
+from definitions import DownloadError
+
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class FileServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data):
+        super().__init__(("127.0.0.1", 0), FileRequestHandler)
+        self.data = data
+        self.ranges = True  # False answers every request with the whole file, like a server without range support
+        self.drop_after = None  # Bytes sent before the next response is cut off
+        self.throttle = 0  # Seconds to sleep after every chunk sent
+        self.requests = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/update.bin".format(self.server_address[1])
+
+
+class FileRequestHandler(http.server.BaseHTTPRequestHandler):
+    chunk_size = 16 * 1024
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        data = server.data
+        # taken before the headers go out, a client that has them knows whether its response is cut off
+        drop_after, server.drop_after = server.drop_after, None
+        match = RANGE_PATTERN.match(self.headers.get("Range", ""))
+        if server.ranges and match is not None:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            end = min(end, len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, len(data)))
+        else:
+            start, end = 0, len(data) - 1
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", '"{0}"'.format(hashlib.sha256(data).hexdigest()[:16]))
+        self.end_headers()
+
+        position = start
+        while position <= end:
+            size = min(self.chunk_size, end + 1 - position)
+            if drop_after is not None:
+                if drop_after <= 0:
+                    return
+                size = min(size, drop_after)
+                drop_after -= size
+            self.wfile.write(data[position:position + size])
+            position += size
+            if server.throttle:
+                time.sleep(server.throttle)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def download(server, directory, connections):
+    location = os.path.join(directory, "update.bin")
+    downloader = http_downloader.RangeDownloader(server.url, location, connections)
+    return downloader, downloader.download(), location
+
+
+def check(name, condition):
+    if not condition:
+        raise SystemExit("{0} failed".format(name))
+    print("{0:<24} ok".format(name))
+
+
+def check_paths(server, directory):
+    expected = hashlib.sha256(server.data).hexdigest()
+
+    for connections in (1, 4):
+        downloader, digest, location = download(server, directory, connections)
+        with open(location, "rb") as f:
+            check("ranges x{0}".format(connections), digest == expected and f.read() == server.data)
+        os.remove(location)
+
+    server.ranges = False
+    downloader, digest, location = download(server, directory, 4)
+    check("no range fallback", digest == expected and downloader.size is None and
+          os.path.getsize(location) == len(server.data))
+    os.remove(location)
+    server.ranges = True
+
+    for connections in (1, 4):
+        # the first ranged response is cut off halfway, the second download has to go on from the saved state
+        location = os.path.join(directory, "update.bin")
+        downloader = http_downloader.RangeDownloader(server.url, location, connections)
+        server.drop_after = len(server.data) // (2 * connections)
+        # the probe is one byte, the cut off applies to the first range request after it
+        original_open = downloader._open
+        downloader._open = lambda start, end=None: _drop_after_probe(server, original_open, start, end)
+        try:
+            downloader.download()
+            check("resume x{0}".format(connections), False)
+        except DownloadError:
+            pass
+        check("partial kept x{0}".format(connections), os.path.exists(location + ".part.json"))
+        downloader, digest, location = download(server, directory, connections)
+        check("resume x{0}".format(connections), digest == expected and downloader.resumed_bytes > 0 and
+              downloader.downloaded_bytes < len(server.data))
+        os.remove(location)
+
+    location = os.path.join(directory, "update.bin")
+    open(location + ".part", "wb").close()
+    open(location + ".part.json", "w").close()
+    http_downloader.discard_partial(location)
+    check("discard partial", not os.path.exists(location + ".part") and
+          not os.path.exists(location + ".part.json"))
+
+
+def _drop_after_probe(server, original_open, start, end):
+    if start == 0 and end == 0:
+        drop_after, server.drop_after = server.drop_after, None
+        response = original_open(start, end)
+        server.drop_after = drop_after
+        return response
+    return original_open(start, end)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="resumable HTTP download benchmark")
+    parser.add_argument("--size", type=float, default=3, help="file size in MB")
+    parser.add_argument("--connections", type=int, default=4, help="largest connection count timed")
+    parser.add_argument("--throttle", type=float, default=0.001, help="seconds the server sleeps per 16 KB chunk")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the file contents")
+    args = parser.parse_args()
+
+    generator = random.Random(args.seed)
+    data = bytes(generator.getrandbits(8) for _ in range(int(args.size * 1024 * 1024)))
+    server = FileServer(data)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    directory = tempfile.mkdtemp(prefix="download_benchmark_")
+    try:
+        check_paths(server, directory)
+
+        # a throttled server stands in for a slow link per connection
+        server.throttle = args.throttle
+        connections = 1
+        while connections <= args.connections:
+            start = time.monotonic()
+            downloader, digest, location = download(server, directory, connections)
+            elapsed = time.monotonic() - start
+            os.remove(location)
+            print("connections {0:<3} {1:>8.2f} s {2:>10.2f} MB/s".format(
+                connections, elapsed, len(data) / elapsed / (1024 * 1024)))
+            connections *= 2
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,9 @@ import hashlib
 import base64
 from xml.etree import ElementTree
 import logging
+import http_downloader
+from configuration_cache import configuration_cache
+from database import get_database
 
 VOLTAGE_DIFFERENCE = 10000
 CURRENT_DIFFERENCE = 500
@@ -36,9 +39,22 @@ AGENT_DB_PATH = "/var/lib/vestel/agent.db"
 SYSTEM_DB_PATH = "/usr/lib/vestel/system.db"
 VFACTORY_DB_PATH = "/run/media/mmcblk1p3/vfactory.db"
 SIGNATURE_CERTIFICATE_PATH = "/usr/lib/vestel/signatureCert.crt"
+DOWNLOAD_CONNECTIONS = 1  # Parallel ranges per OTA file download
 
 logger = logging.getLogger("EVC04_Agent.drive_green_manager")
 
+agent_database = get_database(AGENT_DB_PATH, wal=True)
+
+
+def load_job_id():
+    row = agent_database.fetchone("SELECT jobId FROM driveGreen WHERE ID = 1;")
+    if row is None:
+        return None
+    return row[0]
+
+
+configuration_cache.register("driveGreenJobId", load_job_id)
+
 
 class DriveGreenManager(Requester):
     def __init__(self):
@@ -95,12 +111,8 @@ class DriveGreenManager(Requester):
         self.connect_thread.join()
 
     def initialize_status(self):
-        conn = sqlite3.connect(AGENT_DB_PATH)
-        cursor = conn.cursor()
         query = "SELECT status FROM chargePoints;"
-        cursor.execute(query)
-        row = cursor.fetchone()
-        conn.close()
+        row = agent_database.fetchone(query)
         if row is not None:
             self.status = row[0]
 
@@ -518,12 +530,8 @@ class DriveGreenManager(Requester):
             hmiccid = None
             hmiserl = None
 
-            conn = sqlite3.connect(AGENT_DB_PATH)
-            cursor = conn.cursor()
             query = "SELECT hmiDetails.imsi,hmiDetails.iccid,deviceDetails.acpwVersion,deviceDetails.acpwSerialNumber FROM hmiDetails INNER JOIN deviceDetails USING(ID)"
-            cursor.execute(query)
-            records = cursor.fetchall()
-            conn.close()
+            records = agent_database.fetchall(query)
             for row in records:
                 if row[0]:
                     hmiimsi = row[0]
@@ -604,12 +612,8 @@ class DriveGreenManager(Requester):
 
     def read_configurations(self):
         try:
-            conn = sqlite3.connect(AGENT_DB_PATH)
-            cursor = conn.cursor()
             query = "SELECT deviceUuid,userId,accessToken,serverUrl,serverPort,customer,endpoint,port FROM driveGreen WHERE ID=1"
-            cursor.execute(query)
-            records = cursor.fetchall()
-            conn.close()
+            records = agent_database.fetchall(query)
             for row in records:
                 if row[0]:
                     self.device_uuid = row[0]
@@ -651,13 +655,10 @@ class DriveGreenManager(Requester):
 
     def write_configurations(self):
         try:
-            conn = sqlite3.connect(AGENT_DB_PATH)
-            cursor = conn.cursor()
-            query = 'INSERT OR REPLACE INTO driveGreen (ID, deviceUuid, userId, accessToken, serverUrl, serverPort, customer, endpoint, port) VALUES (1,"{}","{}","{}","{}","{}","{}","{}","{}");'.format(
-                self.device_uuid, self.user_id, self.access_token, self.server_url, self.server_port, self.customer, self.endpoint, self.port)
-            cursor.execute(query)
-            conn.commit()
-            conn.close()
+            query = "INSERT OR REPLACE INTO driveGreen (ID, deviceUuid, userId, accessToken, serverUrl, serverPort, customer, endpoint, port) VALUES (1,?,?,?,?,?,?,?,?);"
+            agent_database.execute(query, (self.device_uuid, self.user_id, self.access_token, self.server_url,
+                                           self.server_port, self.customer, self.endpoint, self.port))
+            configuration_cache.invalidate("driveGreenJobId")
 
         except Exception as e:
             logger.info(e)
@@ -852,12 +853,9 @@ class DriveGreenManager(Requester):
                 execution = message["execution"]
                 document = execution["jobDocument"]
                 job_id = execution["jobId"]
-                conn = sqlite3.connect(AGENT_DB_PATH)
-                cursor = conn.cursor()
-                query = 'UPDATE driveGreen SET jobId = "{}" WHERE ID = 1;'.format(job_id)
-                cursor.execute(query)
-                conn.commit()
-                conn.close()
+                query = "UPDATE driveGreen SET jobId = ? WHERE ID = 1;"
+                agent_database.execute(query, (job_id,))
+                configuration_cache.set("driveGreenJobId", job_id)
                 logger.info("Executing job, id: {}".format(job_id))
                 execute_job_thread = Thread(target=self.execute_job , args=((document),))
                 execute_job_thread.start()
@@ -890,27 +888,19 @@ class DriveGreenManager(Requester):
             self.update_job_status()
 
     def download_file(self, url, location):
-        import urllib.request
         tries = 0
         while True:
             try:
-                d = urllib.request.urlopen(url)
-                meta = d.getheaders()
-                server_file_size = 0
-                for item in meta:
-                    if "Content-Length" in item:
-                        server_file_size = item[1]
-                        logger.info("Downloading update file...")
-                        urllib.request.urlretrieve(url, location)
-                        logger.info("Download completed")
-                        local_file_size = os.path.getsize(location)
-                        if int(server_file_size) != int(local_file_size):
-                            raise Exception("File size doesn't match")
-                        return True
+                logger.info("Downloading update file...")
+                # a failed try leaves the partial file behind and the next one resumes it
+                http_downloader.download(url, location, DOWNLOAD_CONNECTIONS)
+                return True
             except Exception as e:
                 logger.info(e)
                 tries = tries + 1
                 if tries == 5:
+                    # the partial file is as large as the whole image, it must not stay on disk
+                    http_downloader.discard_partial(location)
                     return False
                 time.sleep(10)
                 logger.info("Retrying to download update file")
@@ -918,24 +908,20 @@ class DriveGreenManager(Requester):
     def update_job_status(self):
         if self.job_status is not None:
             try:
-                conn = sqlite3.connect(AGENT_DB_PATH)
-                cursor = conn.cursor()
-                query = "SELECT jobId FROM driveGreen;"
-                cursor.execute(query)
-                row = cursor.fetchone()
-                cursor.close()
-                conn.close()
-                job_id = row[0]
-                message = {
-                    "status": self.job_status
-                }
-                message = json.dumps(message)
-                self.client.publishAsync("$aws/things/{}/jobs/{}/update".format(
-                    self.device_uuid, job_id), message, 1, ackCallback=self.puback)
-                logger.info("Job status: {}, {}".format(job_id, self.job_status))
+                job_id = configuration_cache.get("driveGreenJobId")
+                if job_id is None:
+                    logger.info("No job to update status: {}".format(self.job_status))
+                else:
+                    message = {
+                        "status": self.job_status
+                    }
+                    message = json.dumps(message)
+                    self.client.publishAsync("$aws/things/{}/jobs/{}/update".format(
+                        self.device_uuid, job_id), message, 1, ackCallback=self.puback)
+                    logger.info("Job status: {}, {}".format(job_id, self.job_status))
 
-                update_thread = Thread(target=self.update_request)
-                update_thread.start()
+                    update_thread = Thread(target=self.update_request)
+                    update_thread.start()
 
             except Exception as e:
                 logger.info(e)
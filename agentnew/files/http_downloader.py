@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import urllib.error
+import urllib.request
+
+from definitions import DownloadError
+
+logger = logging.getLogger("EVC04_Agent.http_downloader")
+
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class RangeDownloader(object):
+    """Resumable HTTP download into a fixed location.
+
+    Data is written to "<location>.part" and the byte ranges still missing are
+    kept in "<location>.part.json", so a failed download continues where it
+    stopped instead of starting over. With more than one connection the
+    remaining bytes are split into ranges fetched in parallel. The file is
+    hashed with SHA-256 while it streams to disk with a single connection, and
+    in one pass after the transfer with several.
+    """
+    chunk_size = 64 * 1024
+    timeout = 30  # Seconds
+    state_save_interval = 1024 * 1024  # Bytes written between saves of the resume state
+
+    def __init__(self, url, location, connections=1, chunk_size=None, timeout=None):
+        self.url = url
+        self.location = location
+        self.part_location = location + ".part"
+        self.state_location = location + ".part.json"
+        self.connections = max(1, connections)
+        self.chunk_size = chunk_size or RangeDownloader.chunk_size
+        self.timeout = timeout or RangeDownloader.timeout
+        self.size = None
+        self.ranges = []
+        self.lock = threading.Lock()
+        self.digest = None
+        self.resumed_bytes = 0
+        self.downloaded_bytes = 0
+
+    def download(self):
+        """Downloads the file and returns its hex SHA-256 digest."""
+        response = self._open(0, 0)
+        try:
+            size, validator = self._probe(response)
+            if size is None:
+                logger.info("Server does not support ranges, downloading {0} in one piece".format(self.url))
+                self.discard_partial()
+                self.size = None
+                self._stream_whole(response)
+                return self._finish()
+        finally:
+            response.close()
+
+        self.size = size
+        self._load_state(validator)
+        fd = os.open(self.part_location, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._split_ranges()
+            self._save_state(validator, fd)
+            if self.connections == 1 and len(self.ranges) == 1:
+                self.digest = self._hash_file(self.ranges[0][0])
+            remaining = sum(end - start for start, end in self.ranges)
+            logger.info("Downloading {0}: {1} of {2} bytes left over {3} range(s)".format(
+                self.url, remaining, size, len(self.ranges)))
+            self._fetch_ranges(fd, validator)
+        finally:
+            os.close(fd)
+        if self.digest is None:
+            self.digest = self._hash_file(size)
+        return self._finish()
+
+    def _open(self, start, end=None):
+        request = urllib.request.Request(self.url)
+        request.add_header("Range", "bytes={0}-{1}".format(start, "" if end is None else end))
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def _probe(self, response):
+        # a one byte range tells both whether ranges are served and how large the file is
+        if response.status != 206:
+            return None, None
+        match = CONTENT_RANGE_PATTERN.match(response.headers.get("Content-Range", ""))
+        if match is None:
+            return None, None
+        response.read()
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        return int(match.group(3)), validator
+
+    def _load_state(self, validator):
+        self.ranges = []
+        try:
+            with open(self.state_location, "r") as f:
+                state = json.load(f)
+            if state["url"] == self.url and state["size"] == self.size and state["validator"] == validator \
+                    and os.path.exists(self.part_location):
+                self.ranges = [list(item) for item in state["ranges"] if item[0] < item[1]]
+                self.resumed_bytes = self.size - sum(end - start for start, end in self.ranges)
+                logger.info("Resuming download, {0} bytes already on disk".format(self.resumed_bytes))
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.discard_partial()
+        self.ranges = [[0, self.size]]
+
+    def _save_state(self, validator, fd):
+        # the written data has to be on disk before the state that points past it
+        os.fsync(fd)
+        state = {"url": self.url, "size": self.size, "validator": validator, "ranges": self.ranges}
+        with open(self.state_location + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_location + ".tmp", self.state_location)
+
+    def _split_ranges(self):
+        # split the largest missing range until every connection has one
+        minimum = self.chunk_size * 4
+        while len(self.ranges) < self.connections:
+            largest = max(self.ranges, key=lambda item: item[1] - item[0])
+            start, end = largest
+            if end - start < minimum * 2:
+                break
+            middle = start + (end - start) // 2
+            largest[1] = middle
+            self.ranges.append([middle, end])
+        self.ranges.sort()
+
+    def _fetch_ranges(self, fd, validator):
+        errors = []
+        workers = []
+        for item in self.ranges:
+            if self.connections == 1:
+                self._fetch_range(fd, validator, item, errors)
+            else:
+                worker = threading.Thread(target=self._fetch_range, args=(fd, validator, item, errors), daemon=True)
+                worker.start()
+                workers.append(worker)
+        for worker in workers:
+            worker.join()
+        with self.lock:
+            self._save_state(validator, fd)
+        if errors:
+            raise errors[0]
+
+    def _fetch_range(self, fd, validator, item, errors):
+        try:
+            if item[0] >= item[1]:
+                return
+            response = self._open(item[0], item[1] - 1)
+            try:
+                match = CONTENT_RANGE_PATTERN.match(response.headers.get("Content-Range", ""))
+                if response.status != 206 or match is None or int(match.group(1)) != item[0]:
+                    raise DownloadError("Unexpected range response {0}".format(response.status))
+                chunk = memoryview(bytearray(self.chunk_size))
+                unsaved = 0
+                while item[0] < item[1]:
+                    read_size = response.readinto(chunk[:min(self.chunk_size, item[1] - item[0])])
+                    if not read_size:
+                        raise DownloadError("Connection closed at byte {0}".format(item[0]))
+                    os.pwrite(fd, chunk[:read_size], item[0])
+                    if self.connections == 1 and self.digest is not None:
+                        self.digest.update(chunk[:read_size])
+                    with self.lock:
+                        item[0] += read_size
+                        self.downloaded_bytes += read_size
+                        unsaved += read_size
+                        if unsaved >= RangeDownloader.state_save_interval:
+                            self._save_state(validator, fd)
+                            unsaved = 0
+            finally:
+                response.close()
+        except Exception as e:
+            errors.append(e)
+
+    def _stream_whole(self, response):
+        self.digest = hashlib.sha256()
+        chunk = memoryview(bytearray(self.chunk_size))
+        with open(self.part_location, "wb") as f:
+            while True:
+                read_size = response.readinto(chunk)
+                if not read_size:
+                    break
+                f.write(chunk[:read_size])
+                self.digest.update(chunk[:read_size])
+                self.downloaded_bytes += read_size
+        length = response.headers.get("Content-Length")
+        if length is not None and int(length) != self.downloaded_bytes:
+            raise DownloadError("File size doesn't match")
+
+    def _hash_file(self, length):
+        digest = hashlib.sha256()
+        chunk = memoryview(bytearray(self.chunk_size))
+        with open(self.part_location, "rb") as f:
+            remaining = length
+            while remaining > 0:
+                read_size = f.readinto(chunk[:min(self.chunk_size, remaining)])
+                if not read_size:
+                    raise DownloadError("Partial file shorter than expected")
+                digest.update(chunk[:read_size])
+                remaining -= read_size
+        return digest
+
+    def _finish(self):
+        if self.size is not None and os.path.getsize(self.part_location) != self.size:
+            raise DownloadError("File size doesn't match")
+        os.replace(self.part_location, self.location)
+        self._remove(self.state_location)
+        digest = self.digest.hexdigest()
+        logger.info("Download completed, {0} bytes fetched, {1} resumed, sha256 {2}".format(
+            self.downloaded_bytes, self.resumed_bytes, digest))
+        return digest
+
+    def discard_partial(self):
+        """Removes the partial file and its resume state, for a download given up on."""
+        self._remove(self.part_location)
+        self._remove(self.state_location)
+        self._remove(self.state_location + ".tmp")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def download(url, location, connections=1):
+    return RangeDownloader(url, location, connections).download()
+
+
+def discard_partial(location):
+    RangeDownloader(None, location).discard_partial()
@@ -0,0 +1,198 @@
+import collections
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger("EVC04_Agent.meter_history")
+
+MEASUREMENTS = ("voltageP1", "voltageP2", "voltageP3", "currentP1", "currentP2", "currentP3",
+                "activePowerP1", "activePowerP2", "activePowerP3")
+SAMPLE_COLUMNS = ("timestamp",) + MEASUREMENTS + ("activeEnergy",)
+ROLLUP_COLUMNS = ("startTime", "sampleCount") + \
+                 tuple(measurement + suffix for measurement in MEASUREMENTS for suffix in ("Min", "Max", "Avg")) + \
+                 ("energyStart", "energyDelta")
+
+
+class MeterRollup(object):
+    """Min, max and average of each measurement and the energy used in one interval, updated per sample."""
+
+    def __init__(self, start_time, energy_start):
+        self.start_time = start_time
+        self.energy_start = energy_start
+        self.energy_last = energy_start
+        self.count = 0
+        self.minimum = [None] * len(MEASUREMENTS)
+        self.maximum = [None] * len(MEASUREMENTS)
+        self.total = [0] * len(MEASUREMENTS)
+
+    @classmethod
+    def from_row(cls, row):
+        """Rebuilds the rollup of a meterRollups row, in ROLLUP_COLUMNS order."""
+        rollup = cls(row[0], row[-2])
+        rollup.count = row[1]
+        for index in range(len(MEASUREMENTS)):
+            rollup.minimum[index], rollup.maximum[index], average = row[2 + 3 * index:5 + 3 * index]
+            # the stored average is rounded down, the total is off by less than one unit per sample
+            rollup.total[index] = average * rollup.count
+        rollup.energy_last = row[-2] + row[-1]
+        return rollup
+
+    def add(self, values, energy):
+        self.count += 1
+        for index, value in enumerate(values):
+            if self.count == 1 or value < self.minimum[index]:
+                self.minimum[index] = value
+            if self.count == 1 or value > self.maximum[index]:
+                self.maximum[index] = value
+            self.total[index] += value
+        self.energy_last = energy
+
+    def row(self):
+        row = [self.start_time, self.count]
+        for index in range(len(MEASUREMENTS)):
+            row.extend((self.minimum[index], self.maximum[index], self.total[index] // self.count))
+        row.extend((self.energy_start, self.energy_last - self.energy_start))
+        return row
+
+
+class MeterHistory(object):
+    """Fixed size meter history in agent.db.
+
+    Samples and their 1 and 15 minute rollups are kept in ring tables whose
+    slot is derived from the sequence number or interval start, so the tables
+    never grow and old entries are overwritten in place. Rollups are updated in
+    memory as samples arrive and everything finished since the last flush is
+    written in one transaction every flush_interval, which bounds the flash
+    writes to one commit per interval whatever the meter polling rate is.
+    """
+    sample_capacity = 8640
+    resolutions = {60: 7 * 24 * 60, 900: 90 * 24 * 4}  # Rollup interval in seconds to number of slots
+    flush_interval = 5 * 60  # Seconds
+    max_query_rows = 1000
+
+    def __init__(self, database):
+        self.database = database
+        self.lock = threading.Lock()
+        self.sequence = {}  # Charge point id to number of the next sample
+        self.rollups = {}  # (charge point id, resolution) to the rollup of the current interval
+        self.pending_samples = []
+        self.pending_rollups = collections.OrderedDict()
+        self.flush_thread = None
+        self.statistics = {"samples": 0, "flushes": 0, "rowsWritten": 0}
+
+    def start(self):
+        rows = self.database.fetchall("SELECT chargePointId, MAX(sequence) FROM meterSamples GROUP BY chargePointId;")
+        with self.lock:
+            for charge_point_id, sequence in rows:
+                self.sequence[charge_point_id] = sequence + 1
+        # the last interval of each resolution goes on from its flushed row instead of overwriting it
+        rows = self.database.fetchall("SELECT chargePointId, resolution, MAX(startTime), {0} FROM meterRollups "
+                                      "WHERE sampleCount>0 GROUP BY chargePointId, resolution;".format(
+                                          ", ".join(ROLLUP_COLUMNS[1:])))
+        with self.lock:
+            for row in rows:
+                if row[1] in self.resolutions:
+                    self.rollups[(row[0], row[1])] = MeterRollup.from_row(row[2:])
+        self.flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.flush_thread.start()
+
+    def record(self, charge_point_id, voltage, current, active_power, active_energy, timestamp=None):
+        timestamp = int(timestamp or time.time())
+        values = (voltage.P1, voltage.P2, voltage.P3, current.P1, current.P2, current.P3,
+                  active_power.P1, active_power.P2, active_power.P3)
+        energy = active_energy.get_total()
+        with self.lock:
+            sequence = self.sequence.get(charge_point_id, 0)
+            self.sequence[charge_point_id] = sequence + 1
+            self.pending_samples.append(
+                (charge_point_id, sequence % self.sample_capacity, sequence, timestamp) + values + (energy,))
+            for resolution in self.resolutions:
+                start_time = timestamp - timestamp % resolution
+                key = (charge_point_id, resolution)
+                rollup = self.rollups.get(key)
+                if rollup is None or rollup.start_time != start_time:
+                    # the energy delta of an interval starts where the previous interval ended
+                    rollup = MeterRollup(start_time, energy if rollup is None else rollup.energy_last)
+                    self.rollups[key] = rollup
+                rollup.add(values, energy)
+                self.pending_rollups[(charge_point_id, resolution, start_time)] = rollup
+            self.statistics["samples"] += 1
+
+    def flush(self):
+        with self.lock:
+            samples = self.pending_samples
+            self.pending_samples = []
+            # an interval still open is written again by the first flush after its next sample
+            rollups = [(key, rollup.row()) for key, rollup in self.pending_rollups.items()]
+            self.pending_rollups = collections.OrderedDict()
+        if not samples and not rollups:
+            return
+        with self.database.transaction() as cursor:
+            if samples:
+                cursor.executemany("INSERT OR REPLACE INTO meterSamples (chargePointId, slot, sequence, {0}) "
+                                   "VALUES ({1});".format(", ".join(SAMPLE_COLUMNS),
+                                                          ", ".join("?" * (len(SAMPLE_COLUMNS) + 3))),
+                                   samples)
+            if rollups:
+                cursor.executemany("INSERT OR REPLACE INTO meterRollups (chargePointId, resolution, slot, {0}) "
+                                   "VALUES ({1});".format(", ".join(ROLLUP_COLUMNS),
+                                                          ", ".join("?" * (len(ROLLUP_COLUMNS) + 3))),
+                                   [(key[0], key[1], (key[2] // key[1]) % self.resolutions[key[1]]) + tuple(row)
+                                    for key, row in rollups])
+        with self.lock:
+            self.statistics["flushes"] += 1
+            self.statistics["rowsWritten"] += len(samples) + len(rollups)
+
+    def query(self, charge_point_id, start_time, stop_time, resolution=0, limit=None):
+        """Returns the samples, or the rollups of a resolution, from start_time up to stop_time, oldest first."""
+        limit = min(max(1, int(limit or self.max_query_rows)), self.max_query_rows)
+        charge_point_id = int(charge_point_id)
+        start_time = int(start_time)
+        stop_time = int(stop_time)
+        resolution = int(resolution)
+        if resolution == 0:
+            columns = SAMPLE_COLUMNS
+            query = "SELECT {0} FROM meterSamples WHERE chargePointId=? AND timestamp>=? AND timestamp<? " \
+                    "ORDER BY timestamp, sequence LIMIT ?;".format(", ".join(columns))
+            parameters = (charge_point_id, start_time, stop_time, limit)
+        elif resolution in self.resolutions:
+            columns = ROLLUP_COLUMNS
+            query = "SELECT {0} FROM meterRollups WHERE chargePointId=? AND resolution=? AND startTime>=? " \
+                    "AND startTime<? ORDER BY startTime LIMIT ?;".format(", ".join(columns))
+            parameters = (charge_point_id, resolution, start_time, stop_time, limit)
+        else:
+            raise ValueError("Unsupported resolution {0}".format(resolution))
+        rows = [list(row) for row in self.database.fetchall(query, parameters)]
+
+        # data not flushed yet is answered from memory instead of forcing a write
+        with self.lock:
+            if resolution == 0:
+                pending = [list(sample[3:]) for sample in self.pending_samples if sample[0] == charge_point_id]
+            else:
+                pending = [rollup.row() for key, rollup in self.pending_rollups.items()
+                           if key[0] == charge_point_id and key[1] == resolution]
+        pending = [row for row in pending if start_time <= row[0] < stop_time]
+        if resolution == 0:
+            rows = (rows + pending)[:limit]
+        elif pending:
+            # a pending rollup replaces the older copy of its interval already in the table
+            merged = dict((row[0], row) for row in rows)
+            merged.update((row[0], row) for row in pending)
+            rows = sorted(merged.values(), key=lambda row: row[0])[:limit]
+        return {"resolution": resolution, "columns": list(columns), "rows": rows}
+
+    def get_statistics(self):
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics["pendingSamples"] = len(self.pending_samples)
+            statistics["pendingRollups"] = len(self.pending_rollups)
+            return statistics
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except:
+                logger.info("Meter history flush error: {0}".format(traceback.format_exc()))
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger("EVC04_Agent.session_history")
+
+SESSION_COLUMNS = ("sessionUuid", "authorizationUid", "startTime", "stopTime", "status",
+                   "chargePointId", "initialEnergy", "lastEnergy")
+
+
+class ChargeSessionHistory(object):
+    """Queries and bounds the chargeSessions table filled by the moveToSessionTable trigger.
+
+    Pages are read newest first with a keyset cursor of (startTime, rowid), so
+    every page is one range scan of the startTime or (authorizationUid,
+    startTime) index however deep the client pages. Sessions older than
+    retention_days and the oldest ones beyond max_sessions are deleted in
+    batches, and the file is vacuumed when more than compact_ratio of it is free.
+    """
+    retention_days = 730
+    max_sessions = 100000
+    maintenance_interval = 6 * 60 * 60  # Seconds
+    delete_batch_size = 1000
+    compact_ratio = 0.25
+    default_page_size = 50
+    max_page_size = 500
+
+    def __init__(self, database, retention_days=None, max_sessions=None):
+        self.database = database
+        if retention_days is not None:
+            self.retention_days = retention_days
+        if max_sessions is not None:
+            self.max_sessions = max_sessions
+        self.maintenance_thread = None
+
+    def start(self):
+        self.maintenance_thread = threading.Thread(target=self._maintenance, daemon=True)
+        self.maintenance_thread.start()
+
+    def query(self, start_time=None, stop_time=None, authorization_uid=None, cursor=None, limit=None):
+        """Returns one page of sessions and the cursor of the next page, None after the last one."""
+        limit = min(max(1, int(limit or self.default_page_size)), self.max_page_size)
+        conditions = []
+        parameters = []
+        if authorization_uid is not None:
+            conditions.append("authorizationUid=?")
+            parameters.append(str(authorization_uid))
+        if start_time is not None:
+            conditions.append("startTime>=?")
+            parameters.append(int(start_time))
+        if stop_time is not None:
+            conditions.append("startTime<?")
+            parameters.append(int(stop_time))
+        if cursor is not None:
+            cursor_time, cursor_rowid = int(cursor[0]), int(cursor[1])
+            # the separate startTime<=? bound lets the index range scan start at the cursor
+            conditions.append("startTime<=? AND (startTime<? OR rowid<?)")
+            parameters.extend((cursor_time, cursor_time, cursor_rowid))
+        query = "SELECT rowid, {0} FROM chargeSessions{1} ORDER BY startTime DESC, rowid DESC LIMIT ?;".format(
+            ", ".join(SESSION_COLUMNS), " WHERE " + " AND ".join(conditions) if conditions else "")
+        parameters.append(limit + 1)
+        rows = self.database.fetchall(query, parameters)
+
+        sessions = [dict(zip(SESSION_COLUMNS, row[1:])) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = [rows[limit - 1][3], rows[limit - 1][0]]
+        return {"sessions": sessions, "cursor": next_cursor}
+
+    def apply_retention(self):
+        """Deletes the sessions retention_days and max_sessions do not keep, returns how many."""
+        deleted = 0
+        oldest_kept = int(time.time()) - self.retention_days * 24 * 60 * 60
+        query = "DELETE FROM chargeSessions WHERE rowid IN " \
+                "(SELECT rowid FROM chargeSessions WHERE startTime<? LIMIT ?);"
+        deleted += self._delete_in_batches(query, (oldest_kept, self.delete_batch_size))
+
+        row = self.database.fetchone("SELECT startTime FROM chargeSessions ORDER BY startTime DESC LIMIT 1 OFFSET ?;",
+                                     (self.max_sessions,))
+        if row is not None:
+            deleted += self._delete_in_batches(query, (row[0] + 1, self.delete_batch_size))
+        if deleted:
+            logger.info("{0} charge sessions removed from history".format(deleted))
+        return deleted
+
+    def compact(self):
+        page_count = self.database.fetchone("PRAGMA page_count;")[0]
+        free_pages = self.database.fetchone("PRAGMA freelist_count;")[0]
+        if page_count == 0 or free_pages < page_count * self.compact_ratio:
+            return False
+        start = time.monotonic()
+        with self.database.lock:
+            # VACUUM fails inside a transaction, a batched write must not open one between the two
+            self.database.commit()
+            self.database.execute("VACUUM;")
+        logger.info("agent database compacted, {0} of {1} pages freed in {2:.1f} s".format(
+            free_pages, page_count, time.monotonic() - start))
+        return True
+
+    def _delete_in_batches(self, query, parameters):
+        # short transactions keep the session writers from waiting behind one long delete
+        deleted = 0
+        while True:
+            rowcount = self.database.execute(query, parameters)
+            deleted += rowcount
+            if rowcount < self.delete_batch_size:
+                return deleted
+
+    def _maintenance(self):
+        while True:
+            try:
+                if self.apply_retention():
+                    self.compact()
+            except:
+                logger.info("Charge session history maintenance error: {0}".format(traceback.format_exc()))
+            time.sleep(self.maintenance_interval)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Round-trip latency through the agent's ROUTER socket, measured from a local
+# DEALER that stands in for the OCPP/UI/modbus clients. The router echoes every
+# message back the way the mediator answers a request:
+#
+#   python3 zmq_benchmark.py --messages 1000
+
+import argparse
+import os
+import queue
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import zmq
+
+from zmq_router import ZmqRouter
+
+DEALER_IDENTITY = "benchmark"
+
+
+class LegacyRouter(object):
+    # NOBLOCK receive with a 50 ms sleep and a sender thread polling its queue every 10 ms, as agent.py did
+    def __init__(self, endpoint, handler, context):
+        self.endpoint = endpoint
+        self.handler = handler
+        self.context = context
+        self.broker = None
+        self.dealer_queue = queue.Queue()
+
+    def send(self, identity, data):
+        self.dealer_queue.put((identity, data))
+
+    def run(self):
+        self.broker = self.context.socket(zmq.ROUTER)
+        self.broker.bind(self.endpoint)
+        threading.Thread(target=self._sender, daemon=True).start()
+        while True:
+            try:
+                identity = self.broker.recv_string(flags=zmq.NOBLOCK)
+                msg = self.broker.recv_string(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                time.sleep(0.05)
+                continue
+            self.handler(identity, msg)
+
+    def _sender(self):
+        while True:
+            if not self.dealer_queue.empty():
+                identity, data = self.dealer_queue.get()
+                self.broker.send_string(identity, flags=zmq.SNDMORE)
+                self.broker.send_string(data)
+            time.sleep(0.01)
+
+
+def run(name, router_class, messages, idle_seconds):
+    directory = tempfile.mkdtemp(prefix="zmq_benchmark_")
+    endpoint = "ipc://" + os.path.join(directory, "routing.ipc")
+    context = zmq.Context()
+    router = router_class(endpoint, lambda identity, msg: router.send(identity, msg), context)
+    threading.Thread(target=router.run, daemon=True).start()
+    time.sleep(0.2)
+
+    dealer = context.socket(zmq.DEALER)
+    dealer.setsockopt_string(zmq.IDENTITY, DEALER_IDENTITY)
+    dealer.connect(endpoint)
+    try:
+        dealer.send_string("warmup")
+        dealer.recv_string()
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        time.sleep(idle_seconds)
+        idle_usage = resource.getrusage(resource.RUSAGE_SELF)
+        idle_cpu = (idle_usage.ru_utime + idle_usage.ru_stime - usage.ru_utime - usage.ru_stime) / idle_seconds
+
+        latencies = []
+        for index in range(messages):
+            start = time.perf_counter()
+            dealer.send_string(str(index))
+            if dealer.recv_string() != str(index):
+                raise SystemExit("{0}: reply out of order".format(name))
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print("{0:<8} mean {1:>8.3f} ms  p50 {2:>8.3f} ms  p99 {3:>8.3f} ms  max {4:>8.3f} ms  idle cpu {5:>5.1f} %".format(
+            name, sum(latencies) * 1000 / len(latencies), latencies[len(latencies) // 2] * 1000,
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, latencies[-1] * 1000,
+            idle_cpu * 100))
+    finally:
+        dealer.close(linger=0)
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="agent ROUTER round-trip benchmark")
+    parser.add_argument("--messages", type=int, default=1000, help="sequential request/reply pairs")
+    parser.add_argument("--idle", type=float, default=2.0, help="seconds of idle CPU measurement")
+    parser.add_argument("--mode", choices=("legacy", "poller", "both"), default="both")
+    args = parser.parse_args()
+
+    if args.mode in ("legacy", "both"):
+        # every legacy round trip waits out a 50 ms sleep, a few hundred are enough
+        run("legacy", LegacyRouter, min(args.messages, 200), args.idle)
+    if args.mode in ("poller", "both"):
+        run("poller", ZmqRouter, args.messages, args.idle)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import collections
+import logging
+import os
+import traceback
+
+import zmq
+
+logger = logging.getLogger("EVC04_Agent.zmq_router")
+
+
+class ZmqRouter(object):
+    """ROUTER socket owned by a single thread.
+
+    The thread blocks in a Poller until a dealer message arrives or another
+    thread queues an outgoing one with send(), which wakes the poll through a
+    pipe. Each wakeup receives everything that is ready, up to max_batch
+    messages, and then sends everything that is queued, so the socket is never
+    touched by two threads and nothing waits for a polling period.
+    """
+    poll_timeout = 1000  # Milliseconds
+    max_batch = 100  # Messages received per wakeup before the queued sends get a turn
+
+    def __init__(self, endpoint, handler, context=None):
+        self.endpoint = endpoint
+        self.handler = handler
+        self.context = context or zmq.Context.instance()
+        self.socket = None
+        self.outgoing = collections.deque()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.statistics = {"received": 0, "sent": 0, "wakeups": 0, "malformed": 0}
+
+    def send(self, identity, data):
+        self.outgoing.append((identity, data))
+        try:
+            os.write(self.wakeup_write, b"\0")
+        except BlockingIOError:
+            # the pipe is full of wakeups the router has not read yet, one more is not needed
+            pass
+
+    def run(self):
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(self.endpoint)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.wakeup_read, zmq.POLLIN)
+
+        while True:
+            events = dict(poller.poll(self.poll_timeout))
+            if not events:
+                continue
+            self.statistics["wakeups"] += 1
+            if self.wakeup_read in events:
+                # drained before the queue, a send() racing with it leaves a byte for the next poll
+                try:
+                    os.read(self.wakeup_read, 4096)
+                except BlockingIOError:
+                    pass
+            if self.socket in events:
+                self._receive_ready()
+            self._send_queued()
+
+    def _receive_ready(self):
+        for _ in range(self.max_batch):
+            try:
+                frames = self.socket.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if len(frames) != 2:
+                self.statistics["malformed"] += 1
+                logger.info("Zmq message with {0} frames dropped".format(len(frames)))
+                continue
+            self.statistics["received"] += 1
+            try:
+                self.handler(frames[0].decode("utf-8"), frames[1].decode("utf-8"))
+            except:
+                logger.info("Router receive parse error: {0}".format(traceback.format_exc()))
+
+    def _send_queued(self):
+        while self.outgoing:
+            identity, data = self.outgoing.popleft()
+            try:
+                self.socket.send_multipart([identity.encode("utf-8"), data.encode("utf-8")])
+                self.statistics["sent"] += 1
+            except zmq.ZMQError:
+                logger.info("Zmq send to {0} failed: {1}".format(identity, traceback.format_exc()))